@@ -1,5 +1,6 @@
-from flask import Flask, request
+from flask import Flask, g, jsonify, make_response, request
 from flask_restful import Resource, Api, reqparse
+from flask_restful.representations.json import output_json
 from flask_cors import CORS
 from werkzeug.routing import BaseConverter
 
@@ -8,7 +9,8 @@ import resources.course
 from config.course import BASE_URL as COURSE_BASE_URL
 import resources.fce
 from config.fce import BASE_URL as FCE_BASE_URL
-from common import Message, search, utils
+from config.es_config import ES_FCE_INDEX
+from common import Message, index_version, metrics, search, utils, warmup
 # Raygun
 # if settings.RAYGUN_APIKEY is not None:
 #     from raygun4py.middleware import flask
@@ -19,6 +21,8 @@ if settings.SENTRY_DSN is not None:
 app = Flask(__name__)
 CORS(app)
 api = Api(app, catch_all_404s=True)
+# Times the requests from before they are routed
+app.wsgi_app = metrics.wsgi_middleware(app.wsgi_app)
 
 # # Raygun
 # if settings.RAYGUN_APIKEY is not None:
@@ -30,12 +34,145 @@ if settings.SENTRY_DSN is not None:
 
 
 ##
-## Startup script
+## Metrics
 ##
-@app.before_first_request
-def startup():
-    # Initialize connection to ES server
-    search.init_es_connection()
+
+@app.before_request
+def start_metrics():
+    metrics.start_request()
+
+
+@app.after_request
+def record_metrics(response):
+    metrics.end_request(response)
+    return response
+
+
+@app.teardown_request
+def finish_metrics(exc):
+    metrics.finish_request()
+
+
+@api.representation('application/json')
+def output_timed_json(data, code, headers=None):
+    with metrics.timer('serialize'):
+        if app.debug:
+            # Indented by flask_restful
+            return output_json(data, code, headers)
+        response = make_response(utils.dumps_json(data) + b'\n', code)
+        response.headers.extend(headers or {})
+        return response
+
+
+@app.route('/metrics')
+def get_metrics():
+    return app.response_class(metrics.render(),
+                              content_type=metrics.CONTENT_TYPE)
+
+
+##
+## Warmup
+##
+
+# Whether the first request of the worker started its warmup
+_warmup_started = False
+
+
+@app.before_request
+def start_warmup():
+    # Connects to ES, and loads the local indexes in the background unless
+    # gunicorn.conf.py already did before the worker started serving. The
+    # requests do not wait for them. Once started, the warmup is retried
+    # until it succeeds, so the later requests skip this.
+    global _warmup_started
+    if _warmup_started:
+        return
+    warmup.connect()
+    warmup.start()
+    _warmup_started = True
+
+
+# @brief  Readiness of the worker: 200 once it is warm, 503 before
+@app.route('/health')
+def get_health():
+    response = jsonify(warmup.status())
+    if not warmup.is_ready():
+        response.status_code = 503
+    return response
+
+
+##
+## Conditional requests
+##
+
+# The endpoints answering with data of the course indexes only
+COURSE_ENDPOINTS = {
+    'coursedetail', 'coursedetailbyterm', 'coursedetailallterms',
+    'instructor', 'instructorbyterm', 'buildingbyterm', 'roombyterm',
+    'buildingoccupancy', 'buildingoccupancybyterm', 'buildingroom',
+    'buildingroombyterm', 'datetime', 'datetimespan', 'search',
+    'listallcoursesbyterm',
+}
+# The endpoints answering with a course and its FCEs
+FCE_JOIN_ENDPOINTS = {'coursewithfces', 'coursewithfcesbyterm'}
+# The endpoints answering with data of the FCE index only
+FCE_ENDPOINTS = {
+    'fcebyid', 'fcebyinstructor', 'fcesummarybyid', 'fcesummarybyinstructor',
+    'fcesummarybydepartment',
+}
+
+
+##
+## @brief      Gets the ES indexes a request reads from, or None if its
+##             response does not only depend on the data of indexes, e.g.
+##             the home pages and the batch of courses.
+##
+def get_request_indexes():
+    if request.method not in ('GET', 'HEAD') or request.view_args is None:
+        return None
+    if request.endpoint in COURSE_ENDPOINTS or \
+            request.endpoint in FCE_JOIN_ENDPOINTS:
+        if request.view_args.get('datetime_str') == 'now':
+            # Depends on the time of the request
+            return None
+        # The terms of all course indexes when no term is given
+        index = search.get_course_index(request.view_args.get('term'))
+        if request.endpoint in FCE_JOIN_ENDPOINTS:
+            return [index, ES_FCE_INDEX]
+        return [index]
+    if request.endpoint in FCE_ENDPOINTS:
+        return [ES_FCE_INDEX]
+    return None
+
+
+@app.before_request
+def check_not_modified():
+    indexes = get_request_indexes()
+    if indexes is None:
+        return None
+    version = index_version.get_all(indexes)
+    if version is None:
+        return None
+    g.index_version = version
+
+    # Answered before any search is made
+    if request.if_none_match:
+        if request.if_none_match.contains_weak(version.etag):
+            return app.response_class(status=304)
+    elif request.if_modified_since is not None:
+        if version.last_modified <= request.if_modified_since:
+            return app.response_class(status=304)
+    return None
+
+
+@app.after_request
+def add_validators(response):
+    version = g.get('index_version')
+    if version is not None and response.status_code in (200, 304):
+        response.set_etag(version.etag, weak=True)
+        response.last_modified = version.last_modified
+        response.headers['Cache-Control'] = settings.HTTP_CACHE_CONTROL
+    return response
 
 
 class RegexConverter(BaseConverter):
@@ -57,6 +194,10 @@ api.add_resource(resources.course.CourseapiHome, COURSE_BASE_URL + '/')
 # /course/:course-id
 api.add_resource(resources.course.CourseDetail, COURSE_BASE_URL + r'/course/<regex("\d{2}-\d{3}"):courseid>/')
 api.add_resource(resources.course.CourseDetailByTerm, COURSE_BASE_URL + r'/course/<regex("\d{2}-\d{3}"):courseid>/' + TERM_ENDPOINT)
+api.add_resource(resources.course.CourseWithFCEs, COURSE_BASE_URL + r'/course/<regex("\d{2}-\d{3}"):courseid>/fce/')
+api.add_resource(resources.course.CourseWithFCEsByTerm, COURSE_BASE_URL + r'/course/<regex("\d{2}-\d{3}"):courseid>/' + TERM_ENDPOINT + 'fce/')
+# /courses, batch of course ids
+api.add_resource(resources.course.CourseBatch, COURSE_BASE_URL + '/courses/')
 # /courseid/:course-id/
 api.add_resource(resources.course.CourseDetailAllTerms, COURSE_BASE_URL + r'/courseid/<regex("\d{2}-\d{3}"):courseid>/')
 
@@ -69,6 +210,9 @@ api.add_resource(resources.course.BuildingByTerm, COURSE_BASE_URL + '/building/<
 # /room/:room
 # api.add_resource(Room, COURSE_BASE_URL + '/room/<room>/')
 api.add_resource(resources.course.RoomByTerm, COURSE_BASE_URL + '/room/<room>/' + TERM_ENDPOINT)
+# /building/:building/occupancy, of the current term when no term is given
+api.add_resource(resources.course.BuildingOccupancy, COURSE_BASE_URL + '/building/<building>/occupancy/', defaults={'term': 'current'}, endpoint='buildingoccupancy')
+api.add_resource(resources.course.BuildingOccupancy, COURSE_BASE_URL + '/building/<building>/occupancy/' + TERM_ENDPOINT, endpoint='buildingoccupancybyterm')
 # building/:building/room/:room
 api.add_resource(resources.course.BuildingRoom, COURSE_BASE_URL + '/building/<building>/room/<room>/')
 api.add_resource(resources.course.BuildingRoomByTerm, COURSE_BASE_URL + '/building/<building>/room/<room>/' + TERM_ENDPOINT)
@@ -82,6 +226,9 @@ api.add_resource(resources.course.ListAllCoursesByTerm, COURSE_BASE_URL + '/list
 
 api.add_resource(resources.fce.FCEByID, FCE_BASE_URL + '/courseid/<courseid>/')
 api.add_resource(resources.fce.FCEByInstructor, FCE_BASE_URL + '/instructor/<instructor>/')
+api.add_resource(resources.fce.FCESummaryByID, FCE_BASE_URL + '/courseid/<courseid>/summary/')
+api.add_resource(resources.fce.FCESummaryByInstructor, FCE_BASE_URL + '/instructor/<instructor>/summary/')
+api.add_resource(resources.fce.FCESummaryByDepartment, FCE_BASE_URL + '/department/<department>/summary/')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,264 @@
+# @file asgi.py
+# @brief The asyncio serving mode of the api, with the URL map, hooks and
+#        resources of api.py.
+#
+#        The resources with a get_async() method (the course details and
+#        the instructor endpoints) are served on the event loop of the
+#        worker: their searches await Searcher.execute_async(), which sends
+#        the ES requests with the async client of common/aio.py, so any
+#        number of them wait for ES at once without holding a thread. The
+#        hooks of api.py (metrics, warmup, conditional requests) run around
+#        them as they do in Flask.
+#
+#        The other endpoints, and the streamed responses, are served by the
+#        Flask app in a pool of ASGI_HANDLER_THREADS threads, each one
+#        blocking for the whole request as in a gthread worker.
+#
+#        Run with e.g.
+#        gunicorn asgi:application -k uvicorn.workers.UvicornWorker
+# @author Justin Chu (justinchuby@cmu.edu)
+
+import asyncio
+import inspect
+import io
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import request
+from flask_restful.utils import unpack
+from werkzeug.exceptions import HTTPException
+from werkzeug.wrappers import Response as ResponseBase
+
+import config.es_config
+import config.settings as settings
+from api import api, app
+from common import aio, metrics
+
+
+_executor = ThreadPoolExecutor(max_workers=settings.ASGI_HANDLER_THREADS)
+# Chunks of a response body waiting to be sent
+_QUEUE_SIZE = 8
+
+
+def _build_environ(scope, body):
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'],
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name != 'CONTENT_LENGTH':
+            key = 'HTTP_' + name
+            if key in environ:
+                value = environ[key] + ',' + value
+            environ[key] = value
+    return environ
+
+
+async def _read_body(receive):
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+    return body
+
+
+##
+## @brief      Gets the resource and the get_async() method serving a request
+##             on the event loop.
+##
+## @return     (resource class, method), or None if the request is served by
+##             the Flask app: it has no async method, is streamed, or does
+##             not match a route.
+##
+def _get_async_view(environ):
+    if environ['REQUEST_METHOD'] != 'GET':
+        return None
+    try:
+        endpoint, _ = app.url_map.bind_to_environ(environ).match()
+    except HTTPException:
+        # Answered by Flask, e.g. 404 or a redirect to the trailing slash
+        return None
+    resource = getattr(app.view_functions.get(endpoint), 'view_class', None)
+    method = getattr(resource, 'get_async', None)
+    if method is None:
+        return None
+    if 'stream' in environ['QUERY_STRING'].split('&'):
+        return None
+    return resource, method
+
+
+##
+## @brief      Calls the async method of a resource, then makes its response
+##             as flask_restful does with the return value of a method.
+##
+async def _dispatch(resource, method):
+    rv = method(resource(), **request.view_args)
+    if inspect.isawaitable(rv):
+        # Not awaitable when a decorator answered, e.g. utils.paged
+        rv = await rv
+    if isinstance(rv, ResponseBase):
+        return rv
+    data, code, headers = unpack(rv)
+    return api.make_response(data, code, headers=headers)
+
+
+def _response_start(status, headers):
+    return {
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                    for name, value in headers],
+    }
+
+
+##
+## @brief      Serves a request on the event loop, within a request context
+##             of the Flask app and with its hooks, as Flask does. The
+##             context belongs to the task of the request.
+##
+async def _serve_async(environ, resource, method, send):
+    environ[metrics.START_KEY] = time.perf_counter()
+    with app.request_context(environ):
+        try:
+            try:
+                rv = app.preprocess_request()
+                if rv is None:
+                    rv = await _dispatch(resource, method)
+            except Exception as e:
+                rv = app.handle_user_exception(e)
+            response = app.finalize_request(rv)
+        except Exception as e:
+            response = app.handle_exception(e)
+        try:
+            await send(_response_start(response.status_code,
+                                       response.headers.items()))
+            await send({'type': 'http.response.body',
+                        'body': response.get_data()})
+        finally:
+            response.close()
+
+
+##
+## @brief      Runs the Flask app in a handler thread and puts the chunks of
+##             its body into the queue, followed by None. The whole body is
+##             iterated in the same thread, where the request context of a
+##             streamed response lives. Putting blocks while the queue is
+##             full, so a slow client holds back the generation of the body.
+##
+def _run_app(environ, started, loop, queue, cancelled):
+    def start_response(status, headers, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0])
+        started['headers'] = headers
+
+    def put(chunk):
+        asyncio.run_coroutine_threadsafe(queue.put(chunk), loop).result()
+
+    try:
+        chunks = app(environ, start_response)
+        try:
+            for chunk in chunks:
+                if cancelled.is_set():
+                    break
+                if chunk:
+                    put(chunk)
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+    finally:
+        put(None)
+
+
+##
+## @brief      Serves a request with the Flask app in a handler thread.
+##
+async def _serve_wsgi(environ, send):
+    loop = asyncio.get_event_loop()
+    started = {}
+    queue = asyncio.Queue(maxsize=_QUEUE_SIZE)
+    cancelled = threading.Event()
+    future = loop.run_in_executor(_executor, _run_app, environ, started, loop,
+                                  queue, cancelled)
+
+    chunk = await queue.get()
+    if chunk is None:
+        # Raises the error of the app, if any
+        await future
+    finished = chunk is None
+    try:
+        await send(_response_start(started['status'], started['headers']))
+        if finished:
+            await send({'type': 'http.response.body', 'body': b''})
+        # Streamed responses are sent as they are generated instead of being
+        # held in memory
+        while not finished:
+            next_chunk = await queue.get()
+            finished = next_chunk is None
+            await send({'type': 'http.response.body', 'body': chunk,
+                        'more_body': not finished})
+            chunk = next_chunk
+    except BaseException:
+        # The client went away, stop the app and let it finish
+        cancelled.set()
+        while not finished:
+            finished = await queue.get() is None
+        raise
+    await future
+
+
+def _connect():
+    # The snapshot backend has no async client: its searches are answered
+    # in memory by Searcher.execute_async()
+    if config.es_config.ES_BACKEND != 'snapshot' and not aio.has_client():
+        aio.init_es_async_connection()
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            _connect()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await aio.close_es_async_connection()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    # When the server does not support the lifespan protocol
+    _connect()
+    environ = _build_environ(scope, await _read_body(receive))
+    view = _get_async_view(environ)
+    if view is None:
+        await _serve_wsgi(environ, send)
+    else:
+        await _serve_async(environ, view[0], view[1], send)
@@ -0,0 +1,163 @@
+# @file corpus.py
+# @brief Synthetic course catalog and FCE records for the benchmarks, in the
+#        scottylabs schema read by common/cmu_course.py. The same seed gives
+#        the same catalog, so that runs can be compared.
+# @author Justin Chu (justinchuby@cmu.edu)
+
+import random
+
+DEPARTMENTS = [
+    (15, 'Computer Science'), (18, 'Electrical and Computer Engineering'),
+    (21, 'Mathematical Sciences'), (33, 'Physics'), (36, 'Statistics'),
+    (76, 'English'), (79, 'History'), (80, 'Philosophy'),
+    (85, 'Psychology'), (99, 'Carnegie Mellon University-Wide Studies'),
+]
+
+BUILDINGS = ['DH', 'WEH', 'GHC', 'BH', 'PH', 'SH', 'HH', 'MM', 'POS', 'CYH']
+
+FIRST_NAMES = ['David', 'Mary', 'Timothy', 'Pan', 'Margaret', 'John',
+               'Stephanie', 'Ananya', 'Wei', 'Carlos', 'Rebecca', 'Ahmed']
+LAST_NAMES = ['Kosbie', 'Flaherty', 'Liu', 'Mackey', 'Smith', 'Balcan',
+              'Rosenfeld', 'Garcia', 'Chen', 'Okafor', 'Nguyen', 'Patel',
+              'Johnson', 'Kim', 'Schwartz', 'Ivanova']
+
+WORDS = ['introduction', 'principles', 'systems', 'theory', 'design',
+         'analysis', 'algorithms', 'programming', 'modern', 'advanced',
+         'seminar', 'data', 'networks', 'history', 'culture', 'logic',
+         'probability', 'physics', 'machine', 'learning', 'writing',
+         'research', 'methods', 'computation', 'structures', 'ethics']
+
+# The term of each semester letter, as used in the rundate and semester
+SEMESTERS = {'f': 'Fall', 's': 'Spring', 'm1': 'Summer One',
+             'm2': 'Summer Two'}
+
+
+def _format_time(minutes):
+    hour, minute = divmod(minutes, 60)
+    return '{:02d}:{:02d}{}'.format(hour % 12 or 12, minute,
+                                    'AM' if hour < 12 else 'PM')
+
+
+def _words(rng, count):
+    return ' '.join(rng.choice(WORDS) for _ in range(count))
+
+
+def _instructor(rng):
+    return '{}, {}'.format(rng.choice(LAST_NAMES), rng.choice(FIRST_NAMES))
+
+
+def _times(rng, count):
+    times = []
+    for _ in range(count):
+        # Classes begin on the half hour between 8:00AM and 7:30PM
+        begin = rng.randrange(16, 40) * 30
+        length = rng.choice([50, 80, 110, 170])
+        days = sorted(rng.sample(range(1, 6), rng.choice([1, 2, 2, 3])))
+        building = rng.choice(BUILDINGS)
+        room = str(rng.randint(100, 5310))
+        times.append({
+            'days': days,
+            'begin': _format_time(begin),
+            'end': _format_time(begin + length),
+            'building': building,
+            'room': room,
+            'location': 'Pittsburgh, Pennsylvania',
+        })
+    return times
+
+
+def _meeting(rng, name, instructors):
+    return {
+        'name': name,
+        'instructors': instructors,
+        'times': _times(rng, rng.choice([1, 1, 1, 2])),
+    }
+
+
+##
+## @brief      Generates the courses of a term.
+##
+## @param      count  (int) The number of courses
+## @param      term   (str) The short name of the term, e.g. f17
+## @param      seed   The seed of the random generator
+##
+## @return     A list of scottylabs course dicts, with unique courseids.
+##
+def generate_courses(count, term='f17', seed=0):
+    rng = random.Random('{}:{}'.format(seed, term))
+    letters = term.rstrip('0123456789')
+    year = 2000 + int(term[len(letters):])
+    semester = '{} {}'.format(SEMESTERS[letters], year)
+    courses = []
+    numbers = rng.sample(range(len(DEPARTMENTS) * 1000), count)
+    for number in numbers:
+        department, department_name = DEPARTMENTS[number // 1000]
+        courseid = '{:02d}-{:03d}'.format(department, number % 1000)
+        instructors = [_instructor(rng)
+                       for _ in range(rng.choice([1, 1, 1, 2]))]
+        lectures = [_meeting(rng, 'Lec {}'.format(i + 1), instructors)
+                    for i in range(rng.choice([1, 1, 2]))]
+        sections = [_meeting(rng, chr(ord('A') + i), [_instructor(rng)])
+                    for i in range(rng.choice([0, 1, 3, 6, 10]))]
+        prereqs = None
+        if rng.random() < 0.4:
+            prereqs = '{:02d}-{:03d}'.format(department, rng.randrange(1000))
+        courses.append({
+            'id': courseid,
+            'name': _words(rng, rng.randint(2, 5)).title(),
+            'department': department_name,
+            'units': float(rng.choice([3, 6, 9, 10, 12])),
+            'desc': _words(rng, rng.randint(40, 120)).capitalize() + '.',
+            'prereqs': prereqs,
+            'prereqs_obj': {'invert': False,
+                            'reqs_list': [[prereqs]] if prereqs else None},
+            'coreqs': None,
+            'coreqs_obj': {'invert': None, 'reqs_list': None},
+            'lectures': lectures,
+            'sections': sections,
+            'rundate': '{}-08-20'.format(year),
+            'semester': semester,
+        })
+    return courses
+
+
+##
+## @brief      Generates FCE records for the lectures of courses, one per
+##             instructor and year.
+##
+## @param      courses  The courses given by generate_courses()
+## @param      years    The years of the records
+##
+## @return     A list of FCE dicts.
+##
+def generate_fces(courses, years=(2014, 2015, 2016, 2017), seed=0):
+    rng = random.Random('{}:fce'.format(seed))
+    fces = []
+    for course in courses:
+        instructors = set()
+        for lecture in course['lectures']:
+            instructors.update(lecture['instructors'])
+        for year in years:
+            for instructor in sorted(instructors):
+                enrollment = rng.randint(8, 400)
+                fces.append({
+                    'year': year,
+                    'semester': rng.choice(['Fall', 'Spring']),
+                    'college': 'School of Computer Science',
+                    'department': course['department'],
+                    'courseid': course['id'],
+                    'section': 'A',
+                    'name': course['name'],
+                    'instructor': instructor.upper(),
+                    'type': 'Lecture',
+                    'enrollment': enrollment,
+                    'responses': rng.randint(1, enrollment),
+                    'hrs_per_week': round(rng.uniform(2, 20), 2),
+                    'rating': {
+                        'interest': round(rng.uniform(2.5, 5), 2),
+                        'clear_goals': round(rng.uniform(2.5, 5), 2),
+                        'overall_teaching': round(rng.uniform(2.5, 5), 2),
+                        'overall_course': round(rng.uniform(2.5, 5), 2),
+                    },
+                })
+    return fces
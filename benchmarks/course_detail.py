@@ -0,0 +1,70 @@
+# @file course_detail.py
+# @brief Compares the latency of the course detail lookup by a GET of the
+#        document with the one of the term query it replaces, against the
+#        configured ES cluster.
+#
+#        Run from the root of the repository with e.g.
+#        python benchmarks/course_detail.py --term f17 --courseid 15-112 -n 200
+# @author Justin Chu (justinchuby@cmu.edu)
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from common import search  # noqa: E402
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+
+def bench(fetch, n):
+    # One request to open the connection
+    fetch()
+    samples = []
+    for _ in range(n):
+        start = time.perf_counter()
+        response = fetch()
+        samples.append((time.perf_counter() - start) * 1000)
+        if search.has_error(response):
+            raise RuntimeError(response)
+    return samples
+
+
+def report(name, samples):
+    print("{:<8} p50 {:7.2f} ms  p95 {:7.2f} ms  p99 {:7.2f} ms  "
+          "mean {:7.2f} ms".format(name,
+                                   percentile(samples, 50),
+                                   percentile(samples, 95),
+                                   percentile(samples, 99),
+                                   sum(samples) / len(samples)))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Course detail lookup: GET by _id vs term query')
+    parser.add_argument('--term', default='current')
+    parser.add_argument('--courseid', default='15-112')
+    parser.add_argument('-n', type=int, default=200)
+    args = parser.parse_args()
+
+    search.init_es_connection()
+    searcher = search.CourseSearcher({'courseid': [args.courseid]},
+                                     index=args.term, size=1)
+    doc_id = searcher.doc_id()
+    print("{} in {}, {} requests each".format(args.courseid, searcher.index,
+                                              args.n))
+
+    report('GET', bench(lambda: searcher.fetch_by_id(
+        doc_id, searcher.index, doc_type=searcher.doc_type), args.n))
+    report('search', bench(lambda: searcher.fetch(
+        searcher.generate_query(), searcher.index, size=searcher.size,
+        doc_type=searcher.doc_type), args.n))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+# @file fake_es.py
+# @brief An in-memory stand-in for the Elasticsearch client, answering the
+#        requests the api makes from a few lists of documents, so that the
+#        endpoints can be benchmarked without a cluster. The requests are
+#        evaluated by common/memory_es.py.
+#        AsyncFakeElasticsearch answers the requests of the async client of
+#        the asyncio serving mode (asgi.py) the same way.
+# @author Justin Chu (justinchuby@cmu.edu)
+
+import asyncio
+import functools
+import threading
+import time
+
+from common.memory_es import DocumentList, InMemoryElasticsearch
+
+
+##
+## @brief      Counts a request of the stand-in and the time spent on it.
+##
+def _timed(f):
+    @functools.wraps(f)
+    def g(self, *args, **kwargs):
+        start = time.perf_counter()
+        if self.latency:
+            time.sleep(self.latency)
+        try:
+            return f(self, *args, **kwargs)
+        finally:
+            with self._lock:
+                self.requests += 1
+                self.seconds += time.perf_counter() - start
+    return g
+
+
+##
+## @brief      The stand-in client. Documents are added with index_many();
+##             every request optionally sleeps for latency seconds, to model
+##             the round trip to a cluster.
+##
+class FakeElasticsearch(InMemoryElasticsearch):
+    def __init__(self, latency=0.0):
+        super().__init__()
+        self.latency = latency
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.seconds = 0.0
+
+    def index_many(self, index, doc_type, docs, id_field=None):
+        entries = self.indexes.setdefault(index, DocumentList())
+        for doc in docs:
+            doc_id = str(doc[id_field] if id_field else len(entries))
+            entries.add(doc_type, doc_id, doc)
+
+    ##
+    ## @brief      The number of requests answered and the seconds spent on
+    ##             them, latency included.
+    ##
+    def stats(self):
+        with self._lock:
+            return {'requests': self.requests, 'seconds': self.seconds}
+
+    search = _timed(InMemoryElasticsearch.search)
+    scroll = _timed(InMemoryElasticsearch.scroll)
+    get = _timed(InMemoryElasticsearch.get)
+    mget = _timed(InMemoryElasticsearch.mget)
+    msearch = _timed(InMemoryElasticsearch.msearch)
+
+
+##
+## @brief      Answers a request of the async stand-in from its documents,
+##             after awaiting latency seconds.
+##
+def _awaited(name):
+    async def f(self, *args, **kwargs):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            return getattr(self.es, name)(*args, **kwargs)
+        finally:
+            self.in_flight -= 1
+    f.__name__ = name
+    return f
+
+
+##
+## @brief      The stand-in of the async client, answering from the
+##             documents of a FakeElasticsearch. Its requests wait on the
+##             event loop, so concurrent ones overlap; max_in_flight is the
+##             most of them waiting at once.
+##
+class AsyncFakeElasticsearch(object):
+    def __init__(self, es, latency=0.0):
+        self.es = es
+        self.latency = latency
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    search = _awaited('search')
+    get = _awaited('get')
+    mget = _awaited('mget')
+    msearch = _awaited('msearch')
@@ -0,0 +1,85 @@
+# @file query_templates.py
+# @brief Compares the CPU time spent building the body of a search with the
+#        DSL and with the compiled query templates, for the query shapes of
+#        the endpoints. No ES request is made.
+#
+#        Run from the root of the repository with e.g.
+#        python benchmarks/query_templates.py -n 5000
+# @author Justin Chu (justinchuby@cmu.edu)
+
+import argparse
+import os
+import sys
+import time
+
+import arrow
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import config.settings  # noqa: E402
+from common import search  # noqa: E402
+
+DATETIME = arrow.get('2017-09-12T10:30:00-04:00')
+
+# (name, searcher class, raw query, term)
+SHAPES = [
+    ('courseid', search.CourseSearcher, {'courseid': ['15-112']}, None),
+    ('instructor', search.CourseSearcher,
+     {'instructor': ['kosbie', 'david']}, 'f17'),
+    ('instructor_fuzzy', search.CourseSearcher,
+     {'instructor': ['kosbie'], 'instructor_fuzzy': [True]}, 'f17'),
+    ('building', search.CourseSearcher, {'building': ['dh']}, 'f17'),
+    ('building_room', search.CourseSearcher,
+     {'building': ['dh'], 'room': ['2315']}, 'f17'),
+    ('datetime', search.CourseSearcher,
+     {'datetime': [DATETIME], 'timespan': [0]}, 'f17'),
+    ('datetime_midnight', search.CourseSearcher,
+     {'datetime': [DATETIME.replace(hour=23)], 'timespan': [120]}, 'f17'),
+    ('search', search.CourseSearcher,
+     {'text': ['machine learning'], 'instructor': ['smith']}, 'f17'),
+    ('fce_instructor', search.FCESearcher, {'instructor': ['kosbie']},
+     'fce'),
+]
+
+
+##
+## @brief      Builds the body of the search request of a searcher, as
+##             execute() does before sending it.
+##
+def build_body(searcher):
+    s = searcher.build_search(searcher.generate_query(), searcher.index,
+                              size=searcher.size, doc_type=searcher.doc_type)
+    return s.to_dict()
+
+
+def bench(searcher, n, templates):
+    config.settings.QUERY_TEMPLATES = templates
+    # Compiles the template of the shape
+    body = build_body(searcher)
+    start = time.process_time()
+    for _ in range(n):
+        build_body(searcher)
+    return (time.process_time() - start) / n * 1e6, body
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Query building: elasticsearch_dsl vs compiled templates')
+    parser.add_argument('-n', type=int, default=2000,
+                        help='requests per shape')
+    args = parser.parse_args()
+
+    print("{:<18} {:>10} {:>12} {:>10} {:>8}".format(
+        'shape', 'dsl us', 'template us', 'saved us', 'speedup'))
+    for name, searcher_class, raw_query, term in SHAPES:
+        searcher = searcher_class(raw_query, index=term)
+        dsl, dsl_body = bench(searcher, args.n, False)
+        template, template_body = bench(searcher, args.n, True)
+        if dsl_body != template_body:
+            raise RuntimeError("The bodies of {} differ".format(name))
+        print("{:<18} {:>10.1f} {:>12.1f} {:>10.1f} {:>7.1f}x".format(
+            name, dsl, template, dsl - template, dsl / template))
+
+
+if __name__ == '__main__':
+    main()
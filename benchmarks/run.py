@@ -0,0 +1,339 @@
+# @file run.py
+# @brief Drives every route of api.py at a fixed concurrency against a
+#        synthetic catalog served by the in-memory ES stand-in, and reports
+#        the latency percentiles, throughput and memory of each endpoint.
+#
+#        Run from the root of the repository with e.g.
+#        python benchmarks/run.py --courses 2000 --concurrency 8 -n 100
+#
+#        Save a run with --json and compare a later one against it with
+#        --baseline: the exit status is 1 when an endpoint got slower than
+#        the tolerance allows.
+# @author Justin Chu (justinchuby@cmu.edu)
+
+import argparse
+import concurrent.futures
+import datetime
+import json
+import os
+import random
+import resource
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import config.settings  # noqa: E402
+import config.cache  # noqa: E402
+import config.course  # noqa: E402
+import config.fce  # noqa: E402
+from config.es_config import ES_COURSE_INDEX_PREFIX, ES_FCE_INDEX  # noqa
+from elasticsearch_dsl.connections import connections  # noqa: E402
+
+from benchmarks import corpus  # noqa: E402
+from benchmarks.fake_es import FakeElasticsearch  # noqa: E402
+from common import utils  # noqa: E402
+
+# A past term served along with the current one
+PAST_TERM = 'f17'
+
+
+##
+## @brief      The catalog the requests are drawn from.
+##
+class Catalog(object):
+    def __init__(self, courses_per_term, seed):
+        self.current_term = utils.get_semester_short_from_date(
+            datetime.date.today())
+        self.terms = {}
+        for term in sorted({self.current_term, PAST_TERM}):
+            self.terms[term] = corpus.generate_courses(courses_per_term,
+                                                       term=term, seed=seed)
+        self.courses = self.terms[self.current_term]
+        self.fces = corpus.generate_fces(self.terms[PAST_TERM], seed=seed)
+        self.instructors = sorted({instructor.split(',')[0]
+                                   for course in self.courses
+                                   for lecture in course['lectures']
+                                   for instructor in lecture['instructors']})
+        self.rooms = sorted({(time_obj['building'], time_obj['room'])
+                             for course in self.courses
+                             for lecture in course['lectures']
+                             for time_obj in lecture['times']})
+
+    def install(self, latency):
+        es = FakeElasticsearch(latency=latency)
+        for term, courses in self.terms.items():
+            es.index_many(ES_COURSE_INDEX_PREFIX + term, 'course', courses,
+                          id_field='id')
+        es.index_many(ES_FCE_INDEX, 'fce', self.fces)
+        connections.add_connection('default', es)
+        return es
+
+    def courseid(self, rng):
+        return rng.choice(self.courses)['id']
+
+    def instructor(self, rng):
+        return rng.choice(self.instructors)
+
+    def room(self, rng):
+        return rng.choice(self.rooms)
+
+    def datetime(self, rng):
+        day = datetime.date.today() - datetime.timedelta(days=rng.randrange(7))
+        return '{}T{:02d}:{:02d}:00-04:00'.format(
+            day.isoformat(), rng.randint(8, 20), rng.choice([0, 15, 30, 45]))
+
+
+##
+## @brief      The requests made to each endpoint: (name, flask endpoint,
+##             function of a catalog and a random generator giving (method,
+##             path, json body)). Several names may exercise one endpoint,
+##             e.g. its paged and streamed variants.
+##
+SCENARIOS = [
+    ('home', 'homehome', lambda c, r: ('GET', '/', None)),
+    ('course_home', 'courseapihome',
+     lambda c, r: ('GET', '/course/v1/', None)),
+    ('course', 'coursedetail', lambda c, r: (
+        'GET', '/course/v1/course/{}/'.format(c.courseid(r)), None)),
+    ('course_term', 'coursedetailbyterm', lambda c, r: (
+        'GET', '/course/v1/course/{}/term/current/'.format(c.courseid(r)),
+        None)),
+    ('course_fces', 'coursewithfcesbyterm', lambda c, r: (
+        'GET', '/course/v1/course/{}/term/{}/fce/'.format(
+            r.choice(c.fces)['courseid'], PAST_TERM), None)),
+    ('course_fces_cur', 'coursewithfces', lambda c, r: (
+        'GET', '/course/v1/course/{}/fce/?summary'.format(c.courseid(r)),
+        None)),
+    ('courses_batch', 'coursebatch', lambda c, r: (
+        'POST', '/course/v1/courses/',
+        {'courseids': [c.courseid(r) for _ in range(10)],
+         'term': c.current_term})),
+    ('courseid_all_terms', 'coursedetailallterms', lambda c, r: (
+        'GET', '/course/v1/courseid/{}/'.format(c.courseid(r)), None)),
+    ('instructor', 'instructor', lambda c, r: (
+        'GET', '/course/v1/instructor/{}/'.format(c.instructor(r)), None)),
+    ('instructor_term', 'instructorbyterm', lambda c, r: (
+        'GET', '/course/v1/instructor/{}/term/current/'.format(
+            c.instructor(r)), None)),
+    ('instructor_paged', 'instructor', lambda c, r: (
+        'GET', '/course/v1/instructor/{}/?page_size=20'.format(
+            c.instructor(r)), None)),
+    ('instructor_stream', 'instructor', lambda c, r: (
+        'GET', '/course/v1/instructor/{}/?stream'.format(c.instructor(r)),
+        None)),
+    ('building_term', 'buildingbyterm', lambda c, r: (
+        'GET', '/course/v1/building/{}/term/current/'.format(c.room(r)[0]),
+        None)),
+    ('room_term', 'roombyterm', lambda c, r: (
+        'GET', '/course/v1/room/{}/term/current/'.format(c.room(r)[1]),
+        None)),
+    ('building_room', 'buildingroom', lambda c, r: (
+        'GET', '/course/v1/building/{}/room/{}/'.format(*c.room(r)), None)),
+    ('building_room_term', 'buildingroombyterm', lambda c, r: (
+        'GET', '/course/v1/building/{}/room/{}/term/current/'.format(
+            *c.room(r)), None)),
+    ('datetime', 'datetime', lambda c, r: (
+        'GET', '/course/v1/datetime/{}/'.format(c.datetime(r)), None)),
+    ('datetime_span', 'datetimespan', lambda c, r: (
+        'GET', '/course/v1/datetime/{}/timespan/60/'.format(c.datetime(r)),
+        None)),
+    ('search', 'search', lambda c, r: (
+        'GET', '/course/v1/search/?text={}'.format(r.choice(corpus.WORDS)),
+        None)),
+    ('list_all_courses', 'listallcoursesbyterm', lambda c, r: (
+        'GET', '/course/v1/list-all-courses/term/current/', None)),
+    ('fce_courseid', 'fcebyid', lambda c, r: (
+        'GET', '/fce/v1/courseid/{}/'.format(
+            r.choice(c.fces)['courseid']), None)),
+    ('fce_instructor', 'fcebyinstructor', lambda c, r: (
+        'GET', '/fce/v1/instructor/{}/'.format(c.instructor(r)), None)),
+    ('fce_sum_courseid', 'fcesummarybyid', lambda c, r: (
+        'GET', '/fce/v1/courseid/{}/summary/'.format(
+            r.choice(c.fces)['courseid']), None)),
+    ('fce_sum_instructor', 'fcesummarybyinstructor', lambda c, r: (
+        'GET', '/fce/v1/instructor/{}/summary/'.format(c.instructor(r)),
+        None)),
+    ('fce_sum_department', 'fcesummarybydepartment', lambda c, r: (
+        'GET', '/fce/v1/department/{}/summary/'.format(
+            r.choice(c.fces)['department']), None)),
+    ('metrics', 'get_metrics', lambda c, r: ('GET', '/metrics', None)),
+    ('health', 'get_health', lambda c, r: ('GET', '/health', None)),
+]
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+
+# @brief  The resident set size of the process in MB
+def rss_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * resource.getpagesize() / 2 ** 20
+    except (IOError, OSError):
+        # Not Linux, the peak is the best there is
+        return peak_rss_mb()
+
+
+def peak_rss_mb():
+    # In kB on Linux, in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+##
+## @brief      Makes n requests of a scenario from concurrency threads, each
+##             with its own test client, after a round of warm-up requests.
+##
+def run_scenario(app, es, catalog, make_request, n, concurrency, seed):
+    local = threading.local()
+
+    def request(i):
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = app.test_client()
+        method, path, body = make_request(catalog, random.Random(seed + i))
+        start = time.perf_counter()
+        response = client.open(path, method=method, json=body)
+        # Reads streamed bodies to the end
+        response.get_data()
+        return time.perf_counter() - start, response.status_code
+
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(request, range(-concurrency, 0)))
+        es_before = es.stats()
+        start = time.perf_counter()
+        results = list(pool.map(request, range(n)))
+        elapsed = time.perf_counter() - start
+    es_after = es.stats()
+
+    latencies = [latency * 1000 for latency, _ in results]
+    return {
+        'requests': n,
+        'errors': sum(1 for _, status in results if status >= 400),
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+        'mean_ms': sum(latencies) / n,
+        'throughput_rps': n / elapsed,
+        # Time spent in the ES stand-in, latency included
+        'es_ms': (es_after['seconds'] - es_before['seconds']) * 1000 / n,
+        'rss_mb': rss_mb(),
+    }
+
+
+def report(name, result):
+    print("{:<20} p50 {:8.2f}  p95 {:8.2f}  p99 {:8.2f}  es {:7.2f} ms  "
+          "{:8.1f} req/s  rss {:6.1f} MB{}".format(
+              name, result['p50_ms'], result['p95_ms'], result['p99_ms'],
+              result['es_ms'], result['throughput_rps'], result['rss_mb'],
+              '  {} errors'.format(result['errors'])
+              if result['errors'] else ''))
+
+
+##
+## @brief      Compares the results with the ones of a baseline run.
+##
+## @return     A list of messages, one per regression.
+##
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+            regressions.append("{}: p95 {:.2f} ms, was {:.2f} ms".format(
+                name, result['p95_ms'], base['p95_ms']))
+        if result['throughput_rps'] < base['throughput_rps'] * (1 - tolerance):
+            regressions.append("{}: {:.1f} req/s, was {:.1f} req/s".format(
+                name, result['throughput_rps'], base['throughput_rps']))
+        if result['errors'] > base['errors']:
+            regressions.append("{}: {} errors, was {}".format(
+                name, result['errors'], base['errors']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the endpoints against a synthetic catalog')
+    parser.add_argument('--courses', type=int, default=2000,
+                        help='courses per term')
+    parser.add_argument('-n', type=int, default=100,
+                        help='requests per endpoint')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--es-latency', type=float, default=0.0,
+                        help='milliseconds added to each ES request')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='disable the result cache')
+    parser.add_argument('--local-index', action='store_true',
+                        help='serve the current term from memory')
+    parser.add_argument('--fce-rollup', action='store_true',
+                        help='serve the FCE summaries from the rollup')
+    parser.add_argument('--only', help='comma separated scenarios to run')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='file to write the results to')
+    parser.add_argument('--baseline', help='results of a previous run')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed slowdown against the baseline')
+    args = parser.parse_args()
+
+    if args.no_cache:
+        config.cache.CACHE_ENABLED = False
+    if args.local_index:
+        config.course.LOCAL_INDEX_TERMS = ['current']
+    if args.fce_rollup:
+        config.fce.FCE_ROLLUP = True
+
+    start = time.perf_counter()
+    catalog = Catalog(args.courses, args.seed)
+    es = catalog.install(args.es_latency / 1000)
+    print("{} courses in {} terms, {} FCEs, generated in {:.1f} s".format(
+        sum(len(courses) for courses in catalog.terms.values()),
+        len(catalog.terms), len(catalog.fces), time.perf_counter() - start))
+
+    import api
+    from common import search
+    # The stand-in is already the default connection
+    search.init_es_connection = lambda: None
+    app = api.app
+
+    scenarios = SCENARIOS
+    if args.only:
+        names = args.only.split(',')
+        scenarios = [scenario for scenario in SCENARIOS
+                     if scenario[0] in names]
+    covered = {endpoint for _, endpoint, _ in SCENARIOS}
+    for rule in app.url_map.iter_rules():
+        if rule.endpoint not in covered and rule.endpoint != 'static':
+            print("No scenario for {} ({})".format(rule.endpoint, rule.rule))
+
+    print("{} requests per endpoint, concurrency {}, rss {:.1f} MB".format(
+        args.n, args.concurrency, rss_mb()))
+    results = {}
+    for name, _, make_request in scenarios:
+        results[name] = run_scenario(app, es, catalog, make_request, args.n,
+                                     args.concurrency, args.seed)
+        report(name, results[name])
+    print("peak rss {:.1f} MB".format(peak_rss_mb()))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f, indent=2,
+                      sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,12 @@
 import config.course
+import config.settings
 
 HOME_MESSAGE = 'Hoooray! You are connected.'
 API_ROOT_MESSAGE = 'Course API by ScottyLabs!'
 DATETIME_PARSE_FAIL = 'Failed to parse datetime. Please check format agrees with ISO-8601.'
 SPAN_PARSE_FAIL = 'Failed to parse span. Span should be an integer between {} and {}.'.format(config.course.SPAN_LOWER_LIMIT, config.course.SPAN_UPPER_LIMIT)
-EMPTY_SEARCH = 'At least provide one query parameter to search.'
\ No newline at end of file
+EMPTY_SEARCH = 'At least provide one query parameter to search.'
+BATCH_PARSE_FAIL = 'Failed to parse the request. Expected a JSON object with a non-empty list of courseids, e.g. {"courseids": ["15-112"], "term": "f17"}.'
+BATCH_SIZE_FAIL = 'At most {} courses can be requested at once.'.format(config.course.BATCH_SIZE_LIMIT)
+PAGE_PARSE_FAIL = 'Failed to parse the page. page_size should be an integer between 1 and {}, and cursor the next_cursor of the previous page.'.format(config.settings.PAGE_SIZE_LIMIT)
+OCCUPANCY_BIN_PARSE_FAIL = 'Failed to parse bin. bin should be a number of minutes between {} and {} dividing a day.'.format(config.course.OCCUPANCY_BIN_LOWER_LIMIT, config.course.OCCUPANCY_BIN_UPPER_LIMIT)
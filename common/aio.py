@@ -0,0 +1,268 @@
+# @file aio.py
+# @brief The async ES client of the asyncio serving mode (asgi.py): the
+#        client of elasticsearch-py over an aiohttp connection, so that its
+#        requests are awaited on the event loop of the worker.
+#
+#        elasticsearch-async, the async client of ES 5, is no longer
+#        maintained and does not run on current aiohttp. Like it, the
+#        methods of elasticsearch.Elasticsearch (search, get, mget, msearch)
+#        are kept and return a coroutine: AsyncTransport is the Transport of
+#        elasticsearch-py, with its pool of hosts, retries and errors, whose
+#        requests are sent by AIOHttpConnection.
+# @author Justin Chu (justinchuby@cmu.edu)
+
+import asyncio
+import base64
+import ssl
+import time
+from urllib.parse import urlencode
+
+import certifi
+import elasticsearch
+from elasticsearch import Connection, Transport
+from elasticsearch.exceptions import ConnectionError, ConnectionTimeout,\
+                                     SSLError, TransportError
+from elasticsearch_dsl.connections import connections
+
+import config.es_config
+
+# The alias of the async client in elasticsearch_dsl.connections
+ALIAS = 'async'
+
+
+##
+## @brief      A connection to one ES host sending its requests with aiohttp.
+##             The session, and its pool of maxsize connections, is opened by
+##             the first request, on the event loop it is made from.
+##
+class AIOHttpConnection(Connection):
+    def __init__(self, host='localhost', port=9200, http_auth=None,
+                 use_ssl=False, verify_certs=True, ca_certs=None, maxsize=10,
+                 headers=None, **kwargs):
+        super(AIOHttpConnection, self).__init__(host=host, port=port,
+                                                use_ssl=use_ssl, **kwargs)
+        self.headers = {'content-type': 'application/json'}
+        self.http_auth = None
+        if isinstance(http_auth, (tuple, list)):
+            http_auth = ':'.join(http_auth)
+        if isinstance(http_auth, str):
+            if http_auth:
+                self.headers['authorization'] = 'Basic ' + base64.b64encode(
+                    http_auth.encode('utf-8')).decode('ascii')
+        elif http_auth is not None:
+            # Signs each request, e.g. AWS4Auth
+            self.http_auth = http_auth
+        self.headers.update((k.lower(), v) for k, v in (headers or {}).items())
+        self.ssl = None
+        if use_ssl:
+            if verify_certs:
+                self.ssl = ssl.create_default_context(
+                    cafile=ca_certs or certifi.where())
+            else:
+                self.ssl = False
+        self.maxsize = maxsize
+        self._session = None
+
+    def _get_session(self):
+        import aiohttp
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.maxsize,
+                                               ssl=self.ssl))
+        return self._session
+
+    ##
+    ## @brief      Signs a request with http_auth, which signs the requests
+    ##             of the requests library.
+    ##
+    ## @return     (url, headers) to send the request with, the URL exactly
+    ##             as it was signed.
+    ##
+    def _sign(self, method, url, body, headers):
+        import requests
+        import yarl
+        prepared = requests.Request(method, url, data=body,
+                                    headers=headers).prepare()
+        prepared = self.http_auth(prepared)
+        return yarl.URL(prepared.url, encoded=True), dict(prepared.headers)
+
+    async def perform_request(self, method, url, params=None, body=None,
+                              timeout=None, ignore=()):
+        import aiohttp
+        url = self.url_prefix + url
+        if params:
+            url = '%s?%s' % (url, urlencode(params))
+        full_url = self.host + url
+        request_url, headers = full_url, self.headers
+        if self.http_auth is not None:
+            request_url, headers = self._sign(method, full_url, body, headers)
+
+        start = time.time()
+        try:
+            async with self._get_session().request(
+                    method, request_url, data=body, headers=headers,
+                    timeout=aiohttp.ClientTimeout(
+                        total=timeout or self.timeout)) as response:
+                raw_data = await response.text()
+            duration = time.time() - start
+        except Exception as e:
+            self.log_request_fail(method, full_url, url, body,
+                                  time.time() - start, exception=e)
+            if isinstance(e, aiohttp.ClientSSLError):
+                raise SSLError('N/A', str(e), e)
+            if isinstance(e, asyncio.TimeoutError):
+                raise ConnectionTimeout('TIMEOUT', str(e), e)
+            raise ConnectionError('N/A', str(e), e)
+
+        if not (200 <= response.status < 300) and \
+                response.status not in ignore:
+            self.log_request_fail(method, full_url, url, body, duration,
+                                  response.status, raw_data)
+            self._raise_error(response.status, raw_data)
+
+        self.log_request_success(method, full_url, url, body,
+                                 response.status, raw_data, duration)
+        return response.status, response.headers, raw_data
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+##
+## @brief      The Transport of elasticsearch-py, its perform_request()
+##             awaited. Sniffing, which is made with blocking requests, is
+##             not supported.
+##
+class AsyncTransport(Transport):
+    def __init__(self, hosts, **kwargs):
+        for option in ('sniff_on_start', 'sniff_on_connection_fail',
+                       'sniffer_timeout'):
+            kwargs.pop(option, None)
+        super(AsyncTransport, self).__init__(hosts, **kwargs)
+
+    # @brief  Same as Transport.perform_request
+    async def perform_request(self, method, url, params=None, body=None):
+        if body is not None:
+            body = self.serializer.dumps(body)
+            # some clients or environments don't support sending GET with
+            # body
+            if method in ('HEAD', 'GET') and self.send_get_body_as != 'GET':
+                if self.send_get_body_as == 'POST':
+                    method = 'POST'
+                elif self.send_get_body_as == 'source':
+                    if params is None:
+                        params = {}
+                    params['source'] = body
+                    body = None
+        if body is not None:
+            try:
+                body = body.encode('utf-8', 'surrogatepass')
+            except (UnicodeDecodeError, AttributeError):
+                # bytes/str - no need to re-encode
+                pass
+
+        ignore = ()
+        timeout = None
+        if params:
+            timeout = params.pop('request_timeout', None)
+            ignore = params.pop('ignore', ())
+            if isinstance(ignore, int):
+                ignore = (ignore, )
+
+        for attempt in range(self.max_retries + 1):
+            connection = self.get_connection()
+            try:
+                status, headers, data = await connection.perform_request(
+                    method, url, params, body, ignore=ignore, timeout=timeout)
+            except TransportError as e:
+                if method == 'HEAD' and e.status_code == 404:
+                    return False
+
+                retry = False
+                if isinstance(e, ConnectionTimeout):
+                    retry = self.retry_on_timeout
+                elif isinstance(e, ConnectionError):
+                    retry = True
+                elif e.status_code in self.retry_on_status:
+                    retry = True
+
+                if retry:
+                    # only mark as dead if we are retrying
+                    self.mark_dead(connection)
+                    # raise exception on last retry
+                    if attempt == self.max_retries:
+                        raise
+                else:
+                    raise
+            else:
+                if method == 'HEAD':
+                    return 200 <= status < 300
+                # connection didn't fail, confirm it's live status
+                self.connection_pool.mark_live(connection)
+                if data:
+                    data = self.deserializer.loads(
+                        data, headers.get('content-type'))
+                return data
+
+    async def close(self):
+        for connection in self.connection_pool.connections:
+            await connection.close()
+
+
+##
+## @brief      Creates the async client, with the hosts, pool and retry
+##             policy of search.init_es_connection(), as the ALIAS connection.
+##
+def init_es_async_connection():
+    from config.es_config import ES_MAXSIZE, ES_MAX_RETRIES,\
+                                 ES_RETRY_ON_TIMEOUT, ES_TIMEOUT
+    transport_settings = {
+        'transport_class': AsyncTransport,
+        'connection_class': AIOHttpConnection,
+        'maxsize': ES_MAXSIZE,
+        'timeout': ES_TIMEOUT,
+        'max_retries': ES_MAX_RETRIES,
+        'retry_on_timeout': ES_RETRY_ON_TIMEOUT,
+    }
+    if config.es_config.SERVICE == 'AWS':
+        from requests_aws4auth import AWS4Auth
+        from config.es_config import AWS_ES_HOSTS, AWS_ACCESS_KEY,\
+                                     AWS_SECRET_KEY, AWS_REGION
+        awsauth = AWS4Auth(AWS_ACCESS_KEY, AWS_SECRET_KEY, AWS_REGION, 'es')
+        client = elasticsearch.Elasticsearch(
+            AWS_ES_HOSTS, http_auth=awsauth, use_ssl=True,
+            verify_certs=True, **transport_settings)
+    else:
+        from config.es_config import ES_HOSTS, ES_HTTP_AUTH
+        client = elasticsearch.Elasticsearch(
+            ES_HOSTS, http_auth=ES_HTTP_AUTH, use_ssl=True,
+            verify_certs=True, **transport_settings)
+    connections.add_connection(ALIAS, client)
+    return client
+
+
+##
+## @brief      Closes the connections of the async client, if it exists.
+##
+async def close_es_async_connection():
+    try:
+        client = connections.get_connection(ALIAS)
+    except KeyError:
+        return
+    connections.remove_connection(ALIAS)
+    if isinstance(client.transport, AsyncTransport):
+        await client.transport.close()
+
+
+def get_client():
+    return connections.get_connection(ALIAS)
+
+
+def has_client():
+    try:
+        connections.get_connection(ALIAS)
+    except KeyError:
+        return False
+    return True
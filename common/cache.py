@@ -0,0 +1,290 @@
+# @file cache.py
+# @brief In-process LRU cache with per-endpoint TTLs for search results.
+# @author Justin Chu (justinchuby@cmu.edu)
+
+import fnmatch
+import functools
+import inspect
+import threading
+import time
+from collections import OrderedDict
+
+from common import shared_cache
+from common.utils import copy_json
+import config.cache
+
+
+##
+## @brief      A bounded mapping with LRU eviction and per-entry expiration.
+##             Every entry is tagged with the ES index it was read from so
+##             that it can be dropped when the index is rebuilt.
+##
+class TTLCache(object):
+    def __init__(self, max_size):
+        self.max_size = max_size
+        # key -> (expires_at, index, value), least recently used first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # endpoint -> {'hits': int, 'misses': int}
+        self.endpoint_stats = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _count(self, endpoint, field):
+        stats = self.endpoint_stats.setdefault(endpoint,
+                                               {'hits': 0, 'misses': 0})
+        stats[field] += 1
+
+    #
+    # @brief      Looks up a key.
+    #
+    # @return     (bool, object) Whether the key was found and its value.
+    #
+    def get(self, key, endpoint=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= time.monotonic():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                self._count(endpoint, 'misses')
+                return False, None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            self._count(endpoint, 'hits')
+            return True, entry[2]
+
+    def set(self, key, value, ttl, index=None):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, index, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    #
+    # @brief      Drops the entries read from an index.
+    #
+    # @param      index  (str) The ES index, e.g. course-f17. Entries read from
+    #                    a wildcard index such as course-* are dropped as well.
+    #                    Everything is dropped if index is None.
+    #
+    # @return     (int) The number of entries dropped.
+    #
+    def invalidate(self, index=None):
+        with self._lock:
+            if index is None:
+                count = len(self._entries)
+                self._entries.clear()
+                return count
+            stale = [key for key, entry in self._entries.items()
+                     if entry[1] is not None and
+                     (fnmatch.fnmatchcase(index, entry[1]) or
+                      fnmatch.fnmatchcase(entry[1], index))]
+            for key in stale:
+                del self._entries[key]
+            return len(stale)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'endpoints': {endpoint: dict(stats) for endpoint, stats
+                              in self.endpoint_stats.items()},
+            }
+
+
+_cache = TTLCache(config.cache.CACHE_MAX_SIZE)
+
+
+##
+## @brief      Turns the arguments of a call into a hashable key.
+##
+def _freeze(obj):
+    if isinstance(obj, dict):
+        return tuple(sorted((key, _freeze(value))
+                            for key, value in obj.items()))
+    if isinstance(obj, (list, tuple)):
+        return tuple(_freeze(value) for value in obj)
+    if isinstance(obj, set):
+        return tuple(sorted(_freeze(value) for value in obj))
+    return obj
+
+
+def _is_cacheable(output):
+    response = output.get('response')
+    return isinstance(response, dict) and response.get('status') is None
+
+
+##
+## @brief      Caches the output of a search function.
+##
+##             The key is the normalized (function, arguments, index) tuple,
+##             where the index is resolved to the actual ES index so that the
+##             same term spelled differently (e.g. current and f17) shares
+##             an entry. Error responses and calls with stream=True are
+##             never cached.
+##
+##             When a shared cache is configured (REDIS_URL), outputs missing
+##             from the cache of this worker are looked up there before
+##             calling the function, and stored there afterwards.
+##
+##             Its cache_async() decorates an async version of the function,
+##             served by asgi.py, cached in the same entries.
+##
+## @param      endpoint  (str) The endpoint name, used to look up the TTL in
+##                       config/cache.py and to group the hit/miss counters.
+## @param      index     (function) Maps the bound arguments of the call to
+##                       the ES index it reads from.
+## @param      index_arg (str) The name of the argument holding the term or
+##                       index. It is replaced by the resolved index in the key.
+##
+def cached(endpoint, index, index_arg=None):
+    def decorator(f):
+        signature = inspect.signature(f)
+
+        def bind(args, kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            return bound.arguments
+
+        def make_key(args, kwargs):
+            arguments = bind(args, kwargs)
+            es_index = index(arguments)
+            key_args = {name: value for name, value in arguments.items()
+                        if name != index_arg}
+            return (f.__name__, es_index, _freeze(key_args)), es_index
+
+        def is_enabled():
+            return (config.cache.CACHE_ENABLED and
+                    config.cache.CACHE_TTL.get(endpoint, 0) > 0)
+
+        def lookup(args, kwargs, wait):
+            if not is_enabled():
+                return False, None
+            key, es_index = make_key(args, kwargs)
+            found, value = _cache.get(key, endpoint)
+            if found:
+                return True, copy_json(value)
+            shared = shared_cache.get()
+            if shared is None:
+                return False, None
+            found, value, ttl = shared.get(key, es_index, wait)
+            if found and ttl > 0:
+                # Deserialized for this call, the cached copy is not shared.
+                # Kept until the soft expiry of the shared entry, stale ones
+                # are not kept at all.
+                _cache.set(key, copy_json(value),
+                           min(ttl, config.cache.CACHE_TTL[endpoint]),
+                           es_index)
+            return found, value
+
+        # @brief  Looks up the output of a call without making it.
+        #         Returns (found, output). A miss in the shared cache must be
+        #         followed by set_cached() or release_cached(), which
+        #         release its lock.
+        def get_cached(*args, **kwargs):
+            return lookup(args, kwargs, True)
+
+        # @brief  Same as get_cached(), without waiting for an output being
+        #         computed by another worker. Used by the batches, which
+        #         fetch their misses together anyway.
+        def get_cached_nowait(*args, **kwargs):
+            return lookup(args, kwargs, False)
+
+        # @brief  Releases the lock taken by a miss of get_cached() when the
+        #         call failed.
+        def release_cached(*args, **kwargs):
+            if not is_enabled():
+                return
+            shared = shared_cache.get()
+            if shared is not None:
+                shared.release(make_key(args, kwargs)[0])
+
+        # @brief  Stores the output of a call made somewhere else, e.g. in
+        #         a batch.
+        def set_cached(output, *args, **kwargs):
+            if not is_enabled():
+                return
+            key, es_index = make_key(args, kwargs)
+            shared = shared_cache.get()
+            if not _is_cacheable(output):
+                if shared is not None:
+                    shared.release(key)
+                return
+            ttl = config.cache.CACHE_TTL[endpoint]
+            _cache.set(key, copy_json(output), ttl, es_index)
+            if shared is not None:
+                shared.set(key, output, ttl, es_index)
+
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if not is_enabled() or bind(args, kwargs).get('stream'):
+                # Streamed outputs hold a generator, which is consumed once
+                return f(*args, **kwargs)
+            found, output = get_cached(*args, **kwargs)
+            if found:
+                return output
+            try:
+                output = f(*args, **kwargs)
+            except BaseException:
+                release_cached(*args, **kwargs)
+                raise
+            set_cached(output, *args, **kwargs)
+            return output
+
+        # @brief  Caches an async version of the function, taking the same
+        #         arguments, in the same entries. The shared cache is not
+        #         waited for, which would block the event loop.
+        def cache_async(f_async):
+            @functools.wraps(f_async)
+            async def async_wrapper(*args, **kwargs):
+                if not is_enabled() or bind(args, kwargs).get('stream'):
+                    return await f_async(*args, **kwargs)
+                found, output = get_cached_nowait(*args, **kwargs)
+                if found:
+                    return output
+                try:
+                    output = await f_async(*args, **kwargs)
+                except BaseException:
+                    release_cached(*args, **kwargs)
+                    raise
+                set_cached(output, *args, **kwargs)
+                return output
+            return async_wrapper
+
+        wrapper.get_cached = get_cached
+        wrapper.get_cached_nowait = get_cached_nowait
+        wrapper.set_cached = set_cached
+        wrapper.release_cached = release_cached
+        wrapper.cache_async = cache_async
+        return wrapper
+    return decorator
+
+
+def invalidate(index=None):
+    shared = shared_cache.get()
+    if shared is not None:
+        shared.invalidate(index)
+    return _cache.invalidate(index)
+
+
+def clear():
+    return invalidate(None)
+
+
+def stats():
+    stats = _cache.stats()
+    shared = shared_cache.get()
+    if shared is not None:
+        stats['shared'] = shared.stats()
+    return stats
@@ -1,57 +1,94 @@
 # @file cmu_course.py
 # @brief The module for Course and Meeting object.
+#
+#        The objects are read-only views of a scottylabs course dict: they
+#        hold references to its values rather than copies, so reading a
+#        whole term costs no more than walking the dicts once. Times are
+#        kept as minutes since midnight and days as a bitmask.
 # @author Justin Chu (justinchuby@cmu.edu)
 
+import datetime
 
-import copy
-from common.utils import *
+from common import utils
 
 
-class Course(object):
+##
+## @brief      Base of the read-only objects. Attributes are set once by
+##             __init__ with _set.
+##
+class _ReadOnly(object):
+    __slots__ = ()
+
+    _set = object.__setattr__
+
+    def __setattr__(self, key, value):
+        raise AttributeError("{} is read-only".format(type(self).__name__))
+
+    def __delattr__(self, key):
+        raise AttributeError("{} is read-only".format(type(self).__name__))
+
+    def __repr__(self):
+        return "</{}- {} />".format(
+            type(self).__name__,
+            {key: getattr(self, key) for key in self._REPR})
+
+    ##
+    ## @brief      Gets an attribute, or None if there is no such attribute.
+    ##             The value is not copied.
+    ##
+    def get(self, key):
+        return getattr(self, key, None)
+
+
+class Course(_ReadOnly):
     _PROPS = ["name", "department", "units", "desc",
               "prereqs", "prereqs_obj", "coreqs", "coreqs_obj",
-              "lectures", "sections", "courseid", "rundate", "semester"]
+              "rundate", "semester"]
+    __slots__ = _PROPS + ["courseid", "lectures", "sections", "instructors",
+                          "_scotty_dict"]
+    _REPR = ["courseid", "name", "semester", "lectures", "sections"]
 
     def __init__(self, scotty_dict):
-        self.scottyDict = copy.deepcopy(scotty_dict)
         for key in self._PROPS:
-            self.__dict__[key] = self.scottyDict.get(key)
-        self.courseid = scotty_dict["id"]
-        self.lectures = [Meeting(self, meeting) for meeting in self.scottyDict["lectures"]]
-        self.sections = [Meeting(self, meeting) for meeting in self.scottyDict["sections"]]
-        # Using a list for self.instructors to keep the order
-        self.instructors = []
+            self._set(key, scotty_dict.get(key))
+        self._set('_scotty_dict', scotty_dict)
+        self._set('courseid', scotty_dict["id"])
+        self._set('lectures', tuple(Meeting(self, meeting)
+                                    for meeting in scotty_dict["lectures"]))
+        self._set('sections', tuple(Meeting(self, meeting)
+                                    for meeting in scotty_dict["sections"]))
+        # Keeps the order of the lectures
+        instructors = []
         for lec in self.lectures:
             for instructor in lec.instructors:
-                if instructor not in self.instructors:
-                    self.instructors.append(instructor)
-
-    def __repr__(self):
-        s = "</Course- {} />".format(self.__dict__)
-        return s
-
-    def get(self, key):
-        return copy.deepcopy(self.__dict__.get(key))
-
+                if instructor not in instructors:
+                    instructors.append(instructor)
+        self._set('instructors', tuple(instructors))
+
+    ##
+    ## @brief      The scottylabs dict the course was read from. It is not a
+    ##             copy: copy it before modifying it.
+    ##
     def dict(self):
-        # TODO: export dict from data in the object
-        return copy.deepcopy(self.scottyDict)
+        return self._scotty_dict
 
+    # @brief  Same as dict(), kept for the callers of the former attribute
+    @property
+    def scottyDict(self):
+        return self._scotty_dict
 
-class Meeting(object):
-    # _PROPS = ["name", "instructors", "times"]
-    def __init__(self, course, meeting_dict):
-        self.course = course
-        self.name = meeting_dict["name"]
-        self.instructors = meeting_dict["instructors"]
-        self.times = [TimeObj(time) for time in meeting_dict["times"]]
 
-    def __repr__(self):
-        s = "</Meeting- {} />".format(self.__dict__)
-        return s
+class Meeting(_ReadOnly):
+    __slots__ = ["course", "name", "instructors", "times"]
+    _REPR = ["name", "instructors", "times"]
 
-    def get(self, key):
-        return copy.deepcopy(self.__dict__.get(key))
+    def __init__(self, course, meeting_dict):
+        self._set('course', course)
+        self._set('name', meeting_dict["name"])
+        # The list of the scottylabs dict
+        self._set('instructors', meeting_dict["instructors"])
+        self._set('times', tuple(TimeObj(time)
+                                 for time in meeting_dict["times"]))
 
     def isHappeningAt(self, date_time):
         for timeObj in self.times:
@@ -66,28 +103,51 @@ class Meeting(object):
         return False
 
 
-class TimeObj(object):
-    _PROPS = ["begin", "end", "days", "location", "building", "room"]
+class TimeObj(_ReadOnly):
+    __slots__ = ["begin_minutes", "end_minutes", "day_mask", "location",
+                 "building", "room"]
+    _REPR = ["begin", "end", "days", "location", "building", "room"]
 
     def __init__(self, time_dict):
-        for key in self._PROPS:
-            self.__dict__[key] = time_dict[key]
-        self.begin = parse_time(self.begin)
-        self.end = parse_time(self.end)
-
-    def __repr__(self):
-        s = "</TimeObj- {} />".format(self.__dict__)
-        return s
-
-    def get(self, key):
-        return copy.deepcopy(self.__dict__.get(key))
+        self._set('begin_minutes', utils.parse_minutes(time_dict["begin"]))
+        self._set('end_minutes', utils.parse_minutes(time_dict["end"]))
+        day_mask = 0
+        for day in time_dict["days"] or ():
+            day_mask |= 1 << day
+        self._set('day_mask', day_mask)
+        self._set('location', time_dict["location"])
+        self._set('building', time_dict["building"])
+        self._set('room', time_dict["room"])
+
+    @staticmethod
+    def _time(minutes):
+        if minutes is None:
+            return None
+        return datetime.time(minutes // 60, minutes % 60)
+
+    # @brief  The beginning as a datetime.time, None if unknown (TBA)
+    @property
+    def begin(self):
+        return self._time(self.begin_minutes)
+
+    # @brief  The end as a datetime.time, None if unknown (TBA)
+    @property
+    def end(self):
+        return self._time(self.end_minutes)
+
+    # @brief  The days of the week, 0 for Sunday, in order
+    @property
+    def days(self):
+        return tuple(day for day in range(7) if self.day_mask >> day & 1)
 
     def isHappeningAt(self, date_time):
-        time = date_time.time()
         day = date_time.isoweekday() % 7  # integer
-        if self.isHappeningOn(day) and (self.begin <= time < self.end):
-            return True
-        return False
+        if not self.isHappeningOn(day) or self.begin_minutes is None or \
+                self.end_minutes is None:
+            return False
+        # Comparing whole minutes is exact since the bounds are whole minutes
+        minutes = date_time.hour * 60 + date_time.minute
+        return self.begin_minutes <= minutes < self.end_minutes
 
     def isHappeningOn(self, day):
-        return (day in self.days)
+        return bool(self.day_mask >> day & 1)
@@ -0,0 +1,66 @@
+# @file connection.py
+# @brief Pooled ES transport connections and their utilization statistics.
+# @author Justin Chu (justinchuby@cmu.edu)
+
+from elasticsearch import RequestsHttpConnection, Urllib3HttpConnection
+from elasticsearch_dsl.connections import connections
+from requests.adapters import HTTPAdapter
+
+
+##
+## @brief      A RequestsHttpConnection keeping up to maxsize persistent
+##             connections alive, like Urllib3HttpConnection does.
+##             requests only keeps 10 connections per host by default, so
+##             concurrent requests beyond that would open and close new
+##             connections (and TLS sessions) on the hot path.
+##
+class PooledRequestsHttpConnection(RequestsHttpConnection):
+    def __init__(self, maxsize=10, **kwargs):
+        super(PooledRequestsHttpConnection, self).__init__(**kwargs)
+        self.maxsize = maxsize
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=maxsize)
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+
+    def pools(self):
+        container = self.adapter.poolmanager.pools
+        return [container[key] for key in container.keys()]
+
+
+def _pool_stats(host, pool):
+    # The queue of a urllib3 pool holds the idle connections and one None
+    # for each connection that can still be opened.
+    maxsize, queue = 0, []
+    if pool.pool is not None:
+        maxsize, queue = pool.pool.maxsize, list(pool.pool.queue)
+    return {
+        'host': host,
+        'maxsize': maxsize,
+        'in_use': maxsize - len(queue),
+        'idle': sum(1 for conn in queue if conn is not None),
+        'created': pool.num_connections,
+        'requests': pool.num_requests,
+    }
+
+
+##
+## @brief      Gets the utilization of the connection pools of the default
+##             ES connection of this worker.
+##
+## @return     A list of dictionaries, one per host: the pool size, the
+##             connections in use and idle, the number of connections created
+##             so far (a growing number means churn) and of requests sent.
+##
+def get_pool_stats(alias='default'):
+    try:
+        es = connections.get_connection(alias)
+    except KeyError:
+        return []
+    stats = []
+    for conn in es.transport.connection_pool.connections:
+        if isinstance(conn, PooledRequestsHttpConnection):
+            for pool in conn.pools():
+                stats.append(_pool_stats(conn.host, pool))
+        elif isinstance(conn, Urllib3HttpConnection):
+            stats.append(_pool_stats(conn.host, conn.pool))
+    return stats
@@ -0,0 +1,543 @@
+# @file fce_rollup.py
+# @brief Materialized rollups of the FCEs: the mean and percentiles of the
+#        summarized fields of each course, instructor and department, overall,
+#        per year and per subgroup (the instructors of a course, the courses
+#        of an instructor or a department), so that the summary endpoints are
+#        answered with a lookup instead of aggregations over the fce index.
+#
+#        The rows of the index are held as NumPy columns (the year, the codes
+#        of the course, instructor and department, and the summarized fields)
+#        from which the rollup tables are computed with vectorized sorts.
+#        FCEs are loaded a year at a time, so a refresh only fetches the rows
+#        of the latest year held and the years after it, replacing those it
+#        had; the whole index is read again if it was rebuilt or if the
+#        number of rows does not add up. The rows of an unknown year count in
+#        the totals only, and are kept as they are by a refresh.
+#
+#        A refresh is started whenever the version of the fce index changes
+#        (index_version), and the rollup in use is swapped once the new one
+#        is computed. With FCE_ROLLUP_FILE set, the columns are saved after
+#        each refresh and loaded at startup, so a worker only fetches what
+#        changed since.
+# @author Justin Chu (justinchuby@cmu.edu)
+
+import json
+import logging
+import os
+import threading
+
+try:
+    import numpy as np
+except ImportError:  # Only needed by the rollups
+    np = None
+
+from elasticsearch_dsl import Search
+from elasticsearch_dsl.connections import connections
+
+from common import index_version
+from common.local_index import tokenize
+import config.fce
+from config.fce import ES_FCE_INDEX
+
+logger = logging.getLogger(__name__)
+
+# Version of the file format, checked when loading
+FORMAT_VERSION = 1
+
+GROUPS = ('courseid', 'instructor', 'department')
+# group -> (name of its subgroups in a summary, their grouping)
+SUBGROUPS = {
+    'courseid': ('instructors', 'instructor'),
+    'instructor': ('courses', 'courseid'),
+    'department': ('courses', 'courseid'),
+}
+# The groups matched by their words, like the match queries of FCESearcher.
+# A course is matched by its exact courseid.
+_TEXT_GROUPS = ('instructor', 'department')
+# Keys of the rows of a group per year: code * _YEAR_SPAN + year
+_YEAR_SPAN = 10000
+
+
+def _require_numpy():
+    if np is None:
+        raise ImportError("numpy is required by the FCE rollups")
+
+
+def _value(source, path):
+    for part in path.split('.'):
+        if not isinstance(source, dict):
+            return None
+        source = source.get(part)
+    return source
+
+
+def _number(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return np.nan
+    return value
+
+
+##
+## @brief      The rollup of the rows of the keys of one grouping: the number
+##             of rows of each key, and the mean and percentiles of each
+##             field over its rows having a value.
+##
+class _Table(object):
+    ##
+    ## @param      keys      (int64 array) The key of each row, negative for
+    ##                       the rows left out
+    ## @param      values    (float array) rows x fields
+    ## @param      percents  (list) The percentiles computed
+    ##
+    def __init__(self, keys, values, percents):
+        included = keys >= 0
+        keys, values = keys[included], values[included]
+        self.keys, inverse, self.rows = np.unique(
+            keys, return_inverse=True, return_counts=True)
+        # keys x fields x (mean, percentiles...)
+        self.stats = np.full((len(self.keys), values.shape[1],
+                              1 + len(percents)), np.nan)
+        for field in range(values.shape[1]):
+            column = values[:, field]
+            valid = ~np.isnan(column)
+            groups, column = inverse[valid], column[valid]
+            if not len(column):
+                continue
+            order = np.lexsort((column, groups))
+            groups, column = groups[order], column[order]
+            present, starts, counts = np.unique(
+                groups, return_index=True, return_counts=True)
+            self.stats[present, field, 0] = \
+                np.add.reduceat(column, starts) / counts
+            last = starts + counts - 1
+            for i, percent in enumerate(percents):
+                # Linear interpolation between the closest ranks
+                position = starts + (counts - 1) * (percent / 100)
+                lower = np.floor(position).astype(np.int64)
+                upper = np.minimum(lower + 1, last)
+                self.stats[present, field, 1 + i] = column[lower] + \
+                    (column[upper] - column[lower]) * (position - lower)
+
+    ##
+    ## @brief      Gets the positions of the keys in [low, high).
+    ##
+    def between(self, low, high):
+        return range(np.searchsorted(self.keys, low),
+                     np.searchsorted(self.keys, high))
+
+
+##
+## @brief      The FCE rows as parallel columns, and their rollup tables.
+##
+class FCERollup(object):
+    ##
+    ## @param      years    (int32 array) The year of each row, -1 if unknown
+    ## @param      values   (float array) rows x fields, NaN if missing
+    ## @param      codes    group -> (int32 array) The position of the key of
+    ##                      each row in names[group], -1 if unknown
+    ## @param      names    group -> [key]
+    ## @param      created  (int) The creation date of the index, in epoch
+    ##                      milliseconds
+    ## @param      etag     (str) The version of the index the rows were read
+    ##                      at
+    ##
+    def __init__(self, years, values, codes, names, created=None, etag=None):
+        _require_numpy()
+        self.years = years
+        self.values = values
+        self.codes = codes
+        self.names = names
+        self.created = created
+        self.etag = etag
+        self.fields = list(config.fce.SUMMARY_FIELDS)
+        self.percents = list(config.fce.SUMMARY_PERCENTS)
+        self._percent_keys = ['{:g}'.format(float(percent))
+                              for percent in self.percents]
+        self._codes = {group: {name: code for code, name in enumerate(keys)}
+                       for group, keys in names.items()}
+        # group -> token -> set of codes
+        self._tokens = {}
+        # group -> (the rows sorted by code, the start of each code in them)
+        self._rows = {}
+        for group in _TEXT_GROUPS:
+            postings = self._tokens[group] = {}
+            for code, name in enumerate(names[group]):
+                for token in tokenize(name):
+                    postings.setdefault(token, set()).add(code)
+            order = np.argsort(codes[group], kind='mergesort')
+            self._rows[group] = (order, np.searchsorted(
+                codes[group][order], np.arange(len(names[group]) + 1)))
+
+        self._totals, self._years, self._subgroups = {}, {}, {}
+        for group in GROUPS:
+            group_codes = codes[group].astype(np.int64)
+            self._totals[group] = _Table(group_codes, values, self.percents)
+            year_keys = group_codes * _YEAR_SPAN + years
+            year_keys[(group_codes < 0) | (years < 0)] = -1
+            self._years[group] = _Table(year_keys, values, self.percents)
+            subgroup_codes = codes[SUBGROUPS[group][1]].astype(np.int64)
+            span = len(names[SUBGROUPS[group][1]])
+            subgroup_keys = group_codes * span + subgroup_codes
+            subgroup_keys[(group_codes < 0) | (subgroup_codes < 0)] = -1
+            self._subgroups[group] = (_Table(subgroup_keys, values,
+                                             self.percents), span)
+
+    def __len__(self):
+        return len(self.years)
+
+    def __repr__(self):
+        return "<FCERollup: rows={}, courses={}, instructors={}, " \
+               "departments={}>".format(len(self), len(self.names['courseid']),
+                                        len(self.names['instructor']),
+                                        len(self.names['department']))
+
+    ##
+    ## @brief      Reads the columns of FCE documents.
+    ##
+    ## @param      sources  The _source of each document
+    ## @param      names    group -> [key], extended with the new keys
+    ##
+    ## @return     (years, values, codes)
+    ##
+    @staticmethod
+    def _columns(sources, names):
+        lookup = {group: {name: code for code, name in enumerate(keys)}
+                  for group, keys in names.items()}
+        paths = list(config.fce.SUMMARY_FIELDS.values())
+        years, values = [], []
+        codes = {group: [] for group in GROUPS}
+        for source in sources:
+            year = source.get(config.fce.YEAR_FIELD)
+            years.append(year if isinstance(year, int) else -1)
+            values.append([_number(_value(source, path)) for path in paths])
+            for group in GROUPS:
+                name = source.get(group)
+                if not isinstance(name, str):
+                    codes[group].append(-1)
+                    continue
+                code = lookup[group].get(name)
+                if code is None:
+                    code = lookup[group][name] = len(names[group])
+                    names[group].append(name)
+                codes[group].append(code)
+        return (np.array(years, dtype=np.int32),
+                np.array(values, dtype=np.float64).reshape(-1, len(paths)),
+                {group: np.array(codes[group], dtype=np.int32)
+                 for group in GROUPS})
+
+    ##
+    ## @brief      Builds the rollup of FCE documents.
+    ##
+    @classmethod
+    def build(cls, sources, created=None, etag=None):
+        _require_numpy()
+        names = {group: [] for group in GROUPS}
+        years, values, codes = cls._columns(sources, names)
+        return cls(years, values, codes, names, created, etag)
+
+    ##
+    ## @brief      Gets the first year refetched by a refresh: the latest
+    ##             year held, or None if there is no row.
+    ##
+    def latest_year(self):
+        if not len(self) or self.years.max() < 0:
+            return None
+        return int(self.years.max())
+
+    ##
+    ## @brief      Builds the rollup with the rows of the years from
+    ##             from_year on replaced. The rows of an unknown year are
+    ##             kept, since they are not fetched by year.
+    ##
+    ## @param      sources    The _source of the documents of the years from
+    ##                        from_year on
+    ## @param      from_year  (int) The first year replaced
+    ##
+    def update(self, sources, from_year, etag=None):
+        names = {group: list(keys) for group, keys in self.names.items()}
+        years, values, codes = self._columns(sources, names)
+        kept = self.years < from_year
+        # A year the range matched but that is not a number, already kept
+        added = years >= from_year
+        return FCERollup(
+            np.concatenate([self.years[kept], years[added]]),
+            np.concatenate([self.values[kept], values[added]]),
+            {group: np.concatenate([self.codes[group][kept],
+                                    codes[group][added]])
+             for group in GROUPS},
+            names, self.created, etag)
+
+    ##
+    ## @brief      Finds the keys of a group matching a query, as the query of
+    ##             FCESearcher would: a course by its courseid, an
+    ##             instructor or a department by all the words of the query.
+    ##
+    ## @return     (list) The codes of the keys.
+    ##
+    def resolve(self, group, text):
+        if group not in _TEXT_GROUPS:
+            code = self._codes[group].get(text)
+            return [] if code is None else [code]
+        tokens = tokenize(text)
+        if not tokens:
+            return []
+        postings = self._tokens[group]
+        matched = set(postings.get(tokens[0], set()))
+        for token in tokens[1:]:
+            matched &= postings.get(token, set())
+        return sorted(matched)
+
+    def _fields(self, stats=None):
+        if stats is None:
+            rows = [[None] * (1 + len(self.percents))] * len(self.fields)
+        else:
+            # NaN where there is no value
+            rows = [[None if value != value else value for value in row]
+                    for row in stats.tolist()]
+        return {name: {'mean': row[0],
+                       'percentiles': dict(zip(self._percent_keys, row[1:]))}
+                for name, row in zip(self.fields, rows)}
+
+    def _output(self, group, rows=0, stats=None, years=(), subgroups=()):
+        subgroup, subgroup_key = SUBGROUPS[group]
+        names = self.names[subgroup_key]
+        # The order of the terms aggregations: the years from the latest,
+        # the subgroups from the one with the most rows
+        years = sorted(years, key=lambda item: -item[0])
+        subgroups = sorted(subgroups,
+                           key=lambda item: (-item[1], names[item[0]]))
+        return {
+            'rows': int(rows),
+            'fields': self._fields(stats),
+            'years': [{'year': int(year), 'rows': int(year_rows),
+                       'fields': self._fields(year_stats)}
+                      for year, year_rows, year_stats in
+                      years[:config.fce.SUMMARY_BUCKETS]],
+            subgroup: [{subgroup_key: names[code], 'rows': int(code_rows),
+                        'fields': self._fields(code_stats)}
+                       for code, code_rows, code_stats in
+                       subgroups[:config.fce.SUMMARY_BUCKETS]],
+        }
+
+    ##
+    ## @brief      Gets the summary of a key from the rollup tables, in the
+    ##             format of search.format_fce_summary_output().
+    ##
+    ## @param      group  (str) courseid, instructor or department
+    ## @param      code   (int) The code of the key
+    ##
+    def summary(self, group, code):
+        totals = self._totals[group]
+        positions = totals.between(code, code + 1)
+        if not positions:
+            return self._output(group)
+        position = positions[0]
+
+        years = self._years[group]
+        subgroups, span = self._subgroups[group]
+        return self._output(
+            group, totals.rows[position], totals.stats[position],
+            [(years.keys[i] - code * _YEAR_SPAN, years.rows[i],
+              years.stats[i])
+             for i in years.between(code * _YEAR_SPAN,
+                                    (code + 1) * _YEAR_SPAN)],
+            [(subgroups.keys[i] - code * span, subgroups.rows[i],
+              subgroups.stats[i])
+             for i in subgroups.between(code * span, (code + 1) * span)])
+
+    ##
+    ## @brief      Summarizes the rows of several keys of a group, from the
+    ##             columns of their rows only.
+    ##
+    def summary_of_keys(self, group, codes):
+        order, starts = self._rows[group]
+        rows = np.concatenate([order[starts[code]:starts[code + 1]]
+                               for code in codes])
+        values = self.values[rows]
+
+        def table(keys):
+            table = _Table(keys.astype(np.int64), values, self.percents)
+            return zip(table.keys, table.rows, table.stats)
+
+        totals = list(table(np.zeros(len(rows))))
+        if not totals:
+            return self._output(group)
+        _, count, stats = totals[0]
+        return self._output(group, count, stats, table(self.years[rows]),
+                            table(self.codes[SUBGROUPS[group][1]][rows]))
+
+    ##
+    ## @brief      Summarizes the FCEs matching a query, in the format of
+    ##             search.format_fce_summary_output().
+    ##
+    def summarize(self, group, text):
+        codes = self.resolve(group, text)
+        if not codes:
+            return self._output(group)
+        if len(codes) == 1:
+            return self.summary(group, codes[0])
+        return self.summary_of_keys(group, codes)
+
+    ##
+    ## @brief      Saves the columns as path (.npz) and path + .json.
+    ##
+    def save(self, path):
+        tmp_path = '{}.tmp{}'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, years=self.years, values=self.values,
+                     **{group: self.codes[group] for group in GROUPS})
+        with open(_sidecar_path(tmp_path), 'w') as f:
+            json.dump({
+                'version': FORMAT_VERSION,
+                'created': self.created,
+                'etag': self.etag,
+                'fields': self.fields,
+                'names': self.names,
+            }, f)
+        os.replace(tmp_path, path)
+        os.replace(_sidecar_path(tmp_path), _sidecar_path(path))
+
+    @classmethod
+    def load(cls, path):
+        _require_numpy()
+        with open(_sidecar_path(path)) as f:
+            meta = json.load(f)
+        if meta['version'] != FORMAT_VERSION:
+            raise ValueError(
+                "Unsupported rollup version {}".format(meta['version']))
+        if meta['fields'] != list(config.fce.SUMMARY_FIELDS):
+            raise ValueError("The rollup has other fields than "
+                             "SUMMARY_FIELDS, rebuild it")
+        with np.load(path, allow_pickle=False) as arrays:
+            return cls(arrays['years'], arrays['values'],
+                       {group: arrays[group] for group in GROUPS},
+                       meta['names'], meta['created'], meta['etag'])
+
+
+def _sidecar_path(path):
+    return path + '.json'
+
+
+def _fetch(from_year=None):
+    s = Search(index=ES_FCE_INDEX, doc_type='fce').source(
+        [config.fce.YEAR_FIELD] + list(GROUPS) +
+        list(config.fce.SUMMARY_FIELDS.values()))
+    if from_year is not None:
+        s = s.filter('range', **{config.fce.YEAR_FIELD: {'gte': from_year}})
+    return (hit.to_dict() for hit in s.scan())
+
+
+def _index_state():
+    es = connections.get_connection()
+    settings = es.indices.get_settings(index=ES_FCE_INDEX,
+                                       name='index.creation_date')
+    created = max(int(value['settings']['index']['creation_date'])
+                  for value in settings.values())
+    stats = es.indices.stats(index=ES_FCE_INDEX, metric='docs')
+    return created, stats['_all']['primaries']['docs']['count']
+
+
+_rollup = None
+_lock = threading.Lock()
+_thread = None
+
+
+##
+## @brief      Gets the rollup in use.
+##
+## @return     (FCERollup) or None if none is loaded.
+##
+def get():
+    return _rollup
+
+
+##
+## @brief      Brings the rollup up to date with the fce index, fetching only
+##             the latest years when it can. The rollup in use is replaced
+##             once the new one is computed, and saved to FCE_ROLLUP_FILE.
+##
+## @param      full  Whether to read the whole index again
+##
+## @return     (FCERollup) The new rollup.
+##
+def refresh(full=False):
+    global _rollup
+    with _lock:
+        version = index_version.fetch_version(ES_FCE_INDEX)
+        rollup = _rollup
+        if not full and rollup is not None and rollup.etag == version.etag:
+            return rollup
+        created, count = _index_state()
+        from_year = None if rollup is None else rollup.latest_year()
+        if (full or from_year is None or rollup.created != created):
+            rollup = FCERollup.build(_fetch(), created, version.etag)
+        else:
+            rollup = rollup.update(_fetch(from_year), from_year, version.etag)
+            if len(rollup) != count:
+                # Rows of earlier years were changed
+                rollup = FCERollup.build(_fetch(), created, version.etag)
+        _rollup = rollup
+        if config.fce.FCE_ROLLUP_FILE:
+            rollup.save(config.fce.FCE_ROLLUP_FILE)
+        return rollup
+
+
+def _refresh_quietly():
+    try:
+        refresh()
+    except Exception as e:
+        # The rollup in use is kept, and the next request tries again
+        logger.warning("Cannot refresh the FCE rollup: %s", e)
+
+
+##
+## @brief      Starts refresh() in the background, unless it is running.
+##
+def refresh_async():
+    global _thread
+    if _thread is not None and _thread.is_alive():
+        return
+    _thread = threading.Thread(target=_refresh_quietly, daemon=True)
+    _thread.start()
+
+
+##
+## @brief      Loads the rollup saved to FCE_ROLLUP_FILE, if any, and
+##             refreshes it. Called by the warmup when FCE_ROLLUP is on.
+##
+def init():
+    global _rollup
+    path = config.fce.FCE_ROLLUP_FILE
+    if _rollup is None and path and os.path.exists(path):
+        try:
+            _rollup = FCERollup.load(path)
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning("Cannot load the FCE rollup %s: %s", path, e)
+    return refresh()
+
+
+def unload():
+    global _rollup
+    _rollup = None
+
+
+##
+## @brief      Summarizes the FCEs matching a query from the rollup, and
+##             starts a refresh if the fce index has changed since it was
+##             computed.
+##
+## @param      group  (str) courseid, instructor or department
+## @param      text   (str) The courseid, or the words of the name
+##
+## @return     The summary in the format of
+##             search.format_fce_summary_output(), or None if no rollup is
+##             loaded.
+##
+def summarize(group, text):
+    rollup = _rollup
+    if not config.fce.FCE_ROLLUP or rollup is None:
+        return None
+    version = index_version.get(ES_FCE_INDEX)
+    if version is not None and version.etag != rollup.etag:
+        refresh_async()
+    return rollup.summarize(group, text)
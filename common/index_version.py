@@ -0,0 +1,241 @@
+# @file index_version.py
+# @brief Cheap versions of the ES indexes, used as the validators of the HTTP
+#        conditional requests (ETag and Last-Modified), and to drop the cached
+#        results of an index once it changes.
+# @author Justin Chu (justinchuby@cmu.edu)
+
+import collections
+import datetime
+import fnmatch
+import hashlib
+import threading
+import time
+
+import elasticsearch
+from elasticsearch_dsl.connections import connections
+
+from common import cache, local_index
+import config.settings
+from config.es_config import ES_COURSE_INDEX_PREFIX, ES_REQUEST_TIMEOUTS,\
+                             ES_TIMEOUT
+
+
+##
+## @brief      The version of an index. etag changes whenever the index is
+##             rebuilt, documents are added or deleted or, for the courses, a
+##             new scrape is indexed. last_modified is a UTC datetime.
+##
+IndexVersion = collections.namedtuple('IndexVersion',
+                                      ['etag', 'last_modified'])
+
+
+def _rundates(es, names, timeout):
+    if not names:
+        return {}
+    body = []
+    for name in names:
+        body.append({'index': name, 'type': 'course'})
+        body.append({'size': 0,
+                     'aggs': {'rundate': {'max': {'field': 'rundate'}}}})
+    responses = es.msearch(body=body, request_timeout=timeout)['responses']
+    return {name: response['aggregations']['rundate']['value']
+            for name, response in zip(names, responses)
+            if 'aggregations' in response}
+
+
+##
+## @brief      Reads the versions of indexes, or of the indexes matched by
+##             wildcards, with one stats and one settings request for all of
+##             them, plus one _msearch of the latest rundate of each course
+##             index. Only values that survive a restart of the nodes are
+##             used: the indexing counters and the deleted documents, which
+##             merges purge, are not.
+##
+## @param      indexes  A list of index names, wildcards allowed
+##
+## @return     A dict {index: IndexVersion or None if no index matches}.
+##
+def fetch_versions(indexes):
+    es = connections.get_connection()
+    timeout = ES_REQUEST_TIMEOUTS.get('version', ES_TIMEOUT)
+    pattern = ','.join(sorted(set(indexes)))
+    stats = es.indices.stats(index=pattern, metric='docs',
+                             ignore_unavailable=True,
+                             request_timeout=timeout)['indices']
+    index_settings = es.indices.get_settings(index=pattern,
+                                             name='index.creation_date',
+                                             ignore_unavailable=True,
+                                             request_timeout=timeout)
+    names = sorted(set(stats) & set(index_settings))
+    # The date the courses were scraped
+    rundates = _rundates(es, [name for name in names
+                              if name.startswith(ES_COURSE_INDEX_PREFIX)],
+                         timeout)
+
+    versions = {}
+    for index in indexes:
+        matched = [name for name in names
+                   if fnmatch.fnmatchcase(name, index)]
+        if not matched:
+            versions[index] = None
+            continue
+        count = sum(stats[name]['primaries']['docs']['count']
+                    for name in matched)
+        created = max(int(index_settings[name]['settings']['index']
+                          ['creation_date']) for name in matched)
+        rundate = None
+        if index.startswith(ES_COURSE_INDEX_PREFIX):
+            rundate = max((rundates[name] for name in matched
+                           if rundates.get(name) is not None), default=None)
+        token = '{}:{}:{}:{}'.format(','.join(matched), count, created,
+                                     rundate)
+        last_modified = datetime.datetime.fromtimestamp(
+            max(created, rundate or 0) // 1000, datetime.timezone.utc)
+        versions[index] = IndexVersion(
+            hashlib.sha1(token.encode('utf-8')).hexdigest()[:20],
+            last_modified)
+    return versions
+
+
+##
+## @brief      Reads the version of an index, or of the indexes matched by
+##             a wildcard.
+##
+## @return     (IndexVersion) or None if no index matches.
+##
+def fetch_version(index):
+    return fetch_versions([index])[index]
+
+
+# index -> IndexVersion or None, for every index asked for so far
+_versions = {}
+# The indexes whose first version is being read
+_fetching = set()
+# When the versions are read again
+_expires_at = 0
+_refreshing = False
+# The thread of the last background refresh
+_thread = None
+_lock = threading.Lock()
+
+
+##
+## @brief      Reads the versions of indexes again, all at once, and drops
+##             the cached results and rebuilds the local indexes of those
+##             that changed. The last known versions are kept if ES cannot
+##             tell.
+##
+## @param      indexes  A list of indexes, every index known so far by
+##                      default. Indexes not known yet are added.
+##
+def refresh(indexes=None):
+    known = indexes is None
+    if known:
+        with _lock:
+            indexes = list(_versions)
+    if not indexes:
+        return
+    try:
+        versions = fetch_versions(indexes)
+    except (elasticsearch.exceptions.ElasticsearchException,
+            KeyError, ValueError):
+        versions = {}
+    changed = []
+    with _lock:
+        for index in indexes:
+            if known and index not in _versions:
+                # Dropped by clear() meanwhile
+                continue
+            version = _versions.get(index)
+            new_version = versions.get(index, version)
+            _versions[index] = new_version
+            if (version is not None and new_version is not None and
+                    version.etag != new_version.etag):
+                changed.append(index)
+    for index in changed:
+        cache.invalidate(index)
+        local_index.reload(index)
+
+
+def _refresh_in_background():
+    global _refreshing
+    try:
+        refresh()
+    finally:
+        with _lock:
+            _refreshing = False
+
+
+##
+## @brief      Gets the version of an index. The first time, it is read from
+##             ES by one thread while the others get None. It is then read
+##             again along with the versions of the other indexes in the
+##             background, at most once every INDEX_VERSION_TTL seconds,
+##             while the last known version is returned.
+##
+## @return     (IndexVersion) or None if ES cannot tell.
+##
+def get(index):
+    global _expires_at, _refreshing, _thread
+    now = time.time()
+    with _lock:
+        if index not in _versions:
+            if index in _fetching:
+                return None
+            _fetching.add(index)
+            first = True
+            if not _expires_at:
+                _expires_at = now + config.settings.INDEX_VERSION_TTL
+        else:
+            first = False
+            version = _versions[index]
+            if now >= _expires_at and not _refreshing:
+                # A failed read is not retried before the TTL expires either
+                _expires_at = now + config.settings.INDEX_VERSION_TTL
+                _refreshing = True
+                _thread = threading.Thread(target=_refresh_in_background,
+                                           daemon=True)
+                _thread.start()
+    if not first:
+        return version
+    try:
+        refresh([index])
+    finally:
+        with _lock:
+            _versions.setdefault(index, None)
+            _fetching.discard(index)
+    return _versions[index]
+
+
+##
+## @brief      Gets the version of a response read from several indexes. Its
+##             etag changes whenever the one of an index does.
+##
+## @return     (IndexVersion) or None if ES cannot tell the version of one
+##             of the indexes.
+##
+def get_all(indexes):
+    versions = [get(index) for index in indexes]
+    if not versions or None in versions:
+        return None
+    if len(versions) == 1:
+        return versions[0]
+    token = ':'.join(version.etag for version in versions)
+    return IndexVersion(hashlib.sha1(token.encode('utf-8')).hexdigest()[:20],
+                        max(version.last_modified for version in versions))
+
+
+##
+## @brief      Waits for the background refresh started by get() to finish.
+##
+def wait():
+    thread = _thread
+    if thread is not None:
+        thread.join()
+
+
+def clear():
+    global _expires_at
+    with _lock:
+        _versions.clear()
+        _expires_at = 0
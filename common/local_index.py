@@ -0,0 +1,390 @@
+# @file local_index.py
+# @brief In-memory course indexes that answer course lookups without
+#        a round-trip to Elasticsearch.
+# @author Justin Chu (justinchuby@cmu.edu)
+
+import re
+import time
+import bisect
+import fnmatch
+import logging
+import threading
+
+from elasticsearch_dsl import Search
+from elasticsearch_dsl.response import Response
+
+from common import utils
+from common.cmu_course import Course
+
+logger = logging.getLogger(__name__)
+
+# Keys of a raw query that the local indexes know how to answer. Queries with
+# any other key (e.g. full text search) are sent to Elasticsearch.
+_SUPPORTED_KEYS = frozenset(['courseid', 'instructor', 'building', 'room',
+                            'datetime', 'timespan'])
+
+_TOKEN_PATTERN = re.compile(r'\w+')
+
+
+##
+## @brief      Splits a string into lower case tokens, roughly the way the
+##             ES standard analyzer does.
+##
+def tokenize(s):
+    return _TOKEN_PATTERN.findall(s.lower())
+
+
+##
+## @brief      The meeting times of a term as sorted interval arrays, one per
+##             day of the week, answering which meetings are in session during
+##             a window of time with a binary search.
+##
+class MeetingTimeIndex(object):
+    def __init__(self):
+        # day -> [(begin, end, time key)], with begin and end in minutes
+        self._intervals = [[] for _ in range(7)]
+        self._begins = None
+        self._max_lengths = None
+
+    def __len__(self):
+        return sum(len(intervals) for intervals in self._intervals)
+
+    def add(self, begin, end, days, time_key):
+        for day in days:
+            self._intervals[day].append((begin, end, time_key))
+        self._begins = None
+
+    def _sort(self):
+        for intervals in self._intervals:
+            intervals.sort(key=lambda interval: interval[0])
+        self._begins = [[interval[0] for interval in intervals]
+                        for intervals in self._intervals]
+        self._max_lengths = [max([end - begin for begin, end, _ in intervals],
+                                 default=0)
+                             for intervals in self._intervals]
+
+    ##
+    ## @brief      Finds the meeting times in session during the windows.
+    ##
+    ## @param      windows  A list of (day, begin, end) tuples given by
+    ##                      utils.get_time_windows()
+    ##
+    ## @return     (set) The time keys of the meetings that begin no later
+    ##             than the end of a window and end after its beginning.
+    ##
+    def find(self, windows):
+        if self._begins is None:
+            self._sort()
+        matched = set()
+        for day, begin, end in windows:
+            intervals = self._intervals[day]
+            begins = self._begins[day]
+            # Meetings beginning before begin - max length have ended already
+            low = bisect.bisect_left(begins, begin - self._max_lengths[day])
+            high = bisect.bisect_right(begins, end)
+            for i in range(low, high):
+                if intervals[i][1] > begin:
+                    matched.add(intervals[i][2])
+        return matched
+
+
+##
+## @brief      The courses of one term, along with inverted indexes on the
+##             fields used by the course endpoints.
+##
+##             Postings point at meetings (a lecture or a section) and at the
+##             times of a meeting, so that the nested semantics of the ES
+##             queries are kept: the instructor, building and room must all
+##             match within the same meeting.
+##
+class LocalCourseIndex(object):
+    _MEETING_TYPES = ('lectures', 'sections')
+
+    def __init__(self, index, scotty_dicts):
+        self.index = index
+        self.docs = []
+        # courseid -> [doc position]
+        self.courseids = {}
+        # token -> set of meeting keys (doc position, meeting type, position)
+        self.instructors = {}
+        # token -> set of time keys (meeting key, time position)
+        self.buildings = {}
+        self.rooms = {}
+        # meeting key -> number of times of the meeting
+        self.meeting_times = {}
+        self.time_index = MeetingTimeIndex()
+        for scotty_dict in scotty_dicts:
+            self.add(scotty_dict)
+
+    def __len__(self):
+        return len(self.docs)
+
+    def __repr__(self):
+        return "<LocalCourseIndex: index={}, courses={}>".format(
+            self.index, len(self.docs))
+
+    def add(self, scotty_dict):
+        position = len(self.docs)
+        course = Course(scotty_dict)
+        self.docs.append(scotty_dict)
+        self.courseids.setdefault(course.courseid, []).append(position)
+
+        for meeting_type in self._MEETING_TYPES:
+            for i, meeting in enumerate(getattr(course, meeting_type)):
+                meeting_key = (position, meeting_type, i)
+                self.meeting_times[meeting_key] = len(meeting.times)
+                for instructor in meeting.instructors or []:
+                    for token in tokenize(instructor):
+                        self.instructors.setdefault(token, set()).add(
+                            meeting_key)
+                for j, time_obj in enumerate(meeting.times):
+                    time_key = (meeting_key, j)
+                    for token in tokenize(time_obj.building or ''):
+                        self.buildings.setdefault(token, set()).add(time_key)
+                    for token in tokenize(time_obj.room or ''):
+                        self.rooms.setdefault(token, set()).add(time_key)
+                    if (time_obj.begin_minutes is not None and
+                            time_obj.end_minutes is not None and
+                            time_obj.day_mask):
+                        self.time_index.add(time_obj.begin_minutes,
+                                            time_obj.end_minutes,
+                                            time_obj.days, time_key)
+
+    @staticmethod
+    def _match_any(postings, text):
+        matched = set()
+        for token in tokenize(text):
+            matched |= postings.get(token, set())
+        return matched
+
+    @staticmethod
+    def _match_all(postings, text):
+        tokens = tokenize(text)
+        if not tokens:
+            return set()
+        matched = set(postings.get(tokens[0], set()))
+        for token in tokens[1:]:
+            matched &= postings.get(token, set())
+        return matched
+
+    ##
+    ## @brief      Finds the courses matching a raw query, in the format used
+    ##             by CourseSearcher.
+    ##
+    ## @return     (list) The positions of the matching courses, or None if
+    ##             the raw query cannot be answered locally.
+    ##
+    def find(self, raw_query):
+        if not set(raw_query) <= _SUPPORTED_KEYS:
+            return None
+
+        if 'courseid' in raw_query:
+            candidates = set(self.courseids.get(raw_query['courseid'][0], []))
+        else:
+            candidates = None
+
+        # Times matching every building and room condition
+        time_keys = None
+        if 'building' in raw_query:
+            time_keys = self._match_any(self.buildings,
+                                        raw_query['building'][0])
+        if 'room' in raw_query:
+            room_keys = self._match_any(self.rooms, raw_query['room'][0])
+            time_keys = room_keys if time_keys is None \
+                else time_keys & room_keys
+        if 'datetime' in raw_query:
+            date_time = raw_query['datetime'][0].to('America/New_York')
+            windows = utils.get_time_windows(date_time,
+                                             raw_query['timespan'][0])
+            happening_keys = self.time_index.find(windows)
+            time_keys = happening_keys if time_keys is None \
+                else time_keys & happening_keys
+
+        # Meetings matching the instructor and having at least one
+        # matching time
+        meetings = None
+        if time_keys is not None:
+            meetings = set(meeting_key for meeting_key, _ in time_keys)
+        if 'instructor' in raw_query:
+            instructor_keys = self._match_all(
+                self.instructors, " ".join(raw_query['instructor']))
+            if meetings is None:
+                meetings = set(key for key in instructor_keys
+                               if self.meeting_times[key] > 0)
+            else:
+                meetings &= instructor_keys
+        if meetings is None:
+            meetings = set(key for key, count in self.meeting_times.items()
+                           if count > 0 and
+                           (candidates is None or key[0] in candidates))
+
+        positions = set(meeting_key[0] for meeting_key in meetings)
+        if candidates is not None:
+            positions &= candidates
+        return sorted(positions)
+
+    ##
+    ## @brief      Answers a raw query with a response shaped like the one
+    ##             returned by Elasticsearch.
+    ##
+    ## @param      source  The _source filter given by
+    ##                     search.get_source_filter(), applied the way ES
+    ##                     would
+    ##
+    ## @return     (Response) or None if the raw query is not supported.
+    ##
+    def search(self, raw_query, size, source=None):
+        start = time.time()
+        positions = self.find(raw_query)
+        if positions is None:
+            return None
+        hits = [self._hit(position, source) for position in positions[:size]]
+        took = int((time.time() - start) * 1000)
+        return make_response(self.index, 'course', hits, len(positions),
+                             took=took)
+
+    def _hit(self, position, source=None):
+        doc = self.docs[position]
+        if source:
+            _source = utils.filter_source(doc, source.get('includes'),
+                                          source.get('excludes'))
+        else:
+            # format_response may overwrite top level fields of the hits
+            _source = dict(doc)
+        return {
+            '_index': self.index,
+            '_type': 'course',
+            '_id': doc.get('id'),
+            '_score': None,
+            '_source': _source,
+        }
+
+
+##
+## @brief      Wraps hits into an elasticsearch_dsl Response.
+##
+def make_response(index, doc_type, hits, total, took=0):
+    raw = {
+        'took': took,
+        'timed_out': False,
+        '_shards': {'total': 1, 'successful': 1, 'failed': 0},
+        'hits': {
+            'total': total,
+            'max_score': None,
+            'hits': hits
+        }
+    }
+    return Response(Search(index=index, doc_type=doc_type), raw)
+
+
+# ES index name -> LocalCourseIndex
+_indexes = {}
+
+
+def get(index):
+    return _indexes.get(index)
+
+
+def indexes():
+    return dict(_indexes)
+
+
+##
+## @brief      Builds the local index of a term from its scottylabs dicts and
+##             makes it serve the course lookups.
+##
+def load(index, scotty_dicts):
+    local_index = LocalCourseIndex(index, scotty_dicts)
+    _indexes[index] = local_index
+    return local_index
+
+
+##
+## @brief      Loads every course of an ES index into memory. ES stays the
+##             source of truth; call again to pick up a new scrape.
+##
+def load_from_es(index):
+    return load(index, _scan(index))
+
+
+def _scan(index):
+    s = Search(index=index, doc_type='course')
+    return (hit.to_dict() for hit in s.scan())
+
+
+def unload(index):
+    return _indexes.pop(index, None)
+
+
+_lock = threading.Lock()
+# index -> whether it changed again while being rebuilt
+_rebuilding = {}
+# index -> the thread rebuilding it
+_threads = {}
+
+
+def _rebuild(index):
+    while True:
+        try:
+            local_index = LocalCourseIndex(index, _scan(index))
+        except Exception as e:
+            # Left unloaded: the lookups of the term keep going to ES
+            logger.warning("Cannot rebuild the local index of %s: %s",
+                           index, e)
+            with _lock:
+                del _rebuilding[index]
+            return
+        with _lock:
+            if _rebuilding[index]:
+                # Read while the index was changing, read it again
+                _rebuilding[index] = False
+                continue
+            del _rebuilding[index]
+            _indexes[index] = local_index
+            return
+
+
+##
+## @brief      Drops the local indexes of the ES indexes whose data changed
+##             and rebuilds them from ES in the background. The lookups of
+##             those terms go to ES until they are rebuilt. Called when the
+##             version of an index changes (index_version).
+##
+## @param      pattern  (str) The ES index, wildcards allowed, e.g. course-*
+##
+def reload(pattern):
+    with _lock:
+        names = [name for name in set(_indexes) | set(_rebuilding)
+                 if fnmatch.fnmatchcase(name, pattern)]
+        for name in names:
+            _indexes.pop(name, None)
+            if name in _rebuilding:
+                _rebuilding[name] = True
+                continue
+            _rebuilding[name] = False
+            thread = threading.Thread(target=_rebuild, args=(name,),
+                                      daemon=True)
+            _threads[name] = thread
+            thread.start()
+    return names
+
+
+##
+## @brief      Waits for the rebuilds started by reload() to finish.
+##
+def wait():
+    for thread in list(_threads.values()):
+        thread.join()
+
+
+##
+## @brief      Answers a raw query from the local index of a term.
+##
+## @return     (Response) or None if the index is not loaded or the query is
+##             not supported locally.
+##
+def search(raw_query, index, size, source=None):
+    local_index = _indexes.get(index)
+    if local_index is None:
+        return None
+    return local_index.search(raw_query, size, source=source)
@@ -0,0 +1,607 @@
+# @file memory_es.py
+# @brief A stand-in for the Elasticsearch client answering the requests the
+#        api makes (search, scroll, GET, _mget, _msearch and the index stats)
+#        from documents held by the process: the snapshot files of
+#        common/snapshot.py, or the lists of the benchmarks.
+#
+#        Only the query DSL built by common/search.py is understood: bool,
+#        match, term(s), range, nested and match_all. Text is tokenized like
+#        the local indexes do and every hit scores 1.0.
+#
+#        There is no inverted index: every search matches the query against
+#        each document of the index, whose decoded _source and tokens are
+#        kept by the process. It is meant for corpora of a few terms, like
+#        the catalog of one school, not as a general replacement of ES.
+# @author Justin Chu (justinchuby@cmu.edu)
+
+import collections
+import datetime
+import fnmatch
+import functools
+import itertools
+import re
+import threading
+import time
+
+import elasticsearch
+
+from common import utils
+from common.local_index import tokenize
+
+
+# Scroll contexts kept at most, the least recently used being dropped first,
+# like the search.max_open_scroll_context of a cluster
+MAX_SCROLLS = 500
+# Keep-alive of the scroll contexts, when a request does not give one
+DEFAULT_KEEP_ALIVE = 60
+
+_TIME_UNITS = {'d': 86400, 'h': 3600, 'm': 60, 's': 1, 'ms': 0.001}
+
+
+##
+## @brief      Parses an ES time value, e.g. 1m or 30s.
+##
+## @return     (float) The number of seconds.
+##
+def _parse_time(value):
+    if value is None:
+        return DEFAULT_KEEP_ALIVE
+    match = re.match(r'^(\d+)(d|h|m|s|ms)$', str(value))
+    if match is None:
+        raise _parsing_error('failed to parse [{}]'.format(value))
+    return int(match.group(1)) * _TIME_UNITS[match.group(2)]
+
+
+class _Transport(object):
+    # Read by connection.get_pool_stats(), the stand-in has no pools
+    class connection_pool(object):
+        connections = []
+
+
+class _Indices(object):
+    def __init__(self, es):
+        self.es = es
+
+    @staticmethod
+    def _primaries(count):
+        return {'primaries': {
+            'docs': {'count': count, 'deleted': 0},
+            'indexing': {'index_total': count},
+        }}
+
+    def stats(self, index=None, metric=None, **params):
+        names = self.es._resolve(index, params.get('ignore_unavailable'))
+        counts = {name: len(self.es.indexes[name]) for name in names}
+        return {'_all': self._primaries(sum(counts.values())),
+                'indices': {name: self._primaries(count)
+                            for name, count in counts.items()}}
+
+    def get_settings(self, index=None, name=None, **params):
+        return {name: {'settings': {'index': {
+            'creation_date': str(self.es.indexes[name].created)}}}
+            for name in self.es._resolve(index,
+                                         params.get('ignore_unavailable'))}
+
+
+def _not_found(index):
+    info = {'error': {'type': 'index_not_found_exception',
+                      'reason': 'no such index', 'index': index},
+            'status': 404}
+    return elasticsearch.exceptions.NotFoundError(
+        404, 'index_not_found_exception', info)
+
+
+def _parsing_error(reason):
+    info = {'error': {'type': 'parsing_exception', 'reason': reason},
+            'status': 400}
+    return elasticsearch.exceptions.RequestError(
+        400, 'parsing_exception', info)
+
+
+##
+## @brief      Gets the values of a dotted field of an object, flattening the
+##             lists along the path.
+##
+def _values(obj, path):
+    values = [obj]
+    for part in path.split('.') if path else []:
+        next_values = []
+        for value in values:
+            if isinstance(value, dict) and value.get(part) is not None:
+                child = value[part]
+                if isinstance(child, list):
+                    next_values.extend(child)
+                else:
+                    next_values.append(child)
+        values = next_values
+    return values
+
+
+def _relative(field, prefix):
+    return field[len(prefix) + 1:] if prefix else field
+
+
+def _comparable(value):
+    if isinstance(value, str):
+        time_value = utils.parse_time(value)
+        if time_value is not None:
+            return utils.time_to_minutes(time_value)
+    return value
+
+
+def _as_number(value):
+    if isinstance(value, str):
+        # Dates are aggregated as epoch milliseconds, like ES does
+        date = datetime.datetime.strptime(value[:10], '%Y-%m-%d')
+        return date.replace(tzinfo=datetime.timezone.utc).timestamp() * 1000
+    return value
+
+
+##
+## @brief      The percentile of sorted values, interpolated linearly. ES
+##             gives an estimate, exact on small sets.
+##
+def _percentile(values, percent):
+    if not values:
+        return None
+    position = (len(values) - 1) * percent / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+class _Matcher(object):
+    _QUERIES = ('match_all', 'bool', 'match', 'term', 'terms', 'range',
+                'nested')
+
+    def __init__(self):
+        # (id of an object, field) -> (object, tokens of its values). The
+        # documents never change, so they are tokenized once. The object is
+        # kept so that its id is not reused.
+        self._tokens = {}
+
+    def _field_tokens(self, obj, field):
+        key = (id(obj), field)
+        entry = self._tokens.get(key)
+        if entry is None:
+            tokens = set()
+            for value in _values(obj, field):
+                tokens.update(tokenize(str(value)))
+            entry = self._tokens[key] = (obj, tokens)
+        return entry[1]
+
+    ##
+    ## @brief      Whether an object matches a query. Nested queries match
+    ##             when one of the objects at their path does, prefix being
+    ##             the path of obj in the document.
+    ##
+    def matches(self, obj, query, prefix=''):
+        (kind, body), = query.items()
+        if kind not in self._QUERIES:
+            # Answered like a cluster answers an unknown query
+            raise _parsing_error('no [query] registered for [{}]'.format(kind))
+        return getattr(self, '_' + kind)(obj, body, prefix)
+
+    def _match_all(self, obj, body, prefix):
+        return True
+
+    def _bool(self, obj, body, prefix):
+        def clauses(key):
+            value = body.get(key, [])
+            return value if isinstance(value, list) else [value]
+
+        for query in clauses('must') + clauses('filter'):
+            if not self.matches(obj, query, prefix):
+                return False
+        for query in clauses('must_not'):
+            if self.matches(obj, query, prefix):
+                return False
+        should = clauses('should')
+        minimum = body.get('minimum_should_match')
+        if minimum is None:
+            minimum = 0 if 'must' in body or 'filter' in body else 1
+        if should and minimum:
+            matched = sum(1 for query in should
+                          if self.matches(obj, query, prefix))
+            return matched >= int(minimum)
+        return True
+
+    def _match(self, obj, body, prefix):
+        (field, query), = body.items()
+        if not isinstance(query, dict):
+            query = {'query': query}
+        tokens = tokenize(str(query['query']))
+        field_tokens = self._field_tokens(obj, _relative(field, prefix))
+        if query.get('operator', 'or').lower() == 'and':
+            return all(token in field_tokens for token in tokens)
+        return any(token in field_tokens for token in tokens)
+
+    def _term(self, obj, body, prefix):
+        (field, value), = body.items()
+        if isinstance(value, dict):
+            value = value['value']
+        return value in _values(obj, _relative(field, prefix))
+
+    def _terms(self, obj, body, prefix):
+        (field, terms), = body.items()
+        values = _values(obj, _relative(field, prefix))
+        return any(term in values for term in terms)
+
+    def _range(self, obj, body, prefix):
+        (field, bounds), = body.items()
+        tests = [(bounds[key], test) for key, test in (
+            ('gt', lambda a, b: a > b), ('gte', lambda a, b: a >= b),
+            ('lt', lambda a, b: a < b), ('lte', lambda a, b: a <= b))
+            if key in bounds]
+        for value in _values(obj, _relative(field, prefix)):
+            value = _comparable(value)
+            if all(test(value, _comparable(bound)) for bound, test in tests):
+                return True
+        return False
+
+    def _nested(self, obj, body, prefix):
+        path = body['path']
+        return any(self.matches(child, body['query'], path)
+                   for child in _values(obj, _relative(path, prefix))
+                   if isinstance(child, dict))
+
+
+##
+## @brief      The documents of an index held in a list.
+##
+class DocumentList(object):
+    def __init__(self, created=None):
+        # [(doc type, _id, _source)]
+        self.docs = []
+        # _id -> position
+        self.ids = {}
+        # Creation date in epoch milliseconds
+        self.created = created or int(time.time() * 1000)
+
+    def __len__(self):
+        return len(self.docs)
+
+    def __iter__(self):
+        return iter(self.docs)
+
+    def add(self, doc_type, doc_id, source):
+        self.ids[doc_id] = len(self.docs)
+        self.docs.append((doc_type, doc_id, source))
+
+    ##
+    ## @brief      Gets a document by _id.
+    ##
+    ## @return     (doc type, _source) or None if there is no such document.
+    ##
+    def get(self, doc_id):
+        position = self.ids.get(doc_id)
+        if position is None:
+            return None
+        doc_type, _, source = self.docs[position]
+        return doc_type, source
+
+
+##
+## @brief      The client. Each index is an object like DocumentList: sized,
+##             iterable over (doc type, _id, _source) and with get(_id). The
+##             _source dicts must stay the same objects for the lifetime of
+##             the client.
+##
+class InMemoryElasticsearch(object):
+    def __init__(self, indexes=None):
+        # index -> DocumentList or the like
+        self.indexes = dict(indexes or {})
+        self.indices = _Indices(self)
+        self.transport = _Transport()
+        self._matcher = _Matcher()
+        # scroll_id -> (hits, position, size, source, expiry time), least
+        # recently used first
+        self._scrolls = collections.OrderedDict()
+        self._scrolls_lock = threading.Lock()
+        self._scroll_ids = itertools.count()
+
+    def info(self, **params):
+        return {'name': 'memory', 'cluster_name': 'memory',
+                'version': {'number': elasticsearch.__versionstr__}}
+
+    def _resolve(self, index, ignore_unavailable=False):
+        if isinstance(index, (list, tuple)):
+            index = ','.join(index)
+        names = []
+        for pattern in (index or '*').split(','):
+            if '*' in pattern:
+                names.extend(sorted(fnmatch.filter(self.indexes, pattern)))
+            elif pattern in self.indexes:
+                names.append(pattern)
+            elif not ignore_unavailable:
+                raise _not_found(pattern)
+        return names
+
+    @staticmethod
+    def _source(doc, source):
+        if source is None or source is True:
+            return dict(doc)
+        if source is False:
+            return None
+        if isinstance(source, str):
+            source = [source]
+        if isinstance(source, list):
+            source = {'includes': source}
+        return utils.filter_source(doc, source.get('includes'),
+                                   source.get('excludes'))
+
+    @staticmethod
+    def _source_param(params):
+        includes = params.get('_source_include')
+        excludes = params.get('_source_exclude')
+        if includes is None and excludes is None:
+            return None
+        return {'includes': includes.split(',') if includes else None,
+                'excludes': excludes.split(',') if excludes else None}
+
+    @staticmethod
+    def _sort_values(sort, index, doc_type, doc_id, doc):
+        values = []
+        for field, order in sort:
+            if field == '_score':
+                value = 1.0
+            elif field == '_uid':
+                value = '{}#{}'.format(doc_type, doc_id)
+            elif field == '_index':
+                value = index
+            else:
+                found = _values(doc, field)
+                value = min(found) if found else None
+            values.append(value)
+        return values
+
+    @staticmethod
+    def _compare(sort, a, b):
+        for (field, order), x, y in zip(sort, a, b):
+            if x == y:
+                continue
+            # Missing values go last in both orders
+            if x is None or y is None:
+                return 1 if x is None else -1
+            result = -1 if x < y else 1
+            return -result if order == 'desc' else result
+        return 0
+
+    @staticmethod
+    def _parse_sort(sort):
+        parsed = []
+        for item in sort or []:
+            if item == '_doc':
+                # The index order
+                continue
+            if isinstance(item, str):
+                parsed.append((item, 'desc' if item == '_score' else 'asc'))
+            else:
+                (field, order), = item.items()
+                if isinstance(order, dict):
+                    order = order.get('order', 'asc')
+                parsed.append((field, order))
+        return parsed
+
+    def _find(self, index, doc_type, body):
+        query = body.get('query', {'match_all': {}})
+        sort = body.get('sort', [])
+        sort = self._parse_sort(sort if isinstance(sort, list) else [sort])
+        doc_types = doc_type
+        if isinstance(doc_type, str):
+            doc_types = doc_type.split(',')
+        hits = []
+        for name in self._resolve(index):
+            for entry_type, doc_id, doc in self.indexes[name]:
+                if doc_type and entry_type not in doc_types:
+                    continue
+                if self._matcher.matches(doc, query):
+                    hits.append((name, entry_type, doc_id, doc))
+        if sort:
+            keyed = [(self._sort_values(sort, *hit), hit) for hit in hits]
+            keyed.sort(key=functools.cmp_to_key(
+                lambda a, b: self._compare(sort, a[0], b[0])))
+            after = body.get('search_after')
+            if after is not None:
+                keyed = [(values, hit) for values, hit in keyed
+                         if self._compare(sort, values, after) > 0]
+            return keyed
+        return [(None, hit) for hit in hits]
+
+    def _hit(self, hit, sort_values, source):
+        index, doc_type, doc_id, doc = hit
+        result = {'_index': index, '_type': doc_type, '_id': doc_id,
+                  '_score': None if sort_values else 1.0}
+        _source = self._source(doc, source)
+        if _source is not None:
+            result['_source'] = _source
+        if sort_values is not None:
+            result['sort'] = sort_values
+        return result
+
+    # The aggregations the stand-in computes, the ones the endpoints use
+    _AGGREGATIONS = ('terms', 'max', 'min', 'avg', 'sum', 'value_count',
+                     'percentiles')
+
+    def _aggregate(self, aggs, docs):
+        results = {}
+        for name, agg in (aggs or {}).items():
+            agg = dict(agg)
+            sub_aggs = agg.pop('aggs', agg.pop('aggregations', None))
+            (kind, params), = agg.items()
+            if kind not in self._AGGREGATIONS:
+                # Answered like a cluster answers an unknown aggregation
+                raise _parsing_error(
+                    'Could not find aggregator type [{}] in [{}]'.format(
+                        kind, name))
+            # The keyword subfields of the dynamic mapping hold the same
+            # values
+            field = params['field']
+            if field.endswith('.keyword'):
+                field = field[:-len('.keyword')]
+            if kind == 'terms':
+                results[name] = self._terms_agg(field, params, sub_aggs, docs)
+                continue
+            values = [_as_number(value) for doc in docs
+                      for value in _values(doc, field)]
+            if kind == 'max':
+                results[name] = {'value': max(values, default=None)}
+            elif kind == 'min':
+                results[name] = {'value': min(values, default=None)}
+            elif kind == 'avg':
+                results[name] = {'value': sum(values) / len(values)
+                                 if values else None}
+            elif kind == 'sum':
+                results[name] = {'value': sum(values)}
+            elif kind == 'value_count':
+                results[name] = {'value': len(values)}
+            elif kind == 'percentiles':
+                results[name] = {'values': {
+                    str(float(percent)): _percentile(sorted(values), percent)
+                    for percent in params.get('percents',
+                                              [1, 5, 25, 50, 75, 95, 99])}}
+        return results
+
+    def _terms_agg(self, field, params, sub_aggs, docs):
+        groups = {}
+        for doc in docs:
+            # A document counts once per distinct value
+            for value in set(_values(doc, field)):
+                groups.setdefault(value, []).append(doc)
+        (order_key, order), = params.get('order', {'_count': 'desc'}).items()
+        if order_key in ('_term', '_key'):
+            keys = sorted(groups, reverse=order == 'desc')
+        else:
+            keys = sorted(groups, key=lambda key: (
+                -len(groups[key]) if order == 'desc' else len(groups[key]),
+                key))
+        size = params.get('size', 10)
+        buckets = []
+        for key in keys[:size]:
+            bucket = {'key': key, 'doc_count': len(groups[key])}
+            bucket.update(self._aggregate(sub_aggs, groups[key]))
+            buckets.append(bucket)
+        return {'doc_count_error_upper_bound': 0,
+                'sum_other_doc_count': sum(len(groups[key])
+                                           for key in keys[size:]),
+                'buckets': buckets}
+
+    def _search(self, index, doc_type, body, params):
+        start = time.perf_counter()
+        body = body or {}
+        hits = self._find(index, doc_type, body)
+        size = int(params.get('size', body.get('size', 10)))
+        offset = int(body.get('from', 0))
+        source = body.get('_source', self._source_param(params))
+        response = {
+            'took': 0,
+            'timed_out': False,
+            '_shards': {'total': 1, 'successful': 1, 'failed': 0},
+            'hits': {
+                'total': len(hits),
+                'max_score': None,
+                'hits': [self._hit(hit, sort_values, source) for
+                         sort_values, hit in hits[offset:offset + size]],
+            },
+        }
+        aggs = body.get('aggs', body.get('aggregations'))
+        if aggs:
+            response['aggregations'] = self._aggregate(
+                aggs, [hit[3] for _, hit in hits])
+        if 'scroll' in params:
+            scroll_id = str(next(self._scroll_ids))
+            self._keep_scroll(scroll_id, (hits, offset + size, size, source),
+                              params['scroll'])
+            response['_scroll_id'] = scroll_id
+        response['took'] = int((time.perf_counter() - start) * 1000)
+        return response
+
+    def search(self, index=None, doc_type=None, body=None, **params):
+        return self._search(index, doc_type, body, params)
+
+    ##
+    ## @brief      Keeps the state of a scroll until its keep-alive expires,
+    ##             dropping the expired scrolls and, past MAX_SCROLLS, the
+    ##             least recently used ones.
+    ##
+    def _keep_scroll(self, scroll_id, state, keep_alive):
+        now = time.monotonic()
+        expires_at = now + _parse_time(keep_alive)
+        with self._scrolls_lock:
+            for expired in [key for key, value in self._scrolls.items()
+                            if value[-1] <= now]:
+                del self._scrolls[expired]
+            self._scrolls[scroll_id] = state + (expires_at,)
+            self._scrolls.move_to_end(scroll_id)
+            while len(self._scrolls) > MAX_SCROLLS:
+                self._scrolls.popitem(last=False)
+
+    def scroll(self, scroll_id=None, body=None, **params):
+        if scroll_id is None:
+            scroll_id = body['scroll_id']
+        with self._scrolls_lock:
+            state = self._scrolls.pop(scroll_id, None)
+        if state is None or state[-1] <= time.monotonic():
+            raise elasticsearch.exceptions.NotFoundError(
+                404, 'search_context_missing_exception', {'status': 404})
+        hits, position, size, source, _ = state
+        self._keep_scroll(scroll_id, (hits, position + size, size, source),
+                          params.get('scroll'))
+        return {
+            '_scroll_id': scroll_id,
+            'took': 0,
+            'timed_out': False,
+            '_shards': {'total': 1, 'successful': 1, 'failed': 0},
+            'hits': {
+                'total': len(hits),
+                'max_score': None,
+                'hits': [self._hit(hit, sort_values, source) for
+                         sort_values, hit in hits[position:position + size]],
+            },
+        }
+
+    def clear_scroll(self, scroll_id=None, body=None, **params):
+        if scroll_id is None:
+            scroll_id = body['scroll_id']
+        with self._scrolls_lock:
+            for scroll_id in scroll_id if isinstance(scroll_id, list) \
+                    else [scroll_id]:
+                self._scrolls.pop(scroll_id, None)
+        return {'succeeded': True}
+
+    def _get(self, index, doc_type, doc_id, source):
+        if index not in self.indexes:
+            return _not_found(index).info
+        entry = self.indexes[index].get(doc_id)
+        if entry is None:
+            return {'_index': index, '_type': doc_type, '_id': doc_id,
+                    'found': False}
+        entry_type, doc = entry
+        result = {'_index': index, '_type': entry_type, '_id': doc_id,
+                  '_version': 1, 'found': True}
+        _source = self._source(doc, source)
+        if _source is not None:
+            result['_source'] = _source
+        return result
+
+    def get(self, index, id, doc_type='_all', **params):
+        doc = self._get(index, doc_type, id, self._source_param(params))
+        if not doc.get('found'):
+            raise elasticsearch.exceptions.NotFoundError(404, 'not found', doc)
+        return doc
+
+    def mget(self, body, index=None, doc_type=None, **params):
+        return {'docs': [self._get(doc['_index'], doc.get('_type'),
+                                   doc['_id'], doc.get('_source'))
+                         for doc in body['docs']]}
+
+    def msearch(self, body, index=None, doc_type=None, **params):
+        responses = []
+        for header, search_body in zip(body[::2], body[1::2]):
+            try:
+                responses.append(self._search(header.get('index', index),
+                                              header.get('type', doc_type),
+                                              search_body, {}))
+            except elasticsearch.exceptions.TransportError as e:
+                responses.append(e.info)
+        return {'responses': responses}
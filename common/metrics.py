@@ -0,0 +1,316 @@
+# @file metrics.py
+# @brief Latency histograms and counters of the requests served by a worker,
+#        and gauges of its caches and ES connections, rendered in the
+#        Prometheus text format by the /metrics endpoint. Each worker keeps
+#        its own metrics, a scraper tells them apart by instance.
+# @author Justin Chu (justinchuby@cmu.edu)
+
+import threading
+import time
+
+from flask import g, has_request_context, request
+
+from common import cache, connection, singleflight
+
+# Upper bounds of the latency buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# The key of the WSGI environ holding the time a request came in
+START_KEY = 'courseapi.start'
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Histogram(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # The last count is of the values above every bucket (+Inf)
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+##
+## @brief      The histograms and counters of a worker, keyed by name and
+##             labels, along with the functions reading its gauges.
+##
+class Registry(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        # name -> (type, help)
+        self._meta = {}
+        # name -> {labels: Histogram or number}
+        self._series = {}
+        self._collectors = []
+
+    def _describe(self, name, kind, help_text):
+        if name not in self._meta:
+            self._meta[name] = (kind, help_text)
+            self._series[name] = {}
+        return self._series[name]
+
+    ##
+    ## @brief      Adds a value to a histogram.
+    ##
+    ## @param      labels  A tuple of (label, value) pairs
+    ##
+    def observe(self, name, value, labels=(), help_text=''):
+        with self._lock:
+            series = self._describe(name, 'histogram', help_text)
+            histogram = series.get(labels)
+            if histogram is None:
+                histogram = series[labels] = Histogram()
+            histogram.observe(value)
+
+    ##
+    ## @brief      Adds to a counter, or to a gauge if kind is gauge.
+    ##
+    def inc(self, name, value=1, labels=(), help_text='', kind='counter'):
+        with self._lock:
+            series = self._describe(name, kind, help_text)
+            series[labels] = series.get(labels, 0) + value
+
+    ##
+    ## @brief      Registers a function reading gauges or counters kept
+    ##             elsewhere when the metrics are rendered.
+    ##
+    ## @param      collect  (function) Returns a list of (name, type, help,
+    ##                      [(labels, value)]) tuples
+    ##
+    def add_collector(self, collect):
+        self._collectors.append(collect)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name in sorted(self._meta):
+                kind, help_text = self._meta[name]
+                _render_header(lines, name, kind, help_text)
+                for labels, value in sorted(self._series[name].items()):
+                    if kind == 'histogram':
+                        _render_histogram(lines, name, labels, value)
+                    else:
+                        lines.append(_sample(name, labels, value))
+        for collect in self._collectors:
+            for name, kind, help_text, samples in collect():
+                _render_header(lines, name, kind, help_text)
+                for labels, value in samples:
+                    lines.append(_sample(name, labels, value))
+        return '\n'.join(lines) + '\n'
+
+
+def _render_header(lines, name, kind, help_text):
+    if help_text:
+        lines.append('# HELP {} {}'.format(name, help_text))
+    lines.append('# TYPE {} {}'.format(name, kind))
+
+
+def _render_histogram(lines, name, labels, histogram):
+    cumulative = 0
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        cumulative += count
+        lines.append(_sample(name + '_bucket', labels + (('le', bound),),
+                             cumulative))
+    lines.append(_sample(name + '_bucket', labels + (('le', '+Inf'),),
+                         histogram.count))
+    lines.append(_sample(name + '_sum', labels, histogram.sum))
+    lines.append(_sample(name + '_count', labels, histogram.count))
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"')\
+                     .replace('\n', r'\n')
+
+
+def _sample(name, labels, value):
+    if labels:
+        name += '{' + ','.join('{}="{}"'.format(label, _escape(label_value))
+                               for label, label_value in labels) + '}'
+    return '{} {}'.format(name, value)
+
+
+_registry = Registry()
+
+
+##
+## @brief      Gets the endpoint of the request being served by this thread,
+##             e.g. resources.course.instructor.
+##
+def current_endpoint():
+    if has_request_context() and request.endpoint is not None:
+        return request.endpoint
+    return 'none'
+
+
+##
+## @brief      Records the duration of a phase of the current request:
+##             routing, query (generating the ES query), es (the ES round
+##             trip), to_dict (turning the hits into dicts) or serialize
+##             (writing the JSON body).
+##
+def observe_phase(phase, seconds):
+    _registry.observe('courseapi_phase_seconds', seconds,
+                      (('endpoint', current_endpoint()), ('phase', phase)),
+                      'Time spent in each phase of the requests')
+
+
+##
+## @brief      Times the block of a with statement as a phase of the current
+##             request.
+##
+class timer(object):
+    def __init__(self, phase):
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        observe_phase(self.phase, time.perf_counter() - self.start)
+        return False
+
+
+##
+## @brief      Records an ES request: its wall time, as seen by the worker,
+##             and the time ES reports it took (took), so that the time spent
+##             on the network, in the queues and in (de)serializing shows as
+##             the difference.
+##
+## @param      operation  (str) e.g. fetch, fetch_many, scroll
+## @param      took       (int) The took of the response in milliseconds, or
+##                        None if it has none (GET, errors)
+##
+def observe_es(operation, seconds, took=None):
+    observe_phase('es', seconds)
+    labels = (('operation', operation),)
+    _registry.observe('courseapi_es_wall_seconds', seconds, labels,
+                      'Wall time of the ES requests')
+    if took is not None:
+        _registry.observe('courseapi_es_took_seconds', took / 1000.0, labels,
+                          'Time ES reports the requests took')
+
+
+##
+## @brief      Wraps a WSGI app to record when each request comes in, before
+##             Flask routes it.
+##
+def wsgi_middleware(wsgi_app):
+    def app(environ, start_response):
+        environ[START_KEY] = time.perf_counter()
+        return wsgi_app(environ, start_response)
+    return app
+
+
+##
+## @brief      Called first thing by the before_request handlers.
+##
+def start_request():
+    now = time.perf_counter()
+    g.metrics_start = request.environ.get(START_KEY, now)
+    observe_phase('routing', now - g.metrics_start)
+    _registry.inc('courseapi_in_flight_requests', 1,
+                  help_text='Requests being served', kind='gauge')
+
+
+##
+## @brief      Called by the after_request handlers with the response.
+##             Streamed responses are timed until their first chunk.
+##
+def end_request(response):
+    start = g.get('metrics_start')
+    if start is None:
+        return
+    endpoint = current_endpoint()
+    _registry.observe('courseapi_request_seconds',
+                      time.perf_counter() - start, (('endpoint', endpoint),),
+                      'Time to answer the requests')
+    _registry.inc('courseapi_requests_total', 1,
+                  (('endpoint', endpoint),
+                   ('status', response.status_code)),
+                  'Requests answered')
+
+
+##
+## @brief      Called by the teardown_request handlers, even when the request
+##             failed.
+##
+def finish_request():
+    if g.pop('metrics_start', None) is not None:
+        _registry.inc('courseapi_in_flight_requests', -1, kind='gauge')
+
+
+def _cache_samples(name, stats):
+    samples = []
+    for tier, tier_stats in stats:
+        samples.append(((('tier', tier),), tier_stats.get(name, 0)))
+    return samples
+
+
+def _collect_cache():
+    stats = cache.stats()
+    tiers = [('local', stats)]
+    if 'shared' in stats:
+        shared = dict(stats['shared'])
+        # Stale entries are still served
+        shared['hits'] = shared['hits'] + shared['stale_hits']
+        tiers.append(('shared', shared))
+    ratios = []
+    for tier, tier_stats in tiers:
+        lookups = tier_stats['hits'] + tier_stats['misses']
+        ratios.append(((('tier', tier),),
+                       tier_stats['hits'] / lookups if lookups else 0))
+    return [
+        ('courseapi_cache_hits_total', 'counter', 'Cache hits',
+         _cache_samples('hits', tiers)),
+        ('courseapi_cache_misses_total', 'counter', 'Cache misses',
+         _cache_samples('misses', tiers)),
+        ('courseapi_cache_hit_ratio', 'gauge',
+         'Share of the cache lookups that hit', ratios),
+        ('courseapi_cache_entries', 'gauge', 'Entries of the local cache',
+         [((), stats['size'])]),
+    ]
+
+
+def _collect_single_flight():
+    stats = singleflight.stats()
+    return [
+        ('courseapi_single_flight_calls_total', 'counter',
+         'Searches sent to ES through the single-flight layer',
+         [((), stats['calls'])]),
+        ('courseapi_single_flight_coalesced_total', 'counter',
+         'Searches answered by an identical one in flight',
+         [((), stats['coalesced'])]),
+        ('courseapi_single_flight_in_flight', 'gauge',
+         'Distinct searches in flight', [((), stats['in_flight'])]),
+        ('courseapi_single_flight_waiting', 'gauge',
+         'Searches waiting for an identical one', [((), stats['waiting'])]),
+    ]
+
+
+def _collect_pools():
+    samples = []
+    for pool in connection.get_pool_stats():
+        for state in ('in_use', 'idle'):
+            samples.append(((('host', pool['host']), ('state', state)),
+                            pool[state]))
+    return [('courseapi_es_pool_connections', 'gauge',
+             'Connections of the ES connection pools', samples)]
+
+
+_registry.add_collector(_collect_cache)
+_registry.add_collector(_collect_single_flight)
+_registry.add_collector(_collect_pools)
+
+
+def render():
+    return _registry.render()
@@ -0,0 +1,114 @@
+# @file query_template.py
+# @brief Compiled query templates. The query of each shape (the parts a
+#        request asks for, e.g. an instructor only, or a building and a room)
+#        is built once with elasticsearch_dsl, with placeholders in place of
+#        the values, and serialized. A request then only fills its values
+#        into the compiled skeleton, skipping the Q() trees and to_dict().
+# @author Justin Chu (justinchuby@cmu.edu)
+
+import threading
+
+
+##
+## @brief      A placeholder for the value named name.
+##
+class Param(object):
+    __slots__ = ['name']
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return '<Param {}>'.format(self.name)
+
+
+def _has_param(node):
+    if isinstance(node, Param):
+        return True
+    if isinstance(node, dict):
+        return any(_has_param(value) for value in node.values())
+    if isinstance(node, (list, tuple)):
+        return any(_has_param(value) for value in node)
+    return False
+
+
+##
+## @brief      Compiles a skeleton into a function of the values giving the
+##             query. The parts without placeholders are built once and
+##             shared by all the queries.
+##
+def _compile(node):
+    if isinstance(node, Param):
+        name = node.name
+        return lambda values: values[name]
+    if not _has_param(node):
+        return lambda values: node
+    if isinstance(node, dict):
+        items = [(key, _compile(value)) for key, value in node.items()]
+        return lambda values: {key: render(values) for key, render in items}
+    renders = [_compile(value) for value in node]
+    return lambda values: [render(values) for render in renders]
+
+
+##
+## @brief      The compiled query of a shape.
+##
+class QueryTemplate(object):
+    ##
+    ## @param      skeleton  (dict) The query with Param in place of the
+    ##                       values
+    ##
+    def __init__(self, skeleton):
+        self.skeleton = skeleton
+        self._render = _compile(skeleton)
+
+    ##
+    ## @brief      Fills the values into the skeleton.
+    ##
+    ## @param      values  (dict) name -> value of each Param
+    ##
+    ## @return     (dict) The query. The parts without values are shared with
+    ##             the other queries of the template: do not modify it.
+    ##
+    def render(self, values):
+        return self._render(values)
+
+
+##
+## @brief      The templates of a searcher, compiled the first time their
+##             shape is seen.
+##
+class Templates(object):
+    def __init__(self):
+        # shape -> QueryTemplate
+        self._templates = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._templates)
+
+    ##
+    ## @brief      Renders the query of a shape.
+    ##
+    ## @param      shape   (tuple) Identifies the structure of the query
+    ## @param      values  (dict) The values of the query
+    ## @param      build   The function of (shape, values) building the query
+    ##                     with the DSL. It is called once per shape, with
+    ##                     Param in place of the values.
+    ##
+    ## @return     (dict) The query, as given by build(shape, values).to_dict()
+    ##
+    def render(self, shape, values, build):
+        template = self._templates.get(shape)
+        if template is None:
+            with self._lock:
+                template = self._templates.get(shape)
+                if template is None:
+                    params = {name: Param(name) for name in values}
+                    template = QueryTemplate(build(shape, params).to_dict())
+                    self._templates[shape] = template
+        return template.render(values)
+
+    def clear(self):
+        with self._lock:
+            self._templates.clear()
@@ -1,19 +1,40 @@
 import re
 import copy
+import concurrent.futures
 import json
+import itertools
 import arrow
-import datetime
+import time
+
+from flask import copy_current_request_context, has_request_context
 
 # Elasticsearch libraries, certifi required by Elasticsearch
 import elasticsearch
-from elasticsearch_dsl import Search
+import elasticsearch.helpers
+from elasticsearch_dsl import MultiSearch, Search
 from elasticsearch_dsl.query import Q
+from elasticsearch_dsl.response import Response
 from elasticsearch_dsl.connections import connections
 import certifi
 
-from common import Message, utils
+from common import Message, aio, cache, connection, local_index,\
+                   metrics, query_template, singleflight, term_snapshot, utils
 import config
-from config.es_config import ES_COURSE_INDEX_PREFIX, ES_FCE_INDEX
+import config.course
+import config.fce
+import config.settings
+from config.es_config import ES_COURSE_INDEX_PREFIX, ES_FCE_INDEX,\
+                             ES_REQUEST_TIMEOUTS, ES_TIMEOUT
+
+# Sorts of the pages of results, which must be total so that search_after
+# neither skips nor repeats a hit. _uid (type#id) is only unique within an
+# index: the same course is in the index of each term it is given in, so the
+# course sorts, which may span the course-* indexes, break the ties with
+# _index first. The cursors hold the values of every field of the sort. The
+# FCEs are in a single index.
+COURSE_PAGE_SORT = ['id', '_index', '_uid']
+SEARCH_PAGE_SORT = ['_score', '_index', '_uid']
+FCE_PAGE_SORT = ['-year', '_uid']
 
 
 ##
@@ -22,6 +43,8 @@ from config.es_config import ES_COURSE_INDEX_PREFIX, ES_FCE_INDEX
 class Searcher(object):
     _doc_type = None
     _default_size = 5
+    # The compiled queries of each shape
+    _templates = query_template.Templates()
 
     #
     # @brief      init
@@ -31,13 +54,26 @@ class Searcher(object):
     # @param      index      The index
     # @param      size       The size
     # @param      sort       sort is either None or a list
+    # @param      timeout    The request timeout in seconds, None to use the
+    #                        default timeout of the connection
+    # @param      source     The _source filter given by get_source_filter(),
+    #                        None to get the whole documents
+    # @param      search_after  The sort values of the last hit of the
+    #                        previous page, to get the next page
+    # @param      aggs       (dict) The aggregations computed over the hits,
+    #                        in the ES syntax
     #
-    def __init__(self, raw_query, index=None, size=_default_size, sort=None):
+    def __init__(self, raw_query, index=None, size=_default_size, sort=None,
+                 timeout=None, source=None, search_after=None, aggs=None):
         self.raw_query = copy.deepcopy(raw_query)
         self.index = index
         self.size = size
         self.doc_type = self._doc_type
         self.sort = sort
+        self.timeout = timeout
+        self.source = source
+        self.search_after = search_after
+        self.aggs = aggs
 
     def __repr__(self):
         return "<Searcher Object: raw_query={}>".format(repr(self.raw_query))
@@ -51,19 +87,323 @@ class Searcher(object):
         self._index = value
 
     def execute(self):
-        response = self.fetch(self.generate_query(), self.index,
+        response = self.execute_local()
+        if response is not None:
+            return response
+
+        # Identical requests in flight in other threads are waited for
+        query = self._generate_query()
+        return singleflight.do(self._flight_key(query),
+                               lambda: self._execute_remote(query))
+
+    def _execute_remote(self, query):
+        doc_id = self.doc_id()
+        if doc_id is not None:
+            # Realtime GET of the document, skipping the query and scoring
+            # phases of a search
+            response = self._call(self.fetch_by_id, doc_id, self.index,
+                                  doc_type=self.doc_type,
+                                  timeout=self.timeout, source=self.source)
+            if not self._needs_search_fallback(response):
+                return response
+
+        response = self._call(self.fetch, query, self.index,
                               size=self.size, doc_type=self.doc_type,
-                              sort=self.sort)
+                              sort=self.sort, timeout=self.timeout,
+                              source=self.source,
+                              search_after=self.search_after,
+                              aggs=self.aggs)
         # if config.settings.DEBUG:
         #     print("[DEBUG] ES response:")
         #     print(json.dumps(response.to_dict(), indent=2))
         return response
 
+    ##
+    # @brief      Same as execute(), with the async client of common/aio.py,
+    #             to be awaited on the event loop of asgi.py. Identical
+    #             requests are not coalesced. Without an async client, e.g.
+    #             with the snapshot backend, same as execute().
+    ##
+    async def execute_async(self):
+        response = self.execute_local()
+        if response is not None:
+            return response
+        if not aio.has_client():
+            return self.execute()
+
+        doc_id = self.doc_id()
+        if doc_id is not None:
+            response = await self._call_async(
+                self.fetch_by_id_async, doc_id, self.index,
+                doc_type=self.doc_type, timeout=self.timeout,
+                source=self.source)
+            if not self._needs_search_fallback(response):
+                return response
+
+        return await self._call_async(
+            self.fetch_async, self._generate_query(), self.index,
+            size=self.size, doc_type=self.doc_type, sort=self.sort,
+            timeout=self.timeout, source=self.source,
+            search_after=self.search_after, aggs=self.aggs)
+
+    # @brief  Identifies the ES request made by execute()
+    def _flight_key(self, query):
+        return json.dumps([self.index, self.doc_type,
+                           self.query_to_dict(query),
+                           self.size, self.sort, self.source,
+                           self.search_after, self.timeout, self.aggs],
+                          sort_keys=True, default=str)
+
+    # @brief  Calls a fetch function, timing its ES request
+    @staticmethod
+    def _call(fetch, *args, **kwargs):
+        start = time.perf_counter()
+        response = fetch(*args, **kwargs)
+        Searcher._observe(fetch.__name__, start, response)
+        return response
+
+    # @brief  Same as _call(), with an async fetch function
+    @staticmethod
+    async def _call_async(fetch, *args, **kwargs):
+        start = time.perf_counter()
+        response = await fetch(*args, **kwargs)
+        # Timed under the name of the blocking fetch function
+        Searcher._observe(fetch.__name__[:-len('_async')], start, response)
+        return response
+
+    @staticmethod
+    def _observe(operation, start, response):
+        # GET and _mget report no took
+        took = None
+        if operation in ('fetch', 'fetch_many'):
+            took = Searcher._took(response)
+        metrics.observe_es(operation, time.perf_counter() - start, took)
+
+    # @brief  The took of a response, or the longest one of a list of
+    #         responses, in milliseconds. None if ES did not report it.
+    @staticmethod
+    def _took(response):
+        if isinstance(response, list):
+            took = [Searcher._took(r) for r in response]
+            return max((t for t in took if t is not None), default=None)
+        if isinstance(response, Response) and 'took' in response:
+            return response.took
+        return None
+
+    ##
+    # @brief      Answers the query without going to ES, if possible.
+    ##
+    # @return     (Response) or None if the query has to be sent to ES.
+    ##
+    def execute_local(self):
+        return None
+
+    ##
+    # @brief      Gets the _id of the only document the query can match.
+    ##
+    # @return     (str) or None if the query has to be run as a search.
+    ##
+    def doc_id(self):
+        return None
+
+    @staticmethod
+    def _needs_search_fallback(response):
+        return (config.course.COURSE_GET_FALLBACK and
+                not has_error(response) and response.hits.total == 0)
+
+    ##
+    # @brief      Executes many searchers with a single _mget request for the
+    #             documents fetched by _id and a single _msearch request for
+    #             the others.
+    ##
+    # @param      searchers  A list of Searcher objects
+    ##
+    # @return     A list of responses in the same order, each one being what
+    #             Searcher.execute() would return.
+    ##
+    @staticmethod
+    def execute_many(searchers):
+        responses = [searcher.execute_local() for searcher in searchers]
+        timeouts = [searcher.timeout for searcher in searchers
+                    if searcher.timeout]
+        timeout = max(timeouts, default=None)
+
+        by_id = [i for i, response in enumerate(responses)
+                 if response is None and searchers[i].doc_id() is not None]
+        if by_id:
+            docs = [(searchers[i].doc_id(), searchers[i].index,
+                     searchers[i].doc_type, searchers[i].source)
+                    for i in by_id]
+            fetched = Searcher._call(Searcher.fetch_many_by_id, docs,
+                                     timeout=timeout)
+            for i, response in zip(by_id, fetched):
+                if not Searcher._needs_search_fallback(response):
+                    responses[i] = response
+
+        pending = [i for i, response in enumerate(responses)
+                   if response is None]
+        if pending:
+            searches = []
+            for i in pending:
+                searcher = searchers[i]
+                searches.append(Searcher.build_search(
+                    searcher._generate_query(), searcher.index,
+                    size=searcher.size, doc_type=searcher.doc_type,
+                    sort=searcher.sort, source=searcher.source,
+                    search_after=searcher.search_after, aggs=searcher.aggs))
+            fetched = Searcher._call(Searcher.fetch_many, searches,
+                                     timeout=timeout)
+            for i, response in zip(pending, fetched):
+                responses[i] = response
+        return responses
+
     @staticmethod
-    def fetch(query, index, size=5, doc_type=None, sort=None):
-        s = Search(index=index, doc_type=doc_type).query(query).extra(size=size)
+    def _msearch_responses(searches, raw):
+        responses = []
+        for s, r in zip(searches, raw['responses']):
+            if 'error' in r:
+                # Same as the info of the exception a single search raises
+                responses.append({'status': r.get('status', 500),
+                                  'error': r['error']})
+            else:
+                responses.append(Response(s, r))
+        return responses
+
+    @staticmethod
+    def fetch_many(searches, timeout=None):
+        ms = MultiSearch()
+        for s in searches:
+            ms = ms.add(s)
+        params = {'request_timeout': timeout} if timeout else {}
+        try:
+            raw = connections.get_connection().msearch(body=ms.to_dict(),
+                                                       **params)
+        except elasticsearch.exceptions.TransportError as e:
+            return [e.info] * len(searches)
+        return Searcher._msearch_responses(searches, raw)
+
+    ##
+    # @brief      Turns a document returned by GET or _mget into a response
+    #             with zero or one hit, like the one of a search.
+    ##
+    @staticmethod
+    def _doc_response(doc, index, doc_type):
+        if 'error' in doc:
+            error = doc['error']
+            status = 500
+            if isinstance(error, dict) and \
+                    error.get('type') == 'index_not_found_exception':
+                status = 404
+            return {'status': status, 'error': error}
+        hits = []
+        if doc.get('found'):
+            hits.append({'_index': doc['_index'], '_type': doc['_type'],
+                         '_id': doc['_id'], '_score': None,
+                         '_source': doc['_source']})
+        return local_index.make_response(index, doc_type, hits, len(hits))
+
+    @staticmethod
+    def fetch_by_id(doc_id, index, doc_type=None, timeout=None, source=None):
+        params = {'realtime': True}
+        if timeout:
+            params['request_timeout'] = timeout
+        if source:
+            params.update(Searcher._source_params(source))
+        try:
+            doc = connections.get_connection().get(
+                index=index, doc_type=doc_type or '_all', id=doc_id, **params)
+        except elasticsearch.exceptions.NotFoundError as e:
+            # A missing document gives {"found": false}, a missing index
+            # gives an error
+            doc = e.info if isinstance(e.info, dict) else {'found': False}
+        except elasticsearch.exceptions.TransportError as e:
+            return e.info
+        return Searcher._doc_response(doc, index, doc_type)
+
+    # @brief  Same as fetch_by_id(), with the async client
+    @staticmethod
+    async def fetch_by_id_async(doc_id, index, doc_type=None, timeout=None,
+                                source=None):
+        params = {'realtime': True}
+        if timeout:
+            params['request_timeout'] = timeout
+        if source:
+            params.update(Searcher._source_params(source))
+        try:
+            doc = await aio.get_client().get(
+                index=index, doc_type=doc_type or '_all', id=doc_id, **params)
+        except elasticsearch.exceptions.NotFoundError as e:
+            doc = e.info if isinstance(e.info, dict) else {'found': False}
+        except elasticsearch.exceptions.TransportError as e:
+            return e.info
+        return Searcher._doc_response(doc, index, doc_type)
+
+    ##
+    # @brief      Fetches many documents by _id with a single _mget request.
+    ##
+    # @param      docs  A list of (_id, index, doc_type, source) tuples
+    ##
+    @staticmethod
+    def fetch_many_by_id(docs, timeout=None):
+        body = Searcher._mget_body(docs)
+        params = {'realtime': True}
+        if timeout:
+            params['request_timeout'] = timeout
+        try:
+            raw = connections.get_connection().mget(body=body, **params)
+        except elasticsearch.exceptions.TransportError as e:
+            return [e.info] * len(docs)
+        return [Searcher._doc_response(doc, index, doc_type)
+                for doc, (_, index, doc_type, _) in zip(raw['docs'], docs)]
+
+    @staticmethod
+    def _mget_body(docs):
+        body = {'docs': []}
+        for doc_id, index, doc_type, source in docs:
+            doc = {'_index': index, '_type': doc_type or '_all', '_id': doc_id}
+            if source:
+                doc['_source'] = source
+            body['docs'].append(doc)
+        return body
+
+    # @brief  The query string parameters of GET for a _source filter
+    @staticmethod
+    def _source_params(source):
+        params = {}
+        if source.get('includes'):
+            params['_source_include'] = ','.join(source['includes'])
+        if source.get('excludes'):
+            params['_source_exclude'] = ','.join(source['excludes'])
+        return params
+
+    @staticmethod
+    def build_search(query, index, size=5, doc_type=None, sort=None,
+                     timeout=None, source=None, search_after=None, aggs=None):
+        s = Search(index=index, doc_type=doc_type).extra(size=size)
+        if isinstance(query, dict):
+            # Rendered from a template, sent as is rather than parsed back
+            # into a Q
+            s = s.extra(query=query)
+        else:
+            s = s.query(query)
         if sort:
             s = s.sort(*sort)
+        if search_after:
+            s = s.extra(search_after=search_after)
+        if aggs:
+            s = s.extra(aggs=aggs)
+        if source:
+            s = s.source(**source)
+        if timeout:
+            s = s.params(request_timeout=timeout)
+        return s
+
+    @staticmethod
+    def fetch(query, index, size=5, doc_type=None, sort=None, timeout=None,
+              source=None, search_after=None, aggs=None):
+        s = Searcher.build_search(query, index, size=size, doc_type=doc_type,
+                                  sort=sort, timeout=timeout, source=source,
+                                  search_after=search_after, aggs=aggs)
         try:
             response = s.execute()
         except elasticsearch.exceptions.NotFoundError as e:
@@ -78,22 +418,159 @@ class Searcher(object):
 
         return response
 
+    # @brief  Same as fetch(), with the async client
+    @staticmethod
+    async def fetch_async(query, index, size=5, doc_type=None, sort=None,
+                          timeout=None, source=None, search_after=None,
+                          aggs=None):
+        s = Searcher.build_search(query, index, size=size, doc_type=doc_type,
+                                  sort=sort, timeout=timeout, source=source,
+                                  search_after=search_after, aggs=aggs)
+        try:
+            raw = await aio.get_client().search(
+                index=s._index, doc_type=s._doc_type, body=s.to_dict(),
+                **s._params)
+        except elasticsearch.exceptions.TransportError as e:
+            return e.info
+        # Same as s.execute()
+        return s._response_class(s, raw)
+
+    ##
+    # @brief      Executes the query one page at a time with a scroll, so that
+    #             at most one page of hits is held in memory.
+    ##
+    # @param      page_size  The number of hits per page
+    # @param      scroll     How long ES keeps the scroll context between
+    #                        two pages, e.g. 1m
+    ##
+    # @return     A generator of responses holding the pages of the at most
+    #             self.size hits. An error is yielded as the last page.
+    ##
+    def scan_pages(self, page_size, scroll):
+        response = self.execute_local()
+        if response is not None:
+            # Already in memory
+            yield response
+            return
+
+        s = self.build_search(self._generate_query(), self.index,
+                              size=min(page_size, self.size),
+                              doc_type=self.doc_type, sort=self.sort,
+                              source=self.source)
+        params = {'request_timeout': self.timeout} if self.timeout else {}
+        es = connections.get_connection()
+        try:
+            start = time.perf_counter()
+            raw = es.search(index=self.index, doc_type=self.doc_type,
+                            body=s.to_dict(), scroll=scroll, **params)
+            metrics.observe_es('scan', time.perf_counter() - start,
+                               raw.get('took'))
+        except elasticsearch.exceptions.TransportError as e:
+            yield self._error_info(e)
+            return
+
+        scroll_id = raw.get('_scroll_id')
+        try:
+            hits = raw['hits']['hits'][:self.size]
+            raw['hits']['hits'] = hits
+            seen = len(hits)
+            yield Response(s, raw)
+            while hits and seen < self.size:
+                start = time.perf_counter()
+                raw = es.scroll(scroll_id=scroll_id, scroll=scroll, **params)
+                metrics.observe_es('scroll', time.perf_counter() - start,
+                                   raw.get('took'))
+                scroll_id = raw.get('_scroll_id', scroll_id)
+                hits = raw['hits']['hits'][:self.size - seen]
+                if not hits:
+                    break
+                raw['hits']['hits'] = hits
+                seen += len(hits)
+                yield Response(s, raw)
+        except elasticsearch.exceptions.TransportError as e:
+            yield self._error_info(e)
+        finally:
+            # Also run when the client goes away in the middle of a stream
+            if scroll_id is not None:
+                try:
+                    es.clear_scroll(scroll_id=scroll_id)
+                except elasticsearch.exceptions.TransportError:
+                    pass
+
+    # @brief  The info of an ES error as an error response. Connection
+    #         errors carry the underlying exception instead of a dict.
+    @staticmethod
+    def _error_info(e):
+        if isinstance(e.info, dict):
+            return e.info
+        status = e.status_code if isinstance(e.status_code, int) else 500
+        return {'status': status, 'error': e.error}
+
+    ##
+    # @brief      Reads the parameters of the query from the raw query.
+    ##
+    # @return     (shape, values): shape is a tuple naming the parts of the
+    #             query, which give its structure, and values a dict of the
+    #             values filled into them.
+    ##
+    def query_params(self):
+        return (), {}
+
+    ##
+    # @brief      Builds the query of a shape with the DSL.
+    ##
+    # @param      shape   The shape given by query_params()
+    # @param      values  The values given by query_params(), or the
+    #                     placeholders of a template
+    ##
+    # @return     (Q) The query.
+    ##
+    @classmethod
+    def build_query(cls, shape, values):
+        return Q()
+
     ##
     # @brief      Generate the query for the database.
     ##
-    # @return     (dict) The query for querying the database.
+    # @return     The query for querying the database: a dict rendered from
+    #             the compiled template of its shape, or a Q when
+    #             QUERY_TEMPLATES is off.
     ##
     def generate_query(self):
-        query = Q()
+        shape, values = self.query_params()
+        if config.settings.QUERY_TEMPLATES:
+            query = self._templates.render(shape, values, self.build_query)
+        else:
+            query = self.build_query(shape, values)
+
+        if config.settings.DEBUG:
+            print(json.dumps(self.query_to_dict(query), indent=2))
+            print("[DEBUG] max size: {}, index: {}".format(self.size, self.index))
         return query
 
+    # @brief  The query given by generate_query() as a dict
+    @staticmethod
+    def query_to_dict(query):
+        if isinstance(query, dict):
+            return query
+        return query.to_dict()
+
+    # @brief  generate_query(), timed as the query phase of the request
+    def _generate_query(self):
+        with metrics.timer('query'):
+            return self.generate_query()
+
 
 class FCESearcher(Searcher):
     _doc_type = 'fce'
     _default_size = 5
+    _templates = query_template.Templates()
 
-    def __init__(self, raw_query, index=None, size=_default_size, sort=None):
-        super().__init__(raw_query, index=index, size=size, sort=sort)
+    def __init__(self, raw_query, index=None, size=_default_size, sort=None,
+                 timeout=None, search_after=None, aggs=None):
+        super().__init__(raw_query, index=index, size=size, sort=sort,
+                         timeout=timeout, search_after=search_after,
+                         aggs=aggs)
 
     @property
     def index(self):
@@ -103,30 +580,50 @@ class FCESearcher(Searcher):
     def index(self, value):
         self._index = value
 
-    def generate_query(self):
+    def query_params(self):
         raw_query = self.raw_query
-        query = Q()
+        shape = []
+        values = {}
 
         if 'courseid' in raw_query:
-            courseid = raw_query['courseid'][0]
-            query &= Q('term', courseid=courseid)
+            shape.append('courseid')
+            values['courseid'] = raw_query['courseid'][0]
 
         if 'instructor' in raw_query:
-            instructor = raw_query['instructor'][0]
-            query &= Q('match', instructor={'query': instructor, 'operator': 'and'})
+            shape.append('instructor')
+            values['instructor'] = raw_query['instructor'][0]
+
+        if 'department' in raw_query:
+            shape.append('department')
+            values['department'] = raw_query['department'][0]
+
+        return tuple(shape), values
+
+    @classmethod
+    def build_query(cls, shape, values):
+        query = Q()
+
+        if 'courseid' in shape:
+            query &= Q('term', courseid=values['courseid'])
+
+        if 'instructor' in shape:
+            query &= Q('match', instructor={'query': values['instructor'], 'operator': 'and'})
+
+        if 'department' in shape:
+            query &= Q('match', department={'query': values['department'], 'operator': 'and'})
 
-        if config.settings.DEBUG:
-            print(json.dumps(query.to_dict(), indent=2))
-            print("[DEBUG] max size: {}, index: {}".format(self.size, self.index))
         return query
 
 
 class CourseSearcher(Searcher):
     _doc_type = 'course'
     _default_size = 5
+    _templates = query_template.Templates()
 
-    def __init__(self, raw_query, index=None, size=_default_size):
-        super().__init__(raw_query, index, size)
+    def __init__(self, raw_query, index=None, size=_default_size,
+                 timeout=None, source=None, sort=None, search_after=None):
+        super().__init__(raw_query, index, size, sort=sort, timeout=timeout,
+                         source=source, search_after=search_after)
 
     @property
     def index(self):
@@ -136,28 +633,108 @@ class CourseSearcher(Searcher):
     #               To the ES index
     @index.setter
     def index(self, value):
-        if value is None:
-            # Everything
-            self._index = ES_COURSE_INDEX_PREFIX + '*'
-        elif value == 'current':
-            # Current semester
-            self._index = utils.get_current_course_index()
-        elif re.match('^(f|s|m1|m2)\d{2}$', value):
-            # Match a semester, e.g. f17 or m217
-            self._index = ES_COURSE_INDEX_PREFIX + value
-        else:
-            # Unknown index, use as is
-            self._index = value
+        self._index = get_course_index(value)
+
+    def execute_local(self):
+        # Terms loaded in memory are answered without going to ES, except
+        # for the sorted pages
+        if self.sort or self.search_after:
+            return None
+        return local_index.search(self.raw_query, self.index, self.size,
+                                  source=self.source)
+
+    def doc_id(self):
+        # Course documents are keyed by courseid, so a lookup by courseid in
+        # a single term is a GET
+        if (list(self.raw_query) == ['courseid'] and
+                '*' not in self.index and ',' not in self.index):
+            return self.raw_query['courseid'][0]
+        return None
 
-    def generate_query(self):
+    ##
+    # @brief      Generates the query on the times of the meetings happening
+    #             in any of the time windows.
+    ##
+    # @param      meeting_type  (str) lectures or sections
+    # @param      windows       A list of (day, begin, end) tuples, begin and
+    #                           end formatted as hh:mma
+    ##
+    @staticmethod
+    def _time_query(meeting_type, windows):
+        window_queries = []
+        for day, begin, end in windows:
+            # A meeting is happening if it begins before the window ends
+            # and ends after the window begins
+            _times_begin_query = {'lte': end, 'format': 'hh:mma'}
+            _times_end_query = {'gt': begin, 'format': 'hh:mma'}
+            window_queries.append(Q('bool', must=[
+                Q('match', **{meeting_type + '__times__days': day}),
+                Q('range', **{meeting_type + '__times__begin': _times_begin_query}),
+                Q('range', **{meeting_type + '__times__end': _times_end_query})
+            ]))
+        if len(window_queries) == 1:
+            return window_queries[0]
+        # The span crosses midnight, the meeting can happen on either day
+        return Q('bool', must=[Q('bool', should=window_queries,
+                                 minimum_should_match=1)])
+
+    def query_params(self):
         raw_query = self.raw_query
+        shape = []
+        values = {}
+
+        if 'text' in raw_query:
+            shape.append('text')
+            values['text'] = raw_query['text'][0]
+        else:
+            if 'name' in raw_query:
+                shape.append('name')
+                values['name'] = raw_query['name'][0]
+            if 'desc' in raw_query:
+                shape.append('desc')
+                values['desc'] = raw_query['desc'][0]
+
+        if 'courseid' in raw_query:
+            values['courseid'] = raw_query['courseid'][0]
+            shape.append('courseid')
+
+        if 'instructor' in raw_query:
+            shape.append('instructor_fuzzy' if 'instructor_fuzzy' in raw_query
+                         else 'instructor')
+            values['instructor'] = " ".join(raw_query['instructor'])
+
+        if 'building' in raw_query:
+            shape.append('building')
+            values['building'] = raw_query['building'][0].upper()
+
+        if 'room' in raw_query:
+            shape.append('room')
+            values['room'] = raw_query['room'][0].upper()
+
+        if 'datetime' in raw_query:
+            # Get day and time from the datetime object
+            # raw_query['datetime'] is of type [arrow.arrow.Arrow]
+            date_time = raw_query['datetime'][0].to('America/New_York')
+            windows = utils.get_time_windows(date_time,
+                                             raw_query['timespan'][0])
+            # One window, or two when the span crosses midnight
+            shape.append(('datetime', len(windows)))
+            for i, (day, begin, end) in enumerate(windows):
+                values['day{}'.format(i)] = day
+                values['begin{}'.format(i)] = utils.format_minutes(begin)
+                values['end{}'.format(i)] = utils.format_minutes(end)
+
+        return tuple(shape), values
+
+    @classmethod
+    def build_query(cls, shape, values):
         query = Q()
 
         # TODO: use the English analyser.
         # TODO BUG: text and courseid presented in the same time would cause
         # empty return value
-        if 'text' in raw_query:
-            text = raw_query['text'][0]
+        if 'text' in shape:
+            text = values['text']
             text_query = Q('bool',
                            should=[
                                Q('match', name=text),
@@ -167,30 +744,19 @@ class CourseSearcher(Searcher):
             query &= text_query
 
         else:
-            if 'name' in raw_query:
-                name = raw_query['name'][0]
+            if 'name' in shape:
                 name_query = Q('bool',
-                               must=Q('match', name=name)
+                               must=Q('match', name=values['name'])
                                )
                 query &= name_query
-            if 'desc' in raw_query:
-                desc = raw_query['desc'][0]
+            if 'desc' in shape:
                 desc_query = Q('bool',
-                               must=Q('match', desc=desc)
+                               must=Q('match', desc=values['desc'])
                                )
                 query &= desc_query
 
-        if 'courseid' in raw_query:
-            courseid = raw_query['courseid'][0]
-            if self.index is None:
-                current_semester = utils.get_semester_from_date(
-                    datetime.datetime.today())
-                id_query = Q('bool',
-                             must=Q('term', id=courseid),
-                             should=Q('match', semester=current_semester)
-                             )
-            else:
-                id_query = Q('term', id=courseid)
+        if 'courseid' in shape:
+            id_query = Q('term', id=values['courseid'])
             query &= id_query
 
         # Declare the variables to store the temporary nested queries
@@ -199,11 +765,10 @@ class CourseSearcher(Searcher):
         lec_name_query = Q()
         sec_name_query = Q()
 
-        if 'instructor' in raw_query:
-            instructor = " ".join(raw_query['instructor'])
-            _query_obj = {'query': instructor,
+        if 'instructor' in shape or 'instructor_fuzzy' in shape:
+            _query_obj = {'query': values['instructor'],
                           'operator': 'and'}
-            if 'instructor_fuzzy' in raw_query:
+            if 'instructor_fuzzy' in shape:
                 _query_obj['fuzziness'] = 'AUTO'
 
             lec_name_query = Q('match',
@@ -213,45 +778,30 @@ class CourseSearcher(Searcher):
 
         # TODO: check if DH 100 would give DH 2135 and PH 100
         # see if multilevel nesting is needed
-        if 'building' in raw_query:
-            building = raw_query['building'][0].upper()
+        if 'building' in shape:
+            building = values['building']
             lec_building_query = Q('match', lectures__times__building=building)
             sec_building_query = Q('match', sections__times__building=building)
             lec_nested_queries['lec_building_query'] = lec_building_query
             sec_nested_queries['sec_building_query'] = sec_building_query
 
-        if 'room' in raw_query:
-            room = raw_query['room'][0].upper()
+        if 'room' in shape:
+            room = values['room']
             lec_room_query = Q('match', lectures__times__room=room)
             sec_room_query = Q('match', sections__times__room=room)
             lec_nested_queries['lec_room_query'] = lec_room_query
             sec_nested_queries['sec_room_query'] = sec_room_query
 
-        if 'datetime' in raw_query:
-            # Get day and time from the datetime object
-            # raw_query['datetime'] is of type [arrow.arrow.Arrow]
-            date_time = raw_query['datetime'][0].to('America/New_York')
-            day = date_time.isoweekday() % 7
-            time = date_time.time().strftime("%I:%M%p")
-            delta_time = datetime.timedelta(minutes=raw_query['timespan'][0])
-            shifted_time = (date_time + delta_time).time().strftime("%I:%M%p")
-
-            # NOTE: Known bug: if the time spans across two days, it would
-            # give a wrong result because day is calculated based
-            # on the begin time
-
-            # Construct the query based on day and time
-            _times_begin_query = {'lte': shifted_time, 'format': 'hh:mma'}
-            _times_end_query = {'gt': time, 'format': 'hh:mma'}
-
-            lec_time_query = Q('bool', must=[Q('match', lectures__times__days=day),
-                                             Q('range', lectures__times__begin=_times_begin_query),
-                                             Q('range', lectures__times__end=_times_end_query)])
-            sec_time_query = Q('bool', must=[Q('match', sections__times__days=day),
-                                             Q('range', sections__times__begin=_times_begin_query),
-                                             Q('range', sections__times__end=_times_end_query)])
-            lec_nested_queries['lec_time_query'] = lec_time_query
-            sec_nested_queries['sec_time_query'] = sec_time_query
+        for part in shape:
+            if isinstance(part, tuple) and part[0] == 'datetime':
+                windows = [(values['day{}'.format(i)],
+                            values['begin{}'.format(i)],
+                            values['end{}'.format(i)])
+                           for i in range(part[1])]
+                lec_time_query = cls._time_query('lectures', windows)
+                sec_time_query = cls._time_query('sections', windows)
+                lec_nested_queries['lec_time_query'] = lec_time_query
+                sec_nested_queries['sec_time_query'] = sec_time_query
 
         # Combine all the nested queries
         _lec_temp = Q()
@@ -290,17 +840,48 @@ class CourseSearcher(Searcher):
         # And finally combine the lecture query and section query with "or"
         query &= Q('bool', must=[combined_lec_query | combined_sec_query])
 
-        if config.settings.DEBUG:
-            print(json.dumps(query.to_dict(), indent=2))
-            print("[DEBUG] max size: {}".format(self.size))
         return query
 
 
+# @brief  Gets the ES index from short representation of a term. e.g. f17
+def get_course_index(term):
+    if term is None:
+        # Everything
+        return ES_COURSE_INDEX_PREFIX + '*'
+    elif term == 'current':
+        # Current semester
+        return utils.get_current_course_index()
+    elif re.match('^(f|s|m1|m2)\d{2}$', term):
+        # Match a semester, e.g. f17 or m217
+        return ES_COURSE_INDEX_PREFIX + term
+    else:
+        # Unknown index, use as is
+        return term
+
+
 # @brief  Initializes connection to the Elasticsearch server
 #         The settings are in config/es_config.py
 def init_es_connection():
+    if config.es_config.ES_BACKEND == 'snapshot':
+        from common import snapshot
+        connections.add_connection(
+            'default', snapshot.load_client(config.es_config.SNAPSHOT_DIR))
+        return
+    from config.es_config import ES_MAXSIZE, ES_MAX_RETRIES,\
+                                 ES_RETRY_ON_TIMEOUT, ES_SNIFF_ON_START,\
+                                 ES_SNIFF_ON_CONNECTION_FAIL,\
+                                 ES_SNIFFER_TIMEOUT
+    # Pool and retry policy shared by both services
+    transport_settings = {
+        'maxsize': ES_MAXSIZE,
+        'timeout': ES_TIMEOUT,
+        'max_retries': ES_MAX_RETRIES,
+        'retry_on_timeout': ES_RETRY_ON_TIMEOUT,
+        'sniff_on_start': ES_SNIFF_ON_START,
+        'sniff_on_connection_fail': ES_SNIFF_ON_CONNECTION_FAIL,
+        'sniffer_timeout': ES_SNIFFER_TIMEOUT,
+    }
     if config.es_config.SERVICE == 'AWS':
-        from elasticsearch import RequestsHttpConnection
         from requests_aws4auth import AWS4Auth
         from config.es_config import AWS_ES_HOSTS, AWS_ACCESS_KEY,\
                                      AWS_SECRET_KEY, AWS_REGION
@@ -310,19 +891,55 @@ def init_es_connection():
             http_auth=awsauth,
             use_ssl=True,
             verify_certs=True,
-            connection_class=RequestsHttpConnection
+            connection_class=connection.PooledRequestsHttpConnection,
+            **transport_settings
         )
     else:
         from config.es_config import ES_HOSTS, ES_HTTP_AUTH
         connections.create_connection(
             hosts=ES_HOSTS,
-            timeout=20,
             use_ssl=True,
             verify_certs=True,
-            http_auth=ES_HTTP_AUTH
+            http_auth=ES_HTTP_AUTH,
+            **transport_settings
         )
 
 
+# @brief  Gets the timeout of the ES requests made by an endpoint
+def get_request_timeout(endpoint):
+    return ES_REQUEST_TIMEOUTS.get(endpoint, ES_TIMEOUT)
+
+
+##
+# @brief      Gets the _source filter sent to ES, so that the fields left out
+#             of a response are not transferred and deserialized.
+##
+# @param      includes  A list of fields to return, None for every field
+# @param      excludes  A list of fields to leave out
+##
+# @return     (dict) or None to get the whole documents.
+##
+def get_source_filter(includes=None, excludes=None):
+    source = {}
+    if includes:
+        source['includes'] = sorted(set(includes))
+    if excludes:
+        source['excludes'] = sorted(set(excludes))
+    return source or None
+
+
+# @brief  Loads the courses of the given terms into memory so that the
+#         course lookups on those terms do not go to ES.
+#         The terms default to LOCAL_INDEX_TERMS in config/course.py
+def init_local_indexes(terms=None):
+    if terms is None:
+        terms = config.course.LOCAL_INDEX_TERMS
+    for term in terms:
+        index = get_course_index(term)
+        local_index.load_from_es(index)
+        cache.invalidate(index)
+
+
 # @brief  Initializes an output dictionary for "courses" endpoint
 def init_courses_output():
     output = {'response': {},
@@ -337,12 +954,87 @@ def format_courses_output(response):
 
     if has_error(response):
         return output
-    for hit in response:
-        output['courses'].append(hit.to_dict())
+    with metrics.timer('to_dict'):
+        output['courses'] = hit_sources(response)
 
     return output
 
 
+##
+# @brief      Formats the output for the courses endpoint as a stream. The
+#             first page is fetched right away, so that an error response
+#             can still be returned with its status code.
+##
+# @return     A dictionary {courses: <generator of the courses>,
+#             response: <summary of the first page or the error>}. If an
+#             error happens after the first page, the generator stops and
+#             the error is put into response.
+##
+def stream_courses_output(searcher):
+    output = init_courses_output()
+    pages = searcher.scan_pages(config.course.STREAM_CHUNK_SIZE,
+                                config.course.STREAM_SCROLL)
+    first = next(pages)
+    if has_error(first):
+        output['response'] = first
+        return output
+
+    output['response'] = {'took': first.took,
+                          'hits': {'total': first.hits.total}}
+    output['courses'] = _stream_pages(
+        output, first, pages, hit_sources)
+    return output
+
+
+##
+# @brief      Iterates the items of pages until an error page, which is put
+#             into the response of the output.
+##
+# @param      page      The first page
+# @param      pages     A generator of the next pages
+# @param      to_items  (function) Maps a page to its items
+##
+def _stream_pages(output, page, pages, to_items):
+    try:
+        while page is not None:
+            if has_error(page):
+                output['response'] = page
+                return
+            yield from to_items(page)
+            page = next(pages, None)
+    finally:
+        pages.close()
+
+
+# @brief  Formats the output for the course endpoint
+def format_course_output(response):
+    output = {'response': response_to_dict(response),
+              'course': None}
+
+    if has_error(response):
+        return output
+    if response.hits.total != 0:
+        # Got some hits
+        with metrics.timer('to_dict'):
+            output['course'] = response[0].to_dict()
+
+    return output
+
+
+##
+# @brief      Adds the cursor of the next page to the output of a page of
+#             results, or None on the last page.
+##
+def add_next_cursor(output, response, page_size):
+    output['next_cursor'] = None
+    if has_error(response):
+        return output
+    hits = response.hits
+    if len(hits) == page_size:
+        output['next_cursor'] = utils.encode_cursor(list(hits[-1].meta.sort))
+    return output
+
+
 def init_fces_output():
     output = {'response': {},
               'fces': []}
@@ -355,12 +1047,22 @@ def format_fces_output(response):
 
     if has_error(response):
         return output
-    for hit in response:
-        output['fces'].append(hit.to_dict())
+    with metrics.timer('to_dict'):
+        output['fces'] = hit_sources(response)
 
     return output
 
 
+##
+# @brief      Gets the _source of the hits of a response from the raw
+#             response, skipping the Hit objects elasticsearch_dsl wraps each
+#             hit in. Same as [hit.to_dict() for hit in response].
+##
+def hit_sources(response):
+    return [hit.get('_source', {})
+            for hit in response.to_dict()['hits']['hits']]
+
+
 def has_error(response):
     if isinstance(response, dict) and response.get('status') is not None:
         return True
@@ -386,30 +1088,83 @@ def response_to_dict(response):
 # @return     A dictionary {course: [<dictionary containing the course info>],
 #             response: <response from the server> }
 #
+@cache.cached('course', index_arg='term',
+              index=lambda args: get_course_index(args['term']))
 def get_course_by_id(courseid, term=None):
     output = {'response': {},
               'course': None}
-    index = term
 
     if re.search("^\d\d-\d\d\d$", courseid):
-        searcher = CourseSearcher({'courseid': [courseid]}, index=index)
+        searcher = _get_course_searcher(courseid, term)
         response = searcher.execute()
-        output['response'] = response_to_dict(response)
+        output = format_course_output(response)
 
-        if has_error(response):
-            return output
-        if response.hits.total != 0:
-            # Got some hits
-            output['course'] = response[0].to_dict()
+    return output
+
+
+# @brief  Same as get_course_by_id(), awaited by asgi.py
+@get_course_by_id.cache_async
+async def get_course_by_id_async(courseid, term=None):
+    output = {'response': {},
+              'course': None}
+
+    if re.search("^\d\d-\d\d\d$", courseid):
+        searcher = _get_course_searcher(courseid, term)
+        response = await searcher.execute_async()
+        output = format_course_output(response)
 
     return output
 
 
-def get_courses_by_id(courseid):
+#
+#
+# @brief      Get many courses by courseid with a single request to ES.
+#
+# @param      items  A list of (courseid, term) tuples. term may be None.
+#
+# @return     A list of dictionaries in the same order as items, each one
+#             being what get_course_by_id(courseid, term) returns.
+#
+def get_course_by_id_batch(items):
+    outputs = [None] * len(items)
+    searchers = []
+    pending = []
+    for i, (courseid, term) in enumerate(items):
+        if not re.search("^\d\d-\d\d\d$", courseid):
+            outputs[i] = {'response': {},
+                          'course': None}
+            continue
+        found, output = get_course_by_id.get_cached_nowait(courseid, term)
+        if found:
+            outputs[i] = output
+            continue
+        searchers.append(_get_course_searcher(courseid, term))
+        pending.append(i)
+
+    try:
+        responses = Searcher.execute_many(searchers)
+    except BaseException:
+        for i in pending:
+            get_course_by_id.release_cached(*items[i])
+        raise
+    for i, response in zip(pending, responses):
+        outputs[i] = format_course_output(response)
+        get_course_by_id.set_cached(outputs[i], *items[i])
+    return outputs
+
+
+def _get_course_searcher(courseid, term):
+    return CourseSearcher({'courseid': [courseid]}, index=term,
+                          timeout=get_request_timeout('course'))
+
+
+def get_courses_by_id(courseid, source=None):
     output = init_courses_output()
 
     if re.search("^\d\d-\d\d\d$", courseid):
-        searcher = CourseSearcher({'courseid': [courseid]}, index=None)
+        searcher = CourseSearcher({'courseid': [courseid]}, index=None,
+                                  timeout=get_request_timeout('course'),
+                                  source=source)
         response = searcher.execute()
         output = format_courses_output(response)
         if len(output['courses']) == 0:
@@ -428,31 +1183,78 @@ def get_courses_by_id(courseid):
 # @return     A dictionary {courses: [<dictionary containing the course info>],
 #             response: <response from the server> }
 #
-def get_courses_by_instructor(name, fuzzy=False, index=None, size=100):
+@cache.cached('instructor', index_arg='index',
+              index=lambda args: get_course_index(args['index']))
+def get_courses_by_instructor(name, fuzzy=False, index=None, size=100,
+                              source=None, stream=False, page_size=None,
+                              search_after=None):
+    searcher = _get_instructor_searcher(name, fuzzy, index, size, source,
+                                        page_size, search_after)
+    if stream:
+        return stream_courses_output(searcher)
+    response = searcher.execute()
+    output = format_courses_output(response)
+    if page_size:
+        add_next_cursor(output, response, page_size)
+    return output
+
+
+# @brief  Same as get_courses_by_instructor() without stream, awaited by
+#         asgi.py
+@get_courses_by_instructor.cache_async
+async def get_courses_by_instructor_async(name, fuzzy=False, index=None,
+                                          size=100, source=None, stream=False,
+                                          page_size=None, search_after=None):
+    assert not stream
+    searcher = _get_instructor_searcher(name, fuzzy, index, size, source,
+                                        page_size, search_after)
+    response = await searcher.execute_async()
+    output = format_courses_output(response)
+    if page_size:
+        add_next_cursor(output, response, page_size)
+    return output
+
+
+def _get_instructor_searcher(name, fuzzy, index, size, source, page_size,
+                             search_after):
     raw_query = {'instructor': [name]}
     if fuzzy:
         raw_query['instructor_fuzzy'] = [name]
 
-    searcher = CourseSearcher(raw_query, index=index, size=size)
-    response = searcher.execute()
-    output = format_courses_output(response)
-    return output
+    return CourseSearcher(raw_query, index=index, size=page_size or size,
+                          timeout=get_request_timeout('instructor'),
+                          source=source,
+                          sort=COURSE_PAGE_SORT if page_size else None,
+                          search_after=search_after)
 
 
-def get_courses_by_building_room(building, room, index=None, size=100):
+@cache.cached('building_room', index_arg='index',
+              index=lambda args: get_course_index(args['index']))
+def get_courses_by_building_room(building, room, index=None, size=100,
+                                 source=None, stream=False, page_size=None,
+                                 search_after=None):
     assert(building is not None or room is not None)
     raw_query = dict()
     if building is not None:
         raw_query['building'] = [building]
     if room is not None:
         raw_query['room'] = [room]
-    searcher = CourseSearcher(raw_query, index=index, size=size)
+    searcher = CourseSearcher(raw_query, index=index, size=page_size or size,
+                              timeout=get_request_timeout('building_room'),
+                              source=source,
+                              sort=COURSE_PAGE_SORT if page_size else None,
+                              search_after=search_after)
+    if stream:
+        return stream_courses_output(searcher)
     response = searcher.execute()
     output = format_courses_output(response)
+    if page_size:
+        add_next_cursor(output, response, page_size)
     return output
 
 
-def get_courses_by_datetime(datetime_str, span_str=None, size=200):
+def get_courses_by_datetime(datetime_str, span_str=None, size=200,
+                            source=None, stream=False):
     span_minutes = 0
     if span_str is not None:
         try:
@@ -491,14 +1293,70 @@ def get_courses_by_datetime(datetime_str, span_str=None, size=200):
     searcher = CourseSearcher(
         {'datetime': [date_time],
          'timespan': [span_minutes]},
-        index=index, size=size
+        index=index, size=size,
+        timeout=get_request_timeout('datetime'),
+        source=source
     )
+    if stream:
+        return stream_courses_output(searcher)
     response = searcher.execute()
     output = format_courses_output(response)
     return output
 
 
-def get_courses_by_searching(args, size=100):
+#
+#
+# @brief      Get the occupancy of a building during the week of a term: the
+#             number of meetings in session in each bin of time of each day,
+#             from Sunday, and the minutes per week each of its rooms is in
+#             use. Answered from the snapshot of the term kept by
+#             common/term_snapshot.py.
+#
+# @param      building  (str) e.g. DH
+# @param      index     (str) The term, e.g. f17 or current
+# @param      bin_str   (str) The length of a bin in minutes, 60 if None
+#
+# @return     A dictionary {occupancy: {building, bin_minutes, meetings,
+#             room_minutes}, response: {}}
+#
+def get_building_occupancy(building, index='current', bin_str=None):
+    output = {'response': {},
+              'occupancy': None}
+    try:
+        bin_minutes = 60 if bin_str is None else int(bin_str)
+        if (not (config.course.OCCUPANCY_BIN_LOWER_LIMIT <= bin_minutes <=
+                 config.course.OCCUPANCY_BIN_UPPER_LIMIT) or
+                utils.MINUTES_PER_DAY % bin_minutes):
+            raise ValueError(Message.OCCUPANCY_BIN_PARSE_FAIL)
+    except ValueError:
+        output['response'] = {
+            'status': 400,
+            'error': {
+                'message': Message.OCCUPANCY_BIN_PARSE_FAIL
+            }
+        }
+        return output
+
+    try:
+        snapshot = term_snapshot.get(get_course_index(index))
+    except elasticsearch.exceptions.TransportError as e:
+        status = e.status_code if isinstance(e.status_code, int) else 500
+        output['response'] = {'status': status}
+        return output
+
+    mask = snapshot.select(building=building)
+    output['occupancy'] = {
+        'building': building.upper(),
+        'bin_minutes': bin_minutes,
+        'meetings': snapshot.occupancy(mask, bin_minutes).tolist(),
+        'room_minutes': {room: minutes for (_, room), minutes
+                         in snapshot.room_minutes(mask).items()},
+    }
+    return output
+
+
+def get_courses_by_searching(args, size=100, source=None, stream=False,
+                             page_size=None, search_after=None):
     # valid_args = ('text', 'name', 'desc', 'instructor', 'courseid',
     # 'building', 'room', 'datetime_str', 'span_str', 'term')
 
@@ -572,54 +1430,278 @@ def get_courses_by_searching(args, size=100):
         # TODO: this is a quick hack to support the term arg
         index = 'current'
 
-    searcher = CourseSearcher(raw_query, index=index, size=size)
+    searcher = CourseSearcher(raw_query, index=index, size=page_size or size,
+                              timeout=get_request_timeout('search'),
+                              source=source,
+                              sort=SEARCH_PAGE_SORT if page_size else None,
+                              search_after=search_after)
+    if stream:
+        return stream_courses_output(searcher)
     response = searcher.execute()
     output = format_courses_output(response)
+    if page_size:
+        add_next_cursor(output, response, page_size)
     return output
 
 
-def get_fce_by_id(courseid, size=100):
+@cache.cached('fce', index=lambda args: ES_FCE_INDEX)
+def get_fce_by_id(courseid, size=100, page_size=None, search_after=None):
     searcher = FCESearcher({'courseid': [courseid]},
                            index=ES_FCE_INDEX,
-                           size=size,
-                           sort=['-year'])
+                           size=page_size or size,
+                           sort=FCE_PAGE_SORT if page_size else ['-year'],
+                           timeout=get_request_timeout('fce'),
+                           search_after=search_after)
     response = searcher.execute()
     output = format_fces_output(response)
+    if page_size:
+        add_next_cursor(output, response, page_size)
     return output
 
 
-def get_fce_by_instructor(instructor, size=100):
+def get_fce_by_instructor(instructor, size=100, page_size=None,
+                          search_after=None):
     searcher = FCESearcher({'instructor': [instructor]},
                            index=ES_FCE_INDEX,
-                           size=size,
-                           sort=['-year'])
+                           size=page_size or size,
+                           sort=FCE_PAGE_SORT if page_size else ['-year'],
+                           timeout=get_request_timeout('fce'),
+                           search_after=search_after)
     response = searcher.execute()
     output = format_fces_output(response)
+    if page_size:
+        add_next_cursor(output, response, page_size)
     return output
 
 
-def list_all_courses(term):
-    if term == 'current':
-        index = utils.get_current_course_index()
+##
+# @brief      The aggregations of each summarized field: its mean and
+#             percentiles.
+##
+def _fce_field_aggs():
+    aggs = {}
+    for name, field in config.fce.SUMMARY_FIELDS.items():
+        aggs[name + '_mean'] = {'avg': {'field': field}}
+        aggs[name + '_percentiles'] = {'percentiles': {
+            'field': field, 'percents': config.fce.SUMMARY_PERCENTS}}
+    return aggs
+
+
+##
+# @brief      The aggregations of an FCE summary: the fields summarized over
+#             all the rows, per year and per group.
+##
+# @param      group        (str) The name of the groups, e.g. instructors
+# @param      group_field  (str) The field the groups are keyed by
+##
+def fce_summary_aggs(group, group_field):
+    aggs = _fce_field_aggs()
+    aggs['years'] = {
+        'terms': {'field': config.fce.YEAR_FIELD,
+                  'size': config.fce.SUMMARY_BUCKETS,
+                  'order': {'_term': 'desc'}},
+        'aggs': _fce_field_aggs(),
+    }
+    aggs[group] = {
+        'terms': {'field': group_field,
+                  'size': config.fce.SUMMARY_BUCKETS},
+        'aggs': _fce_field_aggs(),
+    }
+    return aggs
+
+
+# @brief  Reads the summarized fields from the aggregations of a bucket
+def _fce_field_summary(aggs):
+    fields = {}
+    for name in config.fce.SUMMARY_FIELDS:
+        percentiles = {}
+        for percent, value in aggs[name + '_percentiles']['values'].items():
+            # ES gives NaN when there is no value
+            if not isinstance(value, (int, float)) or value != value:
+                value = None
+            percentiles['{:g}'.format(float(percent))] = value
+        fields[name] = {'mean': aggs[name + '_mean']['value'],
+                        'percentiles': percentiles}
+    return fields
+
+
+##
+# @brief      Formats the output for the FCE summary endpoints.
+##
+# @param      group  (str) The name of the groups, as in fce_summary_aggs()
+# @param      key    (str) The name of the key of a group in the output
+##
+# @return     A dictionary {summary: {rows, fields, years: [...],
+#             <group>: [...]}, response: <the ES response>}. Each field is
+#             {mean, percentiles: {25, 50, 75}}, and each year or group
+#             {year or key, rows, fields}.
+##
+def format_fce_summary_output(response, group, key):
+    output = {'response': response_to_dict(response),
+              'summary': None}
+
+    if has_error(response):
+        return output
+    aggs = output['response']['aggregations']
+    output['summary'] = {
+        'rows': output['response']['hits']['total'],
+        'fields': _fce_field_summary(aggs),
+        'years': [{'year': bucket['key'],
+                   'rows': bucket['doc_count'],
+                   'fields': _fce_field_summary(bucket)}
+                  for bucket in aggs['years']['buckets']],
+        group: [{key: bucket['key'],
+                 'rows': bucket['doc_count'],
+                 'fields': _fce_field_summary(bucket)}
+                for bucket in aggs[group]['buckets']],
+    }
+    return output
+
+
+def _get_fce_summary(raw_query, group, group_field, key):
+    searcher = FCESearcher(raw_query, index=ES_FCE_INDEX, size=0,
+                           timeout=get_request_timeout('fce'),
+                           aggs=fce_summary_aggs(group, group_field))
+    response = searcher.execute()
+    return format_fce_summary_output(response, group, key)
+
+
+# @brief  Summarizes the FCEs of a course, per year and per instructor
+@cache.cached('fce', index=lambda args: ES_FCE_INDEX)
+def get_fce_summary_by_id(courseid):
+    return _get_fce_summary({'courseid': [courseid]}, 'instructors',
+                            config.fce.INSTRUCTOR_FIELD, 'instructor')
+
+
+# @brief  Summarizes the FCEs of an instructor, per year and per course
+@cache.cached('fce', index=lambda args: ES_FCE_INDEX)
+def get_fce_summary_by_instructor(instructor):
+    return _get_fce_summary({'instructor': [instructor]}, 'courses',
+                            config.fce.COURSEID_FIELD, 'courseid')
+
+
+# @brief  Summarizes the FCEs of a department, per year and per course
+@cache.cached('fce', index=lambda args: ES_FCE_INDEX)
+def get_fce_summary_by_department(department):
+    return _get_fce_summary({'department': [department]}, 'courses',
+                            config.fce.COURSEID_FIELD, 'courseid')
+
+
+# Runs the parts of the joined responses fetched concurrently
+_join_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=config.settings.JOIN_THREADS)
+
+
+##
+# @brief      Calls a function in a thread of _join_executor, in the context
+#             of the current request if any, so that its metrics are
+#             recorded under the endpoint.
+##
+# @return     (Future) The result of the call.
+##
+def _submit(f, *args, **kwargs):
+    if has_request_context():
+        f = copy_current_request_context(f)
+    return _join_executor.submit(f, *args, **kwargs)
+
+
+#
+#
+# @brief      Gets a course along with its FCEs. The FCEs are fetched in
+#             another thread while this one fetches the course, so that the
+#             two requests to ES overlap and both outputs are cached as if
+#             they had been fetched separately.
+#
+# @param      courseid  (str) The courseid
+# @param      term      (str) The elasticsearch index
+# @param      summary   Whether to get the summary of the FCEs instead of
+#                       their rows
+# @param      size      (int) The maximum number of FCE rows
+#
+# @return     (course output, FCE output), being what
+#             get_course_by_id(courseid, term) and get_fce_by_id(courseid,
+#             size) or get_fce_summary_by_id(courseid) return.
+#
+def get_course_with_fces(courseid, term=None, summary=False, size=100):
+    if summary:
+        fces = _submit(get_fce_summary_by_id, courseid)
     else:
-        index = ES_COURSE_INDEX_PREFIX + term
-    print(index)
-    query = Q()
-    # Use ES api to search
-    s = Search(index=index).query(query).extra(
-            size=7000).source(False)
+        fces = _submit(get_fce_by_id, courseid, size=size)
+    course_output = get_course_by_id(courseid, term)
+    return course_output, fces.result()
+
 
+##
+# @brief      Reads the IDs of the courses of an index with a scroll.
+##
+# @param      index       The ES index
+# @param      chunk_size  The number of IDs per chunk
+##
+# @return     A generator of lists of at most chunk_size IDs. An error is
+#             yielded as the last chunk.
+##
+def scan_course_ids(index, chunk_size=config.course.LIST_CHUNK_SIZE):
+    local = local_index.get(index)
+    if local is not None:
+        courseids = list(local.courseids)
+        for i in range(0, len(courseids), chunk_size):
+            yield courseids[i:i + chunk_size]
+        return
+
+    s = Search(index=index, doc_type='course').source(False).params(
+        size=chunk_size, scroll=config.course.STREAM_SCROLL,
+        request_timeout=get_request_timeout('list'))
+    chunk = []
     try:
-        response = s.execute().to_dict()
-        if "hits" in response:
-            for elem in response['hits']['hits']:
-                print(elem['_id'])
-            courseids = [elem['_id'] for elem in response['hits']['hits']]
-            return courseids
-    except:
-        pass
-    return []
+        # Sorted by _doc, the cheapest order to scroll in
+        for hit in s.scan():
+            chunk.append(hit.meta.id)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+    except elasticsearch.exceptions.TransportError as e:
+        yield Searcher._error_info(e)
+        return
+    except elasticsearch.helpers.ScanError as e:
+        # Some shards failed, the IDs would be incomplete
+        yield {'status': 500, 'error': str(e)}
+        return
+    if chunk:
+        yield chunk
+
+
+##
+# @brief      Lists the IDs of the courses of a term. The list is cached
+#             until the index is reloaded.
+##
+# @param      term    (str) The term, e.g. f17 or current
+# @param      stream  (bool) Whether to give the IDs as a generator, read
+#                     from ES a chunk at a time. Not cached.
+##
+# @return     A dictionary {courseids: [<courseid>],
+#             response: <response from the server> }
+##
+@cache.cached('list', index_arg='term',
+              index=lambda args: get_course_index(args['term']))
+def list_all_courses(term, stream=False):
+    output = {'response': {},
+              'courseids': []}
+    chunks = scan_course_ids(get_course_index(term))
+    first = next(chunks, [])
+    if has_error(first):
+        output['response'] = first
+        return output
 
+    if stream:
+        output['courseids'] = _stream_pages(output, first, chunks, iter)
+        return output
+    for chunk in itertools.chain([first], chunks):
+        if has_error(chunk):
+            output['response'] = chunk
+            output['courseids'] = []
+            break
+        output['courseids'].extend(chunk)
+    return output
 
 
 if __name__ == '__main__':
@@ -0,0 +1,263 @@
+# @file shared_cache.py
+# @brief Optional cache tier shared by the workers, backed by Redis (or any
+#        server speaking its protocol). It sits under the in-process cache of
+#        common/cache.py, so that the output of a search made by one worker
+#        is reused by the others.
+# @author Justin Chu (justinchuby@cmu.edu)
+
+import hashlib
+import json
+import threading
+import time
+import uuid
+
+try:
+    import redis
+except ImportError:  # Only needed when REDIS_URL is set
+    redis = None
+
+import config.cache
+from config.es_config import ES_COURSE_INDEX_PREFIX
+
+
+##
+## @brief      Gets the family of an index, the wildcard matching it and the
+##             other indexes its entries have to be dropped with.
+##
+def _family(index):
+    if '*' not in index and index.startswith(ES_COURSE_INDEX_PREFIX):
+        return ES_COURSE_INDEX_PREFIX + '*'
+    return index
+
+
+# Deletes a lock only if it still holds the token of the worker releasing it,
+# so that a worker whose lock expired cannot release the lock of another one
+_RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+##
+## @brief      A cache of JSON payloads in Redis.
+##
+##             Entries are invalidated with generation counters rather than
+##             by deleting keys: each entry records the generations of its
+##             index when it was written, and is ignored once one of them is
+##             incremented. An entry of course-f17 depends on the counters of
+##             course-f17 and of everything (course-*:all), an entry of the
+##             wildcard course-* on the counter of course-*, which is
+##             incremented along with any course index.
+##
+##             Entries have a soft expiry, the TTL of their endpoint, and are
+##             kept GRACE seconds longer. The first worker reading an entry
+##             past its soft expiry takes a lock and refreshes it, while the
+##             others keep serving the stale payload. A worker missing an
+##             entry that another worker is computing waits for it up to
+##             LOCK_WAIT seconds. Locks hold a random token and are only
+##             released by the thread that took them.
+##
+class SharedCache(object):
+    def __init__(self, client, prefix=config.cache.SHARED_CACHE_PREFIX,
+                 grace=config.cache.SHARED_CACHE_GRACE,
+                 lock_ttl=config.cache.SHARED_CACHE_LOCK_TTL,
+                 lock_wait=config.cache.SHARED_CACHE_LOCK_WAIT):
+        self.client = client
+        self.prefix = prefix
+        self.grace = grace
+        self.lock_ttl = lock_ttl
+        self.lock_wait = lock_wait
+        self.errors = (ValueError,)
+        if redis is not None:
+            self.errors += (redis.exceptions.RedisError,)
+        self._release_script = client.register_script(_RELEASE_SCRIPT)
+        # The tokens of the locks taken by this thread, lock key -> token
+        self._tokens = threading.local()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.failures = 0
+
+    def _count(self, field):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+    def _key(self, key):
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return '{}:entry:{}'.format(self.prefix, digest)
+
+    def _lock_key(self, key):
+        return self._key(key) + ':lock'
+
+    def _generation_keys(self, index):
+        keys = [self.prefix + ':generation']
+        if index is not None:
+            family = _family(index)
+            keys.append('{}:generation:{}'.format(self.prefix, index))
+            if family != index:
+                keys.append('{}:generation:{}:all'.format(self.prefix, family))
+        return keys
+
+    def _read(self, key, index):
+        pipe = self.client.pipeline(transaction=False)
+        pipe.get(self._key(key))
+        pipe.mget(self._generation_keys(index))
+        raw, generations = pipe.execute()
+        generations = [int(generation or 0) for generation in generations]
+        if raw is None:
+            return None, generations
+        entry = json.loads(raw.decode('utf-8') if isinstance(raw, bytes)
+                           else raw)
+        if entry['generations'] != generations:
+            # Invalidated
+            return None, generations
+        return entry, generations
+
+    ##
+    ## @brief      Looks up a key.
+    ##
+    ## @param      wait  (bool) Whether to wait for an entry being computed
+    ##                   by another worker.
+    ##
+    ## @return     (bool, object, float) Whether the key was found, its value
+    ##             and the seconds left before its soft expiry, negative for
+    ##             a stale value. A stale value is returned as not found to
+    ##             the one caller that gets to refresh it.
+    ##
+    def get(self, key, index=None, wait=True):
+        try:
+            deadline = time.monotonic() + (self.lock_wait if wait else 0)
+            while True:
+                entry, _ = self._read(key, index)
+                if entry is not None:
+                    ttl = entry['soft_expiry'] - time.time()
+                    if ttl > 0:
+                        self._count('hits')
+                        return True, entry['value'], ttl
+                    if not self._acquire(key):
+                        # Another worker is refreshing it
+                        self._count('stale_hits')
+                        return True, entry['value'], ttl
+                    self._count('misses')
+                    return False, None, 0
+                if self._acquire(key) or time.monotonic() >= deadline:
+                    self._count('misses')
+                    return False, None, 0
+                # Another worker is computing it
+                self._count('waits')
+                time.sleep(0.05)
+        except self.errors:
+            self._count('failures')
+            return False, None, 0
+
+    def _held_tokens(self):
+        if not hasattr(self._tokens, 'locks'):
+            self._tokens.locks = {}
+        return self._tokens.locks
+
+    def _acquire(self, key):
+        token = uuid.uuid4().hex
+        if not self.client.set(self._lock_key(key), token, nx=True,
+                               ex=self.lock_ttl):
+            return False
+        self._held_tokens()[self._lock_key(key)] = token
+        return True
+
+    ##
+    ## @brief      Stores a JSON-serializable value and releases the lock
+    ##             taken by get().
+    ##
+    def set(self, key, value, ttl, index=None):
+        try:
+            generations = [int(generation or 0) for generation in
+                           self.client.mget(self._generation_keys(index))]
+            entry = json.dumps({
+                'generations': generations,
+                'soft_expiry': time.time() + ttl,
+                'value': value,
+            }, separators=(',', ':'))
+            self.client.set(self._key(key), entry, ex=int(ttl + self.grace))
+        except self.errors:
+            self._count('failures')
+        self.release(key)
+
+    ##
+    ## @brief      Releases the lock taken by get() when the value could not
+    ##             be computed, e.g. on an error response. Does nothing if
+    ##             this thread does not hold the lock.
+    ##
+    def release(self, key):
+        lock_key = self._lock_key(key)
+        token = self._held_tokens().pop(lock_key, None)
+        if token is None:
+            return
+        try:
+            self._release_script(keys=[lock_key], args=[token])
+        except self.errors:
+            self._count('failures')
+
+    ##
+    ## @brief      Drops the entries read from an index in every worker.
+    ##
+    ## @param      index  (str) The ES index. Everything is dropped if index
+    ##                    is None.
+    ##
+    def invalidate(self, index=None):
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            if index is None:
+                pipe.incr(self.prefix + ':generation')
+            else:
+                family = _family(index)
+                pipe.incr('{}:generation:{}'.format(self.prefix, index))
+                if family != index:
+                    pipe.incr('{}:generation:{}'.format(self.prefix, family))
+                else:
+                    pipe.incr('{}:generation:{}:all'.format(self.prefix,
+                                                            family))
+            pipe.execute()
+        except self.errors:
+            self._count('failures')
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'waits': self.waits,
+                'failures': self.failures,
+            }
+
+
+_shared_cache = None
+
+
+##
+## @brief      Uses the client for the shared cache, e.g. a
+##             fakeredis.FakeStrictRedis in tests. None disables it.
+##
+def set_client(client):
+    global _shared_cache
+    _shared_cache = SharedCache(client) if client is not None else None
+    return _shared_cache
+
+
+##
+## @brief      Gets the shared cache, connecting to REDIS_URL the first time.
+##
+## @return     (SharedCache) or None if no shared cache is configured.
+##
+def get():
+    if _shared_cache is None and config.cache.REDIS_URL:
+        if redis is None:
+            raise ImportError("redis is required to use REDIS_URL")
+        set_client(redis.StrictRedis.from_url(
+            config.cache.REDIS_URL,
+            socket_timeout=config.cache.REDIS_TIMEOUT,
+            socket_connect_timeout=config.cache.REDIS_TIMEOUT))
+    return _shared_cache
@@ -0,0 +1,104 @@
+# @file singleflight.py
+# @brief Coalesces identical concurrent ES requests of a worker into one:
+#        the first caller makes the request, the callers arriving while it is
+#        in flight wait for it and get a copy of its response.
+# @author Justin Chu (justinchuby@cmu.edu)
+
+import threading
+
+from elasticsearch_dsl.response import Response
+
+from common.utils import copy_json
+import config.settings
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+##
+## @brief      Copies a response for a waiter, since the formatting functions
+##             modify the hits in place.
+##
+def _copy_response(response):
+    if isinstance(response, Response):
+        return Response(response._search, copy_json(response.to_dict()))
+    return copy_json(response)
+
+
+class SingleFlight(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        # key -> _Call
+        self._calls = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    ##
+    ## @brief      Calls fetch, unless a call with the same key is in flight,
+    ##             in which case its result is waited for instead.
+    ##
+    ## @param      key    A hashable key identifying the request
+    ## @param      fetch  (function) Makes the request
+    ##
+    def do(self, key, fetch):
+        with self._lock:
+            self.calls += 1
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.waiters += 1
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return _copy_response(call.result)
+
+        try:
+            call.result = fetch()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+                waiters = call.waiters
+            call.done.set()
+        if waiters:
+            # The result is kept intact for the waiters to copy
+            return _copy_response(call.result)
+        return call.result
+
+    def stats(self):
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'coalesced': self.coalesced,
+                'in_flight': len(self._calls),
+                'waiting': sum(call.waiters for call in self._calls.values()),
+            }
+
+
+_single_flight = SingleFlight()
+
+
+##
+## @brief      Calls fetch once for all the concurrent callers with the same
+##             key, if SINGLE_FLIGHT is enabled.
+##
+def do(key, fetch):
+    if not config.settings.SINGLE_FLIGHT:
+        return fetch()
+    return _single_flight.do(key, fetch)
+
+
+def stats():
+    return _single_flight.stats()
@@ -0,0 +1,262 @@
+# @file snapshot.py
+# @brief Snapshot files of the ES indexes, served by the read-only replicas
+#        (ES_BACKEND = 'snapshot') without a cluster.
+#
+#        A snapshot holds the documents of one index, each as compact JSON,
+#        followed by a table of their offsets. It is memory-mapped read-only,
+#        so the workers of a host share the pages of the file, and a
+#        document is only decoded when it is first read. The decoded
+#        documents are held by each process: the searches of
+#        common/memory_es.py scan them all, which suits a corpus of a few
+#        terms but not an index ES would shard.
+#
+#        Layout, little-endian:
+#          header   magic, version, count, table offset, meta offset and
+#                   meta length (HEADER)
+#          docs     the _source of each document, as UTF-8 JSON
+#          table    count + 1 u64 offsets into the file, 8-byte aligned:
+#                   document i spans table[i]:table[i + 1]
+#          meta     JSON: index, creation date and the _id and _type of
+#                   each document
+#
+#        Build the snapshots of a cluster with
+#            python -m common.snapshot [directory]
+# @author Justin Chu (justinchuby@cmu.edu)
+
+import argparse
+import glob
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+
+import elasticsearch.helpers
+from elasticsearch_dsl.connections import connections
+
+from common.memory_es import InMemoryElasticsearch
+from config.es_config import ES_COURSE_INDEX_PREFIX, ES_FCE_INDEX,\
+                             SNAPSHOT_DIR
+
+MAGIC = b'CAPISNAP'
+# Version of the file format, checked when loading
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<8sIIQQQ')
+EXTENSION = '.snap'
+# The indexes dumped by default
+DEFAULT_PATTERNS = (ES_COURSE_INDEX_PREFIX + '*', ES_FCE_INDEX)
+
+
+def _json(obj):
+    return json.dumps(obj, separators=(',', ':'),
+                      ensure_ascii=False).encode('utf-8')
+
+
+##
+## @brief      Writes the snapshot of an index. The file is replaced
+##             atomically, so that a replica never maps a partial file.
+##
+## @param      path     The snapshot file
+## @param      index    (str) The name of the index
+## @param      hits     The documents, as ES hits with _type, _id and
+##                      _source
+## @param      created  (int) The creation date of the index in epoch
+##                      milliseconds
+##
+## @return     The number of documents written.
+##
+def write(path, index, hits, created):
+    ids, doc_types, offsets = [], [], []
+    tmp_path = '{}.tmp{}'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        # The header is written last, once the offsets are known
+        f.write(b'\0' * HEADER.size)
+        position = HEADER.size
+        for hit in hits:
+            data = _json(hit['_source'])
+            offsets.append(position)
+            f.write(data)
+            position += len(data)
+            ids.append(hit['_id'])
+            doc_types.append(hit['_type'])
+        offsets.append(position)
+        padding = -position % 8
+        f.write(b'\0' * padding)
+        table_offset = position + padding
+        f.write(struct.pack('<{}Q'.format(len(offsets)), *offsets))
+        meta = {'index': index, 'created': created, 'ids': ids}
+        if len(set(doc_types)) == 1:
+            meta['doc_type'] = doc_types[0]
+        else:
+            meta['doc_types'] = doc_types
+        meta_data = _json(meta)
+        meta_offset = table_offset + 8 * len(offsets)
+        f.write(meta_data)
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(ids), table_offset,
+                            meta_offset, len(meta_data)))
+    os.replace(tmp_path, path)
+    return len(ids)
+
+
+##
+## @brief      The documents of a snapshot file, as an index of
+##             InMemoryElasticsearch.
+##
+class SnapshotIndex(object):
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count, table_offset, meta_offset, meta_length = \
+            HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise ValueError("{} is not a snapshot".format(path))
+        if version != FORMAT_VERSION:
+            raise ValueError("Unsupported snapshot version {}".format(version))
+        meta = json.loads(
+            self._map[meta_offset:meta_offset + meta_length].decode('utf-8'))
+        self.index = meta['index']
+        # Creation date in epoch milliseconds
+        self.created = meta['created']
+        self._ids = meta['ids']
+        self._doc_types = meta.get('doc_types')
+        self._doc_type = meta.get('doc_type')
+        self._positions = {doc_id: position
+                           for position, doc_id in enumerate(self._ids)}
+        table_end = table_offset + 8 * (count + 1)
+        if sys.byteorder == 'little':
+            # Read in place
+            self._offsets = memoryview(self._map)[table_offset:table_end]\
+                .cast('Q')
+        else:
+            self._offsets = struct.unpack_from(
+                '<{}Q'.format(count + 1), self._map, table_offset)
+        # The decoded documents, kept since the client requires the same
+        # objects on every read
+        self._docs = [None] * count
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._docs)
+
+    def __iter__(self):
+        for position in range(len(self._docs)):
+            yield self._type(position), self._ids[position], \
+                self._doc(position)
+
+    def __repr__(self):
+        return "<SnapshotIndex: index={}, docs={}>".format(self.index,
+                                                          len(self))
+
+    def _type(self, position):
+        if self._doc_types is not None:
+            return self._doc_types[position]
+        return self._doc_type
+
+    def _doc(self, position):
+        doc = self._docs[position]
+        if doc is None:
+            with self._lock:
+                doc = self._docs[position]
+                if doc is None:
+                    start = self._offsets[position]
+                    end = self._offsets[position + 1]
+                    doc = self._docs[position] = json.loads(
+                        self._map[start:end].decode('utf-8'))
+        return doc
+
+    ##
+    ## @brief      Gets a document by _id.
+    ##
+    ## @return     (doc type, _source) or None if there is no such document.
+    ##
+    def get(self, doc_id):
+        position = self._positions.get(doc_id)
+        if position is None:
+            return None
+        return self._type(position), self._doc(position)
+
+    ##
+    ## @brief      Decodes all the documents. Called before forking, the
+    ##             workers start with the decoded documents instead of each
+    ##             decoding them on its first searches. Their pages are only
+    ##             shared until the reference counts written by the searches
+    ##             copy them, so each worker ends up holding its own copy.
+    ##
+    def warm(self):
+        for position in range(len(self._docs)):
+            self._doc(position)
+
+    def close(self):
+        if isinstance(self._offsets, memoryview):
+            self._offsets.release()
+        self._map.close()
+
+
+##
+## @brief      Creates a client serving the snapshots of a directory.
+##
+## @param      directory  The directory of the .snap files
+## @param      warm       Whether to decode all the documents now
+##
+## @return     An InMemoryElasticsearch.
+##
+def load_client(directory, warm=False):
+    indexes = {}
+    for path in sorted(glob.glob(os.path.join(directory, '*' + EXTENSION))):
+        snapshot_index = SnapshotIndex(path)
+        if warm:
+            snapshot_index.warm()
+        indexes[snapshot_index.index] = snapshot_index
+    if not indexes:
+        raise FileNotFoundError(
+            "No snapshot in {}. Build them with python -m common.snapshot"
+            .format(os.path.abspath(directory)))
+    return InMemoryElasticsearch(indexes)
+
+
+##
+## @brief      Dumps indexes into snapshot files named after them.
+##
+## @param      directory  The directory of the snapshots, created if needed
+## @param      patterns   The names of the indexes, wildcards allowed
+## @param      es         The client, the default connection if None
+##
+## @return     A list of (path, number of documents).
+##
+def build(directory, patterns=DEFAULT_PATTERNS, es=None):
+    if es is None:
+        es = connections.get_connection()
+    os.makedirs(directory, exist_ok=True)
+    settings = es.indices.get_settings(index=','.join(patterns))
+    written = []
+    for index in sorted(settings):
+        created = int(settings[index]['settings']['index']['creation_date'])
+        path = os.path.join(directory, index + EXTENSION)
+        hits = elasticsearch.helpers.scan(es, index=index,
+                                          query={'sort': ['_doc']})
+        written.append((path, write(path, index, hits, created)))
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Dumps the ES indexes into the snapshot files served "
+                    "with ES_BACKEND=snapshot.")
+    parser.add_argument('directory', nargs='?', default=SNAPSHOT_DIR)
+    parser.add_argument('--index', action='append', dest='patterns',
+                        help="An index to dump, wildcards allowed. May be "
+                             "repeated. Default: {}".format(
+                                 ', '.join(DEFAULT_PATTERNS)))
+    args = parser.parse_args()
+    from common import search
+    search.init_es_connection()
+    for path, count in build(args.directory,
+                             args.patterns or DEFAULT_PATTERNS):
+        print("{}: {} documents".format(path, count))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,418 @@
+# @file term_snapshot.py
+# @brief Columnar snapshots of the meeting times of a term, for the schedule
+#        queries (what is happening in a building at some time, how busy a
+#        room is) answered with vectorized masks over NumPy arrays instead of
+#        nested ES queries or loops over the courses.
+#
+#        A snapshot is saved as a .npy file of one record per meeting time,
+#        loaded memory-mapped, and a JSON sidecar holding the courseids and
+#        the names of the buildings and rooms the records refer to by code.
+#
+#        The occupancy endpoints are answered from the snapshots given by
+#        get(), built from ES and built again when the term changes. With
+#        TERM_SNAPSHOT_DIR, they are saved there and the workers map the file
+#        of a term instead of building it again.
+# @author Justin Chu (justinchuby@cmu.edu)
+
+import json
+import logging
+import os
+import threading
+
+try:
+    import numpy as np
+except ImportError:  # Only needed by the snapshots
+    np = None
+
+from elasticsearch_dsl import Search
+
+from common import index_version, utils
+from common.cmu_course import Course
+import config.course
+
+logger = logging.getLogger(__name__)
+
+# Version of the file format, checked when loading
+FORMAT_VERSION = 1
+
+LECTURE = 0
+SECTION = 1
+
+# One record per meeting time. Unknown times, buildings and rooms are -1.
+ROW_DTYPE = [
+    ('course', '<i4'),        # Position of the courseid in courseids
+    ('meeting_type', 'i1'),   # LECTURE or SECTION
+    ('meeting', '<i2'),       # Position of the meeting in the course
+    ('day_mask', 'u1'),       # Bit d set if the meeting is on day d (0: Sun)
+    ('begin', '<i2'),         # Minutes since midnight
+    ('end', '<i2'),
+    ('building', '<i2'),      # Position in buildings
+    ('room', '<i4'),          # Position in rooms
+]
+
+
+def _require_numpy():
+    if np is None:
+        raise ImportError("numpy is required by the term snapshots")
+
+
+class _Codes(object):
+    def __init__(self):
+        self.names = []
+        self._codes = {}
+
+    def code(self, name):
+        if name is None:
+            return -1
+        code = self._codes.get(name)
+        if code is None:
+            code = self._codes[name] = len(self.names)
+            self.names.append(name)
+        return code
+
+
+##
+## @brief      The meeting times of a term as parallel columns.
+##
+class TermSnapshot(object):
+    def __init__(self, index, rows, courseids, buildings, rooms, etag=None):
+        _require_numpy()
+        self.index = index
+        # The version of the index the snapshot was built from, if known
+        self.etag = etag
+        self.rows = rows
+        self.courseids = courseids
+        self.buildings = buildings
+        self.rooms = rooms
+        self._building_codes = {name: code
+                                for code, name in enumerate(buildings)}
+        self._room_codes = {name: code for code, name in enumerate(rooms)}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __repr__(self):
+        return "<TermSnapshot: index={}, courses={}, meeting times={}>".format(
+            self.index, len(self.courseids), len(self.rows))
+
+    ##
+    ## @brief      Builds the snapshot of a term from its scottylabs dicts.
+    ##
+    @classmethod
+    def build(cls, index, scotty_dicts, etag=None):
+        _require_numpy()
+        courseids = []
+        buildings, rooms = _Codes(), _Codes()
+        records = []
+        for scotty_dict in scotty_dicts:
+            course = Course(scotty_dict)
+            position = len(courseids)
+            courseids.append(course.courseid)
+            for meeting_type, meetings in ((LECTURE, course.lectures),
+                                           (SECTION, course.sections)):
+                for i, meeting in enumerate(meetings):
+                    for time_obj in meeting.times:
+                        records.append((
+                            position, meeting_type, i, time_obj.day_mask,
+                            _or_unknown(time_obj.begin_minutes),
+                            _or_unknown(time_obj.end_minutes),
+                            buildings.code(_upper(time_obj.building)),
+                            rooms.code(_upper(time_obj.room))))
+        rows = np.array(records, dtype=ROW_DTYPE)
+        return cls(index, rows, courseids, buildings.names, rooms.names,
+                   etag)
+
+    ##
+    ## @brief      Builds the snapshot of a term from the courses in ES.
+    ##
+    @classmethod
+    def from_es(cls, index, etag=None):
+        s = Search(index=index, doc_type='course')
+        return cls.build(index, (hit.to_dict() for hit in s.scan()), etag)
+
+    ##
+    ## @brief      Saves the snapshot as path (.npy) and path + .json. Each
+    ##             file is replaced atomically, the sidecar last, so that a
+    ##             worker never maps a partial file.
+    ##
+    def save(self, path):
+        if not path.endswith('.npy'):
+            path += '.npy'
+        tmp_path = '{}.tmp{}.npy'.format(path[:-len('.npy')], os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.save(f, self.rows, allow_pickle=False)
+        with open(_sidecar_path(tmp_path), 'w') as f:
+            json.dump({
+                'version': FORMAT_VERSION,
+                'index': self.index,
+                'etag': self.etag,
+                'rows': len(self.rows),
+                'courseids': self.courseids,
+                'buildings': self.buildings,
+                'rooms': self.rooms,
+            }, f)
+        os.replace(tmp_path, path)
+        os.replace(_sidecar_path(tmp_path), _sidecar_path(path))
+
+    ##
+    ## @brief      Selects the meeting times matching all the given
+    ##             conditions.
+    ##
+    ## @param      day       (int) The day of the week, 0 for Sunday
+    ## @param      begin     (int) The window of time, in minutes since
+    ## @param      end       midnight, both inclusive: the meetings that
+    ##                       begin no later than end and end after begin are
+    ##                       selected, as by the datetime endpoints
+    ## @param      building  (str) e.g. DH, case insensitive
+    ## @param      room      (str) e.g. 2315
+    ##
+    ## @return     A boolean array over the rows.
+    ##
+    def select(self, day=None, begin=None, end=None, building=None,
+               room=None):
+        rows = self.rows
+        mask = np.ones(len(rows), dtype=bool)
+        if day is not None:
+            mask &= (rows['day_mask'] & (1 << day)) != 0
+        if begin is not None or end is not None:
+            mask &= rows['begin'] >= 0
+        if begin is not None:
+            mask &= rows['end'] > begin
+        if end is not None:
+            mask &= rows['begin'] <= end
+        if building is not None:
+            mask &= rows['building'] == self._building_codes.get(
+                building.upper(), -2)
+        if room is not None:
+            mask &= rows['room'] == self._room_codes.get(room.upper(), -2)
+        return mask
+
+    ##
+    ## @brief      Gets the courseids of the selected meeting times.
+    ##
+    ## @return     A list of courseids in the order of the term.
+    ##
+    def get_courseids(self, mask):
+        positions = np.unique(self.rows['course'][mask])
+        return [self.courseids[position] for position in positions]
+
+    ##
+    ## @brief      Gets the courses having a meeting during a span of time,
+    ##             like get_courses_by_datetime does.
+    ##
+    ## @param      date_time     (datetime) The start, in local time
+    ## @param      span_minutes  (int) The length of the span
+    ##
+    def happening(self, date_time, span_minutes=0, building=None, room=None):
+        mask = np.zeros(len(self.rows), dtype=bool)
+        for day, begin, end in utils.get_time_windows(date_time,
+                                                      span_minutes):
+            mask |= self.select(day, begin, end, building, room)
+        return self.get_courseids(mask)
+
+    ##
+    ## @brief      Counts the meetings in session during each bin of time of
+    ##             each day of the week.
+    ##
+    ## @param      mask         Restricts the count to the rows given by
+    ##                          select(), e.g. those of a building
+    ## @param      bin_minutes  (int) The length of a bin, dividing a day
+    ##
+    ## @return     An array of 7 days x (1440 / bin_minutes) counts.
+    ##
+    def occupancy(self, mask=None, bin_minutes=60):
+        bins = utils.MINUTES_PER_DAY // bin_minutes
+        rows = self.rows
+        known = rows['begin'] >= 0
+        if mask is not None:
+            known &= mask
+        rows = rows[known]
+        first = rows['begin'] // bin_minutes
+        # The bin after the last one the meeting is in session in
+        last = np.minimum(-(-rows['end'] // bin_minutes), bins)
+        counts = np.zeros((7, bins), dtype=np.int32)
+        for day in range(7):
+            on_day = (rows['day_mask'] & (1 << day)) != 0
+            change = np.bincount(first[on_day], minlength=bins + 1) - \
+                np.bincount(last[on_day], minlength=bins + 1)
+            counts[day] = np.cumsum(change)[:bins]
+        return counts
+
+    ##
+    ## @brief      Sums the minutes per week each room is in use.
+    ##
+    ## @return     A dict {(building, room): minutes}.
+    ##
+    def room_minutes(self, mask=None):
+        rows = self.rows
+        known = (rows['begin'] >= 0) & (rows['building'] >= 0) & \
+            (rows['room'] >= 0)
+        if mask is not None:
+            known &= mask
+        rows = rows[known]
+        days = np.zeros(len(rows), dtype=np.int32)
+        for day in range(7):
+            days += (rows['day_mask'] >> day) & 1
+        minutes = (rows['end'].astype(np.int32) - rows['begin']) * days
+        # One code per pair of building and room
+        rooms = rows['building'].astype(np.int64) * len(self.rooms) + \
+            rows['room']
+        totals = np.bincount(rooms, weights=minutes)
+        result = {}
+        for code in np.nonzero(totals)[0]:
+            building, room = divmod(int(code), len(self.rooms))
+            result[(self.buildings[building], self.rooms[room])] = \
+                int(totals[code])
+        return result
+
+
+def _or_unknown(value):
+    return -1 if value is None else value
+
+
+def _upper(name):
+    return name.upper() if name else None
+
+
+def _sidecar_path(path):
+    if path.endswith('.npy'):
+        path = path[:-len('.npy')]
+    return path + '.json'
+
+
+##
+## @brief      Loads a snapshot saved by TermSnapshot.save().
+##
+## @param      path  The .npy file
+## @param      mmap  Whether to map the file instead of reading it, so that
+##                   the workers of a host share its pages
+##
+def load(path, mmap=True):
+    _require_numpy()
+    if not path.endswith('.npy'):
+        path += '.npy'
+    with open(_sidecar_path(path)) as f:
+        meta = json.load(f)
+    if meta.get('version') != FORMAT_VERSION:
+        raise ValueError("Unsupported snapshot version {}".format(
+            meta.get('version')))
+    rows = np.load(path, mmap_mode='r' if mmap else None,
+                   allow_pickle=False)
+    if len(rows) != meta['rows']:
+        raise ValueError("{} does not match its sidecar".format(path))
+    return TermSnapshot(meta['index'], rows, meta['courseids'],
+                        meta['buildings'], meta['rooms'], meta.get('etag'))
+
+
+##
+## @brief      The file of a version of a term in TERM_SNAPSHOT_DIR. A file
+##             is never rewritten once its sidecar exists.
+##
+def _file_path(index, etag):
+    return os.path.join(config.course.TERM_SNAPSHOT_DIR,
+                        '{}.{}.npy'.format(index, etag))
+
+
+##
+## @brief      Maps the file of a version of a term from TERM_SNAPSHOT_DIR.
+##
+## @return     (TermSnapshot) or None if there is no such file.
+##
+def _load_file(index, etag):
+    path = _file_path(index, etag)
+    if not os.path.exists(_sidecar_path(path)):
+        return None
+    try:
+        snapshot = load(path)
+    except (OSError, ValueError, KeyError) as e:
+        logger.warning("Cannot load the snapshot %s: %s", path, e)
+        return None
+    if snapshot.index != index or snapshot.etag != etag:
+        return None
+    return snapshot
+
+
+##
+## @brief      Saves the snapshot of a version of a term to TERM_SNAPSHOT_DIR
+##             and removes the files of its other versions. The workers
+##             still mapping them keep their pages.
+##
+def _save_file(snapshot):
+    path = _file_path(snapshot.index, snapshot.etag)
+    try:
+        os.makedirs(config.course.TERM_SNAPSHOT_DIR, exist_ok=True)
+        snapshot.save(path)
+        for name in os.listdir(config.course.TERM_SNAPSHOT_DIR):
+            other = os.path.join(config.course.TERM_SNAPSHOT_DIR, name)
+            if (name.startswith(snapshot.index + '.') and
+                    other not in (path, _sidecar_path(path)) and
+                    '.tmp' not in name):
+                os.remove(other)
+    except OSError as e:
+        # Served from memory, built again by the next worker
+        logger.warning("Cannot save the snapshot of %s: %s",
+                       snapshot.index, e)
+
+
+def _build(index, etag):
+    use_file = config.course.TERM_SNAPSHOT_DIR and etag is not None
+    if use_file:
+        snapshot = _load_file(index, etag)
+        if snapshot is not None:
+            return snapshot
+    snapshot = TermSnapshot.from_es(index, etag)
+    if use_file:
+        _save_file(snapshot)
+    return snapshot
+
+
+# ES index -> (etag of the index, TermSnapshot)
+_snapshots = {}
+# ES index -> the lock held while its snapshot is built
+_building = {}
+_lock = threading.Lock()
+
+
+def _fresh(index, etag):
+    built_etag, snapshot = _snapshots.get(index, (None, None))
+    if snapshot is not None and (etag is None or etag == built_etag):
+        return snapshot
+    return None
+
+
+##
+## @brief      Gets the snapshot of a term, built the first time and whenever
+##             the version of the index changes, by one thread at a time. The
+##             snapshots of the other terms are served meanwhile. The last
+##             snapshot is kept while ES cannot tell the version.
+##
+## @param      index  (str) The ES index of the term, e.g. course-f17
+##
+def get(index):
+    _require_numpy()
+    version = index_version.get(index)
+    etag = version.etag if version is not None else None
+    with _lock:
+        snapshot = _fresh(index, etag)
+        if snapshot is not None:
+            return snapshot
+        building = _building.setdefault(index, threading.Lock())
+    with building:
+        with _lock:
+            # Built by the thread holding the lock before
+            snapshot = _fresh(index, etag)
+        if snapshot is None:
+            snapshot = _build(index, etag)
+            with _lock:
+                _snapshots[index] = (etag, snapshot)
+        return snapshot
+
+
+def unload(index):
+    with _lock:
+        return _snapshots.pop(index, (None, None))[1]
+
+
+def clear():
+    with _lock:
+        _snapshots.clear()
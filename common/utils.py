@@ -1,10 +1,37 @@
 import re
+import json
+import base64
 import datetime
+import functools
 import string
 import copy
+import fnmatch
+from flask import request
+try:
+    import orjson
+except ImportError:  # Optional, json is used without it
+    orjson = None
+from common import Message
+import config.settings
 from config.course import ES_COURSE_INDEX_PREFIX
 
 
+##
+## @brief      Serializes an object to UTF-8 JSON, with orjson when it is
+##             installed and FAST_JSON is on.
+##
+## @return     (bytes)
+##
+def dumps_json(obj):
+    if orjson is not None and config.settings.FAST_JSON:
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            # e.g. keys that are not strings, which json converts
+            pass
+    return json.dumps(obj).encode('utf-8')
+
+
 def formatErrMsg(e, header=""):
     if not header.endswith("_"):
         header += "_"
@@ -86,6 +113,74 @@ def parse_time(time_string):
         return None
 
 
+MINUTES_PER_DAY = 24 * 60
+
+
+##
+## @brief      Parses a time of the day, e.g. 01:30PM or 13:30, into minutes
+##             since midnight. Accepts what parse_time accepts without the
+##             cost of strptime.
+##
+## @return     (int) or None if the string is not a time.
+##
+def parse_minutes(time_string):
+    if not isinstance(time_string, str):
+        return None
+    s = time_string.strip().upper()
+    suffix = s[-2:]
+    if suffix in ('AM', 'PM'):
+        s = s[:-2]
+    hour, sep, minute = s.partition(':')
+    if not (sep and hour.isdigit() and minute.isdigit() and
+            len(hour) <= 2 and len(minute) <= 2):
+        return None
+    hour, minute = int(hour), int(minute)
+    if minute > 59:
+        return None
+    if suffix in ('AM', 'PM'):
+        if not 1 <= hour <= 12:
+            return None
+        hour = hour % 12 + (12 if suffix == 'PM' else 0)
+    elif hour > 23:
+        return None
+    return hour * 60 + minute
+
+
+##
+## @brief      Converts a datetime.time to the number of minutes since midnight.
+##
+def time_to_minutes(time):
+    return time.hour * 60 + time.minute
+
+
+##
+## @brief      Formats minutes since midnight as hh:mma, e.g. 01:30PM.
+##
+def format_minutes(minutes):
+    return datetime.time(minutes // 60, minutes % 60).strftime("%I:%M%p")
+
+
+##
+## @brief      Gets the windows of time covered by a span starting at a
+##             datetime, split at midnight.
+##
+## @param      date_time     (datetime) The start, in local time.
+## @param      span_minutes  (int) The length of the span.
+##
+## @return     A list of (day, begin, end) tuples, where day is 0 for Sunday
+##             and begin/end are minutes since midnight, both inclusive.
+##             A span crossing midnight gives one window on each day.
+##
+def get_time_windows(date_time, span_minutes=0):
+    day = date_time.isoweekday() % 7
+    begin = time_to_minutes(date_time.time())
+    end = begin + span_minutes
+    if end < MINUTES_PER_DAY:
+        return [(day, begin, end)]
+    return [(day, begin, MINUTES_PER_DAY - 1),
+            ((day + 1) % 7, 0, end - MINUTES_PER_DAY)]
+
+
 ##
 ## @brief      Get the mini term.
 ##
@@ -172,6 +267,130 @@ def word_limit(f):
     return g
 
 
+##
+## @brief      Filters the fields of a document like the _source filtering of
+##             ES. Patterns are matched against the dotted path of a field,
+##             e.g. lectures.instructors, and may contain wildcards.
+##
+## @param      doc       (dict) The document
+## @param      includes  A list of patterns of the fields to keep, None to
+##                       keep every field
+## @param      excludes  A list of patterns of the fields to leave out
+##
+## @return     (dict) A new document, sharing the values that are kept as is.
+##
+def filter_source(doc, includes=None, excludes=None, prefix=''):
+    filtered = {}
+    for key, value in doc.items():
+        path = prefix + key
+        if excludes and any(fnmatch.fnmatchcase(path, pattern)
+                            for pattern in excludes):
+            continue
+        if (not includes or
+                any(fnmatch.fnmatchcase(path, pattern)
+                    for pattern in includes)):
+            if excludes and isinstance(value, (dict, list)):
+                value = _filter_value(value, None, excludes, path + '.')
+            filtered[key] = value
+        elif isinstance(value, (dict, list)) and \
+                any(pattern.startswith(path + '.') or pattern.startswith('*')
+                    for pattern in includes):
+            # Some fields of the object are included
+            value = _filter_value(value, includes, excludes, path + '.')
+            if value:
+                filtered[key] = value
+    return filtered
+
+
+def _filter_value(value, includes, excludes, prefix):
+    if isinstance(value, dict):
+        return filter_source(value, includes, excludes, prefix)
+    if any(isinstance(elem, dict) for elem in value):
+        return [filter_source(elem, includes, excludes, prefix)
+                if isinstance(elem, dict) else elem for elem in value]
+    return value
+
+
+##
+## @brief      Copies a JSON-like object. Much cheaper than copy.deepcopy for
+##             the nested dicts and lists returned by the search functions.
+##
+def copy_json(obj):
+    if isinstance(obj, dict):
+        return {key: copy_json(value) for key, value in obj.items()}
+    if isinstance(obj, list):
+        return [copy_json(value) for value in obj]
+    return obj
+
+
+##
+## @brief      Encodes the sort values of the last hit of a page into the
+##             opaque cursor given to the client to get the next page.
+##
+def encode_cursor(sort_values):
+    data = json.dumps(sort_values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+##
+## @brief      Decodes a cursor given by encode_cursor().
+##
+## @return     (list) The sort values to search after.
+##
+## @exception  ValueError  If the cursor is malformed.
+##
+def decode_cursor(cursor):
+    try:
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        sort_values = json.loads(data.decode('utf-8'))
+    except (TypeError, ValueError, UnicodeDecodeError):
+        raise ValueError("Malformed cursor")
+    if not isinstance(sort_values, list) or not sort_values:
+        raise ValueError("Malformed cursor")
+    return sort_values
+
+
+##
+## @brief      Parses the page_size and cursor arguments of a request.
+##
+## @return     (page_size, search_after), (None, None) if the request does
+##             not ask for a page.
+##
+## @exception  ValueError  If an argument is malformed.
+##
+def parse_page(args):
+    if 'page_size' not in args and 'cursor' not in args:
+        return None, None
+    page_size = int(args.get('page_size', config.settings.PAGE_SIZE_DEFAULT))
+    if not 0 < page_size <= config.settings.PAGE_SIZE_LIMIT:
+        raise ValueError("Page size out of range")
+    search_after = None
+    if 'cursor' in args:
+        search_after = decode_cursor(args['cursor'])
+    return page_size, search_after
+
+
+##
+## @brief      Passes the page_size and search_after of a paged request to the
+##             handler, or answers 400 if they are malformed.
+##
+def paged(f):
+    @functools.wraps(f)
+    def g(*args, **kwargs):
+        try:
+            kwargs['page_size'], kwargs['search_after'] = \
+                parse_page(request.args)
+        except ValueError:
+            return {
+                'status': 400,
+                'error': {
+                    'message': Message.PAGE_PARSE_FAIL
+                }
+            }, 400
+        return f(*args, **kwargs)
+    return g
+
+
 class _Tests():
     @staticmethod
     def test_parse_time():
@@ -179,3 +398,40 @@ class _Tests():
         assert(datetime.time(20, 15) == parse_time("8:15PM"))
         assert(datetime.time(8, 0) == parse_time("8:00"))
         assert(datetime.time(20, 0) == parse_time("20:00"))
+        for time_string in ("8:15am", "8:15PM", "8:00", "20:00", "12:05AM",
+                            "12:05PM", "13:00PM", "8:60", "TBA", ""):
+            time = parse_time(time_string)
+            assert(parse_minutes(time_string) ==
+                   (time_to_minutes(time) if time is not None else None))
+
+    @staticmethod
+    def test_get_time_windows():
+        # Saturday 11:30PM with a span of 60 minutes goes into Sunday
+        date_time = datetime.datetime(2017, 9, 2, 23, 30)
+        assert(get_time_windows(date_time, 0) == [(6, 1410, 1410)])
+        assert(get_time_windows(date_time, 60) == [(6, 1410, 1439),
+                                                   (0, 0, 30)])
+        assert(format_minutes(810) == "01:30PM")
+
+    @staticmethod
+    def test_filter_source():
+        doc = {'id': '15-112', 'desc': 'Fundamentals',
+               'lectures': [{'name': 'Lec 1', 'instructors': ['Kosbie']}]}
+        assert(filter_source(doc, None, ['desc']) ==
+               {'id': '15-112',
+                'lectures': [{'name': 'Lec 1', 'instructors': ['Kosbie']}]})
+        assert(filter_source(doc, ['id', 'lectures.name']) ==
+               {'id': '15-112', 'lectures': [{'name': 'Lec 1'}]})
+        assert(filter_source(doc, ['lectures'], ['*.instructors']) ==
+               {'lectures': [{'name': 'Lec 1'}]})
+
+    @staticmethod
+    def test_cursor():
+        sort_values = ['15-112', 'course#15-112']
+        assert(decode_cursor(encode_cursor(sort_values)) == sort_values)
+        for cursor in ('', 'not a cursor', encode_cursor({})):
+            try:
+                decode_cursor(cursor)
+                assert(False)
+            except ValueError:
+                pass
@@ -0,0 +1,216 @@
+# @file warmup.py
+# @brief Warms a worker up before it serves: connects to ES, opens the
+#        connection pool, reads the versions of the current term, loads
+#        the local indexes and the FCE rollup and reads the course IDs of
+#        the current term, so that the first requests do not pay for them.
+#
+#        Under gunicorn (gunicorn.conf.py) prefork() runs in the master once
+#        the app is preloaded and run() in each worker after the fork, before
+#        it accepts requests. Elsewhere, the first request starts it in the
+#        background. A failed warmup is retried in the background, with
+#        backoff, while the worker serves its requests as if it was cold.
+#        /health only reports a worker ready once run() has succeeded.
+# @author Justin Chu (justinchuby@cmu.edu)
+
+import logging
+import threading
+import time
+
+from elasticsearch_dsl.connections import connections
+
+from common import fce_rollup, index_version, search, utils
+import config.course
+import config.es_config
+import config.fce
+import config.settings
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_connect_lock = threading.Lock()
+_thread_lock = threading.Lock()
+_ready = threading.Event()
+# Whether the default ES connection exists in this process
+_connected = False
+_thread = None
+_error = None
+# step -> seconds
+_steps = {}
+
+
+def _step(name, f, *args):
+    start = time.perf_counter()
+    result = f(*args)
+    _steps[name] = time.perf_counter() - start
+    return result
+
+
+def _connect():
+    global _connected
+    with _connect_lock:
+        if not _connected:
+            search.init_es_connection()
+            _connected = True
+
+
+##
+## @brief      Creates the default ES connection of the worker, if it does not
+##             exist yet. Opens no socket, the requests can be served once it
+##             returns, warm or not.
+##
+def connect():
+    if not _connected:
+        _connect()
+
+
+##
+## @brief      Opens up to WARMUP_CONNECTIONS connections of the pool with
+##             concurrent requests, along with their TLS sessions.
+##
+def _open_pool():
+    es = connections.get_connection()
+    count = min(config.settings.WARMUP_CONNECTIONS,
+                config.es_config.ES_MAXSIZE)
+    errors = []
+
+    def request():
+        try:
+            es.info()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=request) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+def _prime_versions():
+    indexes = {utils.get_current_course_index(),
+               config.es_config.ES_FCE_INDEX}
+    # The changes of the terms loaded in memory are only seen against a
+    # known version
+    indexes.update(search.get_course_index(term)
+                   for term in config.course.LOCAL_INDEX_TERMS)
+    index_version.refresh(sorted(indexes))
+
+
+##
+## @brief      Reads the course IDs of the current term into the cache of
+##             /list-all-courses/, from its local index if it has one.
+##
+def _prime_current_term():
+    output = search.list_all_courses('current')
+    response = output['response']
+    if not search.has_error(response):
+        return
+    if response['status'] == 404:
+        # Not scraped yet, e.g. at the start of a term: there is nothing
+        # to warm, its requests are answered with a 404 either way
+        logger.warning("No index for the current term: %s",
+                       response.get('error'))
+        return
+    raise RuntimeError("Cannot read the courses of the current term: {}"
+                       .format(response.get('error')))
+
+
+##
+## @brief      Decodes the snapshots in the master, so that the workers do
+##             not each decode them on their first searches. Opens no
+##             socket: the connections to ES are opened by run() in each
+##             worker.
+##
+def prefork():
+    if config.es_config.ES_BACKEND != 'snapshot':
+        return
+    with _lock:
+        _step('connect', _connect)
+        for snapshot_index in connections.get_connection().indexes.values():
+            _step('decode ' + snapshot_index.index, snapshot_index.warm)
+
+
+##
+## @brief      Warms the worker up, once. Blocks until it is warm; raises
+##             the error of the warmup if it fails, in which case the next
+##             call tries again. Every step is made again by a new try.
+##
+def run():
+    global _error
+    if _ready.is_set():
+        return
+    with _lock:
+        if _ready.is_set():
+            return
+        start = time.perf_counter()
+        try:
+            _step('connect', _connect)
+            _step('pool', _open_pool)
+            # Read first, so that a change of the data while the local
+            # indexes load is seen as a change of version
+            _step('index versions', _prime_versions)
+            _step('local indexes', search.init_local_indexes)
+            # After the local indexes, whose loading empties the cache of
+            # their terms
+            _step('current term', _prime_current_term)
+            if config.fce.FCE_ROLLUP:
+                _step('fce rollup', fce_rollup.init)
+        except Exception as e:
+            _error = e
+            raise
+        _error = None
+        _steps['total'] = time.perf_counter() - start
+        _ready.set()
+
+
+def _run_until_ready():
+    delay = config.settings.WARMUP_RETRY_DELAY
+    while True:
+        try:
+            run()
+            return
+        except Exception as e:
+            # Kept in _error for status()
+            logger.warning("Warmup failed, retrying in %s s: %s", delay, e)
+        time.sleep(delay)
+        delay = min(delay * 2, config.settings.WARMUP_RETRY_MAX_DELAY)
+
+
+##
+## @brief      Starts run() in the background, tried again with backoff until
+##             it succeeds, unless it is ready or already running.
+##
+def start():
+    global _thread
+    if _ready.is_set():
+        return
+    with _thread_lock:
+        if _thread is not None and _thread.is_alive():
+            return
+        _thread = threading.Thread(target=_run_until_ready, daemon=True)
+        _thread.start()
+
+
+def is_ready():
+    return _ready.is_set()
+
+
+##
+## @brief      Gets the state of the warmup, for /health.
+##
+## @return     A dictionary {status: ready, warming or failed, seconds: the
+##             time each step took, error: the last error if it failed}.
+##
+def status():
+    if _ready.is_set():
+        state = 'ready'
+    elif _error is not None:
+        state = 'failed'
+    else:
+        state = 'warming'
+    result = {'status': state, 'seconds': dict(_steps)}
+    if _error is not None:
+        result['error'] = '{}: {}'.format(type(_error).__name__, _error)
+    return result
@@ -0,0 +1,35 @@
+import os
+import ast
+
+
+# Set CACHE_ENABLED=False in the environment to bypass the result cache
+CACHE_ENABLED = ast.literal_eval(os.environ.get('CACHE_ENABLED', 'True'))
+
+# Maximum number of search results kept in memory by each worker
+CACHE_MAX_SIZE = int(os.environ.get('CACHE_MAX_SIZE', 2048))
+
+# Time to live of the cached results, in seconds, per endpoint.
+# Course data only changes when a new scrape is indexed, so these can be long.
+# An endpoint with a TTL of 0 is not cached.
+CACHE_TTL = {
+    'course': 600,
+    'instructor': 600,
+    'building_room': 600,
+    'fce': 3600,
+    # The course IDs of a term, dropped when the term is reloaded
+    'list': 3600,
+}
+
+# Shared cache tier, e.g. redis://localhost:6379/0. Unset to only cache in
+# each worker.
+REDIS_URL = os.environ.get('REDIS_URL')
+# Socket timeout of the Redis requests, in seconds
+REDIS_TIMEOUT = float(os.environ.get('REDIS_TIMEOUT', 0.5))
+SHARED_CACHE_PREFIX = os.environ.get('SHARED_CACHE_PREFIX', 'courseapi')
+# Seconds a shared entry is still served after its TTL, while one worker
+# refreshes it
+SHARED_CACHE_GRACE = 60
+# Seconds the refresh lock of an entry is held at most, and seconds a worker
+# waits for an entry being computed by another worker
+SHARED_CACHE_LOCK_TTL = 10
+SHARED_CACHE_LOCK_WAIT = 2.0
@@ -1,3 +1,5 @@
+import os
+import ast
 from config.es_config import *
 
 
@@ -5,3 +7,32 @@ BASE_URL = '/course/v1'
 
 SPAN_LOWER_LIMIT = 0
 SPAN_UPPER_LIMIT = 120
+
+# Bounds of the bins of the occupancy endpoints, in minutes
+OCCUPANCY_BIN_LOWER_LIMIT = 5
+OCCUPANCY_BIN_UPPER_LIMIT = 24 * 60
+
+# Maximum number of courses in one request to the batch endpoint
+BATCH_SIZE_LIMIT = 50
+
+# Number of courses fetched from ES and written out at a time by the
+# streamed responses (?stream), and how long ES keeps their scroll contexts
+STREAM_CHUNK_SIZE = 100
+STREAM_SCROLL = '1m'
+
+# Directory the term snapshots of the occupancy endpoints are saved to and
+# mapped from (common/term_snapshot.py), shared by the workers of a host.
+# Unset to build them in each worker.
+TERM_SNAPSHOT_DIR = os.environ.get('TERM_SNAPSHOT_DIR')
+
+# Number of course IDs read from ES at a time by list-all-courses
+LIST_CHUNK_SIZE = 1000
+
+# Course documents are keyed by courseid, so a lookup by courseid in a term
+# is a GET of the document. Set to True to fall back to a search when the
+# document is not found, e.g. for an index keyed differently.
+COURSE_GET_FALLBACK = ast.literal_eval(os.environ.get('COURSE_GET_FALLBACK', 'False'))
+
+# Terms whose courses are held in memory by each worker and served without
+# querying ES, e.g. "['current']". ES is only used to load them.
+LOCAL_INDEX_TERMS = ast.literal_eval(os.environ.get('LOCAL_INDEX_TERMS', '[]'))
@@ -32,5 +32,40 @@ except Exception as err:
     print(err)
     print("Please configure ES service in es_config.py correctly.")
 
+# Connection pool of each worker. Every worker keeps up to ES_MAXSIZE
+# persistent connections to each ES host.
+ES_MAXSIZE = int(os.environ.get('ES_MAXSIZE', 10))
+# Default timeout of a request to ES, in seconds
+ES_TIMEOUT = float(os.environ.get('ES_TIMEOUT', 20))
+ES_MAX_RETRIES = int(os.environ.get('ES_MAX_RETRIES', 3))
+ES_RETRY_ON_TIMEOUT = ast.literal_eval(os.environ.get('ES_RETRY_ON_TIMEOUT', 'True'))
+# Sniffing is not supported by the AWS Elasticsearch service
+ES_SNIFF_ON_START = ast.literal_eval(os.environ.get('ES_SNIFF_ON_START', 'False'))
+ES_SNIFF_ON_CONNECTION_FAIL = ast.literal_eval(
+    os.environ.get('ES_SNIFF_ON_CONNECTION_FAIL', 'False'))
+# Seconds between two sniffs, None to disable periodic sniffing
+ES_SNIFFER_TIMEOUT = ast.literal_eval(os.environ.get('ES_SNIFFER_TIMEOUT', 'None'))
+# Timeout of the requests to ES made by each endpoint, in seconds.
+# Endpoints not listed use ES_TIMEOUT.
+ES_REQUEST_TIMEOUTS = {
+    'course': 5,
+    'instructor': 10,
+    'building_room': 10,
+    'datetime': 10,
+    'search': 10,
+    'fce': 10,
+    # Per scroll request of list-all-courses
+    'list': 10,
+    # Per request reading the version of an index (common/index_version.py),
+    # made before the request is handled
+    'version': 2,
+}
+
 ES_COURSE_INDEX_PREFIX = 'course-'
 ES_FCE_INDEX = 'fce'
+
+# Where the api reads the documents from: 'es' for the cluster, or
+# 'snapshot' for the snapshot files in SNAPSHOT_DIR (read-only replicas, see
+# common/snapshot.py)
+ES_BACKEND = os.environ.get('ES_BACKEND', 'es')
+SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR', 'snapshots')
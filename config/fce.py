@@ -1,4 +1,33 @@
+import os
+import ast
 from config.es_config import *
 
 
 BASE_URL = '/fce/v1'
+
+# Schema of the fce index assumed by the summary endpoints.
+# The numeric fields summarized, by the name they are reported under. The
+# ratings are on a scale of 1 to 5.
+SUMMARY_FIELDS = {
+    'hrs_per_week': 'hrs_per_week',
+    'interest': 'rating.interest',
+    'clear_goals': 'rating.clear_goals',
+    'overall_teaching': 'rating.overall_teaching',
+    'overall_course': 'rating.overall_course',
+}
+# The fields the rows are grouped by. The instructor is a text field, its
+# keyword subfield is created by the dynamic mapping of ES 5. courseid is
+# mapped as a keyword, since it is matched with a term query.
+YEAR_FIELD = 'year'
+INSTRUCTOR_FIELD = 'instructor.keyword'
+COURSEID_FIELD = 'courseid'
+# Percentiles reported for each field
+SUMMARY_PERCENTS = [25, 50, 75]
+# Maximum number of groups of each grouping, e.g. years
+SUMMARY_BUCKETS = 50
+
+# Serve the summaries from the rollups of common/fce_rollup.py, refreshed
+# whenever the fce index changes. Requires numpy.
+FCE_ROLLUP = ast.literal_eval(os.environ.get('FCE_ROLLUP', 'False'))
+# The file the rollup is saved to and loaded from at startup, if any
+FCE_ROLLUP_FILE = os.environ.get('FCE_ROLLUP_FILE')
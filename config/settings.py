@@ -1,6 +1,49 @@
 import os
+import ast
 
 DEBUG = None
 
 RAYGUN_APIKEY = os.environ.get('RAYGUN_APIKEY')
 SENTRY_DSN = os.environ.get('SENTRY_DSN')
+
+# Handler threads per worker in the asyncio serving mode (asgi.py), serving
+# the endpoints without an async version a request at a time
+ASGI_HANDLER_THREADS = int(os.environ.get('ASGI_HANDLER_THREADS', 64))
+
+# Number of results per page of the endpoints taking page_size and cursor
+PAGE_SIZE_DEFAULT = 20
+PAGE_SIZE_LIMIT = 100
+
+# Seconds an index version (the ETag and Last-Modified of the responses)
+# is reused before the versions of all the indexes are read again from ES,
+# in the background while the last ones are still answered
+INDEX_VERSION_TTL = int(os.environ.get('INDEX_VERSION_TTL', 30))
+# Cache-Control of the responses carrying an ETag. CDNs and clients reuse
+# them for as long as a worker reuses the version they were validated
+# against, and revalidate them with If-None-Match afterwards.
+HTTP_CACHE_CONTROL = os.environ.get(
+    'HTTP_CACHE_CONTROL', 'public, max-age={}'.format(INDEX_VERSION_TTL))
+
+# Set SINGLE_FLIGHT=False to send identical concurrent ES requests of a worker
+# separately instead of waiting for the one in flight
+SINGLE_FLIGHT = ast.literal_eval(os.environ.get('SINGLE_FLIGHT', 'True'))
+
+# Threads per worker fetching the parts of a joined response, e.g. the FCEs
+# of /course/v1/course/<id>/fce/, while the request thread fetches the course
+JOIN_THREADS = int(os.environ.get('JOIN_THREADS', 16))
+
+# Connections to ES each worker opens while warming up (common/warmup.py),
+# at most ES_MAXSIZE
+WARMUP_CONNECTIONS = int(os.environ.get('WARMUP_CONNECTIONS', 4))
+# Seconds before a failed warmup is tried again, doubled after each failure
+# up to WARMUP_RETRY_MAX_DELAY
+WARMUP_RETRY_DELAY = float(os.environ.get('WARMUP_RETRY_DELAY', 1))
+WARMUP_RETRY_MAX_DELAY = float(os.environ.get('WARMUP_RETRY_MAX_DELAY', 60))
+
+# Set QUERY_TEMPLATES=False to build the query of each request with
+# elasticsearch_dsl instead of filling the compiled query of its shape
+QUERY_TEMPLATES = ast.literal_eval(os.environ.get('QUERY_TEMPLATES', 'True'))
+
+# Set FAST_JSON=False to serialize the responses with json even when orjson
+# is installed
+FAST_JSON = ast.literal_eval(os.environ.get('FAST_JSON', 'True'))
@@ -0,0 +1,35 @@
+# @file gunicorn.conf.py
+# @brief gunicorn settings: the app is imported once in the master, and each
+#        worker warms up (common/warmup.py) after the fork, before it accepts
+#        requests. The warmup must finish within the worker timeout.
+# @author Justin Chu (justinchuby@cmu.edu)
+
+import os
+
+# Import the app, arrow and elasticsearch_dsl before forking the workers
+preload_app = True
+
+# Threaded workers: a request waiting for ES only holds one of the threads
+# of its worker. Keep ES_MAXSIZE at least GUNICORN_THREADS, so that every
+# thread has a pooled connection.
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 10))
+
+
+def when_ready(server):
+    from common import warmup
+    warmup.prefork()
+
+
+def post_fork(server, worker):
+    from common import warmup
+    try:
+        warmup.run()
+    except Exception as e:
+        # The worker still serves, while the warmup is retried in the
+        # background and /health reports it failed
+        server.log.warning("Warmup of worker %s failed: %s", worker.pid, e)
+        warmup.start()
+    else:
+        server.log.info("Worker %s warmed up in %.2f s", worker.pid,
+                        warmup.status()['seconds']['total'])
@@ -1,6 +1,13 @@
-from flask import Flask, request
+import re
+from flask import Flask, Response, request, stream_with_context
 from flask_restful import Resource
-from common import Message, search, utils
+from common import Message, fce_rollup, search, utils
+import config.course
+
+COURSEID_PATTERN = r'^\d{2}-\d{3}$'
+TERM_PATTERN = r'^((f|s|m1|m2)\d{2}|current)$'
+# Dotted paths of the fields of a course, e.g. lectures.instructors
+FIELD_PATTERN = r'^[\w*]+(\.[\w*]+)*$'
 
 
 ##
@@ -28,7 +35,34 @@ def parse_url_array(args, field):
     return None
 
 
+#
+#
+# @brief      Gets the _source filter of a request from its fields argument,
+#             the fields to return, and its filtered_fields argument, the
+#             fields to leave out. The filtered fields are still set to None
+#             by format_response.
+#
+def parse_source_filter(args):
+    includes = [field for field in parse_url_array(args, 'fields') or []
+                if re.match(FIELD_PATTERN, field)]
+    excludes = [field
+                for field in parse_url_array(args, 'filtered_fields') or []
+                if is_valid_field(field)]
+    return search.get_source_filter(includes, excludes)
+
+
+def is_streamed(args):
+    return 'stream' in args
+
+
 def format_response(search_result, filtered_fields=None):
+    for key in ('courses', 'courseids'):
+        if (search_result['response'].get('status') is None and
+                not isinstance(search_result.get(key, []), list)):
+            # A generator given by search.stream_courses_output or
+            # search.list_all_courses
+            return stream_response(search_result, filtered_fields, key=key)
+
     if filtered_fields:
         for field in filtered_fields:
             if is_valid_field(field):
@@ -67,6 +101,45 @@ def format_response(search_result, filtered_fields=None):
     return response, code
 
 
+#
+#
+# @brief      Writes the {"courses": [...]} object of a streamed search result
+#             as the courses come from ES, a chunk of courses at a time.
+#             An error after the first chunk is added as "error", since the
+#             status code has been sent already.
+#
+# @param      key   The key of the list, courses or courseids
+#
+def stream_response(search_result, filtered_fields=None, key='courses'):
+    filtered_fields = [field for field in filtered_fields or []
+                       if is_valid_field(field)]
+
+    def generate():
+        items = search_result[key]
+        chunk = ['{"%s": [' % key]
+        try:
+            for i, item in enumerate(items):
+                for field in filtered_fields:
+                    item[field] = None
+                if i:
+                    chunk.append(', ')
+                chunk.append(utils.dumps_json(item).decode('utf-8'))
+                if len(chunk) >= 2 * config.course.STREAM_CHUNK_SIZE:
+                    yield ''.join(chunk)
+                    chunk = []
+        finally:
+            # Releases the ES scroll when the client goes away
+            items.close()
+        chunk.append(']')
+        if search.has_error(search_result['response']):
+            chunk.append(', "error": {"message": "Server Error"}')
+        chunk.append('}\n')
+        yield ''.join(chunk)
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/json')
+
+
 #
 #
 # @brief      Gets the course detail.
@@ -79,6 +152,23 @@ def format_response(search_result, filtered_fields=None):
 #
 def get_course_detail(courseid, index):
     result = search.get_course_by_id(courseid, index)
+    return format_course_detail(result, courseid, index)
+
+
+# @brief  Same as get_course_detail(), awaited by asgi.py
+async def get_course_detail_async(courseid, index):
+    result = await search.get_course_by_id_async(courseid, index)
+    return format_course_detail(result, courseid, index)
+
+
+#
+#
+# @brief      Formats the result of search.get_course_by_id.
+#
+# @return     (dict, int) A course-api Course object or the error message,
+#             along with the http response code.
+#
+def format_course_detail(result, courseid, index):
     course = result.get('course')
 
     if course is not None:
@@ -116,83 +206,286 @@ class CourseDetail(Resource):
     def get(self, courseid):
         return get_course_detail(courseid, None)
 
+    # @brief  Same as get(), served by asgi.py
+    async def get_async(self, courseid):
+        return await get_course_detail_async(courseid, None)
+
 
 class CourseDetailByTerm(Resource):
     def get(self, courseid, term):
         return get_course_detail(courseid, term)
 
+    async def get_async(self, courseid, term):
+        return await get_course_detail_async(courseid, term)
+
+
+#
+#
+# @brief      Gets a course with its FCEs attached, under fces, or with the
+#             summary of its FCEs under fce_summary if the request has the
+#             summary argument. The course and the FCEs are fetched
+#             concurrently, and the summary is taken from the FCE rollup
+#             when it is loaded. The FCEs are None if they cannot be read.
+#
+# @return     (dict, int) The response, as get_course_detail gives it.
+#
+def get_course_with_fces(courseid, index):
+    summary = 'summary' in request.args
+    fce_summary = fce_rollup.summarize('courseid', courseid) \
+        if summary else None
+    if fce_summary is not None:
+        result = search.get_course_by_id(courseid, index)
+        fce_result = {'response': {}, 'summary': fce_summary}
+    else:
+        result, fce_result = search.get_course_with_fces(
+            courseid, index, summary=summary, size=300)
+
+    response, code = format_course_detail(result, courseid, index)
+    if code == 200:
+        failed = fce_result['response'].get('status') is not None
+        if summary:
+            response['fce_summary'] = None if failed else fce_result['summary']
+        else:
+            response['fces'] = None if failed else fce_result['fces']
+    return response, code
+
+
+class CourseWithFCEs(Resource):
+    def get(self, courseid):
+        return get_course_with_fces(courseid, None)
+
+
+class CourseWithFCEsByTerm(Resource):
+    def get(self, courseid, term):
+        return get_course_with_fces(courseid, term)
+
+
+#
+#
+# @brief      Parses the body of a batch request. The body is either
+#             {"courseids": ["15-112", ...], "term": "f17"} or a list of
+#             {"courseid": "15-112", "term": "f17"} objects under "courses".
+#             term is optional.
+#
+# @return     A list of (courseid, term) tuples, each one once, or None if
+#             the body is malformed.
+#
+def parse_batch_items(body):
+    if not isinstance(body, dict):
+        return None
+    default_term = body.get('term')
+    requested = body.get('courseids', []), body.get('courses', [])
+    if not all(isinstance(part, list) for part in requested):
+        return None
+    items = []
+    for item in requested[0] + requested[1]:
+        if isinstance(item, str):
+            courseid, term = item, default_term
+        elif isinstance(item, dict) and isinstance(item.get('courseid'), str):
+            courseid, term = item['courseid'], item.get('term', default_term)
+        else:
+            return None
+        if not re.match(COURSEID_PATTERN, courseid):
+            return None
+        if term is not None and not (isinstance(term, str) and
+                                     re.match(TERM_PATTERN, term)):
+            return None
+        if (courseid, term) not in items:
+            items.append((courseid, term))
+    if not items:
+        return None
+    return items
+
+
+#
+# @brief      Gets the key of each item of a batch in its response: the
+#             courseid, followed by the term for a course asked for in
+#             several terms, e.g. 15-112/f17.
+#
+def batch_keys(items):
+    courseids = [courseid for courseid, term in items]
+    return [courseid if courseids.count(courseid) == 1 or term is None
+            else '{}/{}'.format(courseid, term)
+            for courseid, term in items]
+
+
+class CourseBatch(Resource):
+    def post(self):
+        items = parse_batch_items(request.get_json(silent=True))
+        if items is None:
+            return {
+                'status': 400,
+                'error': {
+                    'message': Message.BATCH_PARSE_FAIL
+                }
+            }, 400
+        if len(items) > config.course.BATCH_SIZE_LIMIT:
+            return {
+                'status': 400,
+                'error': {
+                    'message': Message.BATCH_SIZE_FAIL
+                }
+            }, 400
+
+        results = search.get_course_by_id_batch(items)
+        courses = {}
+        for key, (courseid, term), result in zip(batch_keys(items), items,
+                                                 results):
+            response, code = format_course_detail(result, courseid, term)
+            courses[key] = response.get('course', response)
+        return {'courses': courses}
+
 
 class CourseDetailAllTerms(Resource):
     def get(self, courseid):
-        result = search.get_courses_by_id(courseid)
+        source = parse_source_filter(request.args)
+        result = search.get_courses_by_id(courseid, source=source)
         filtered_fields = parse_url_array(request.args, 'filtered_fields')
         return format_response(result, filtered_fields)
 
 
 class Instructor(Resource):
+    @utils.paged
     @utils.word_limit
-    def get(self, name):
+    def get(self, name, page_size=None, search_after=None):
         args = request.args
         fuzzy = False
         if 'fuzzy' in args:
             fuzzy = True
-        result = search.get_courses_by_instructor(name, fuzzy=fuzzy, size=1000)
+        source = parse_source_filter(request.args)
+        stream = is_streamed(request.args) and page_size is None
+        result = search.get_courses_by_instructor(name, fuzzy=fuzzy, size=1000,
+                                                  source=source,
+                                                  stream=stream,
+                                                  page_size=page_size,
+                                                  search_after=search_after)
         filtered_fields = parse_url_array(request.args, 'filtered_fields')
         return format_response(result, filtered_fields)
 
+    # @brief  Same as get() without stream, served by asgi.py
+    @utils.paged
+    @utils.word_limit
+    async def get_async(self, name, page_size=None, search_after=None):
+        return await get_courses_by_instructor_async(name, None, 1000,
+                                                     page_size, search_after)
+
 
 class InstructorByTerm(Resource):
+    @utils.paged
     @utils.word_limit
-    def get(self, name, term):
+    def get(self, name, term, page_size=None, search_after=None):
         args = request.args
         fuzzy = False
         if 'fuzzy' in args:
             fuzzy = True
+        source = parse_source_filter(request.args)
+        stream = is_streamed(request.args) and page_size is None
         result = search.get_courses_by_instructor(name, fuzzy=fuzzy,
-                                                  index=term, size=500)
+                                                  index=term, size=500,
+                                                  source=source,
+                                                  stream=stream,
+                                                  page_size=page_size,
+                                                  search_after=search_after)
         filtered_fields = parse_url_array(request.args, 'filtered_fields')
         return format_response(result, filtered_fields)
 
+    @utils.paged
+    @utils.word_limit
+    async def get_async(self, name, term, page_size=None, search_after=None):
+        return await get_courses_by_instructor_async(name, term, 500,
+                                                     page_size, search_after)
+
+
+# @brief  The courses of an instructor, as Instructor.get() gives them
+#         without stream, awaited by asgi.py
+async def get_courses_by_instructor_async(name, term, size, page_size,
+                                          search_after):
+    result = await search.get_courses_by_instructor_async(
+        name, fuzzy='fuzzy' in request.args, index=term, size=size,
+        source=parse_source_filter(request.args), page_size=page_size,
+        search_after=search_after)
+    filtered_fields = parse_url_array(request.args, 'filtered_fields')
+    return format_response(result, filtered_fields)
+
 
 class BuildingByTerm(Resource):
+    @utils.paged
     @utils.word_limit
-    def get(self, building, term):
+    def get(self, building, term, page_size=None, search_after=None):
+        source = parse_source_filter(request.args)
+        stream = is_streamed(request.args) and page_size is None
         result = search.get_courses_by_building_room(building, None,
-                                                     index=term, size=500)
+                                                     index=term, size=500,
+                                                     source=source,
+                                                     stream=stream,
+                                                     page_size=page_size,
+                                                     search_after=search_after)
         filtered_fields = parse_url_array(request.args, 'filtered_fields')
         return format_response(result, filtered_fields)
 
 
 class RoomByTerm(Resource):
+    @utils.paged
     @utils.word_limit
-    def get(self, room, term):
+    def get(self, room, term, page_size=None, search_after=None):
+        source = parse_source_filter(request.args)
+        stream = is_streamed(request.args) and page_size is None
         result = search.get_courses_by_building_room(None, room,
-                                                     index=term, size=500)
+                                                     index=term, size=500,
+                                                     source=source,
+                                                     stream=stream,
+                                                     page_size=page_size,
+                                                     search_after=search_after)
         filtered_fields = parse_url_array(request.args, 'filtered_fields')
         return format_response(result, filtered_fields)
 
 
 class BuildingRoom(Resource):
+    @utils.paged
     @utils.word_limit
-    def get(self, building, room):
-        result = search.get_courses_by_building_room(building, room, size=500)
+    def get(self, building, room, page_size=None, search_after=None):
+        source = parse_source_filter(request.args)
+        stream = is_streamed(request.args) and page_size is None
+        result = search.get_courses_by_building_room(building, room, size=500,
+                                                     source=source,
+                                                     stream=stream,
+                                                     page_size=page_size,
+                                                     search_after=search_after)
         filtered_fields = parse_url_array(request.args, 'filtered_fields')
         return format_response(result, filtered_fields)
 
 
 class BuildingRoomByTerm(Resource):
+    @utils.paged
     @utils.word_limit
-    def get(self, building, room, term):
+    def get(self, building, room, term, page_size=None, search_after=None):
+        source = parse_source_filter(request.args)
+        stream = is_streamed(request.args) and page_size is None
         result = search.get_courses_by_building_room(building, room,
-                                                     index=term, size=100)
+                                                     index=term, size=100,
+                                                     source=source,
+                                                     stream=stream,
+                                                     page_size=page_size,
+                                                     search_after=search_after)
         filtered_fields = parse_url_array(request.args, 'filtered_fields')
         return format_response(result, filtered_fields)
 
 
+class BuildingOccupancy(Resource):
+    def get(self, building, term):
+        result = search.get_building_occupancy(building, index=term,
+                                               bin_str=request.args.get('bin'))
+        return format_response(result)
+
+
 class Datetime(Resource):
     @utils.word_limit
     def get(self, datetime_str):
-        result = search.get_courses_by_datetime(datetime_str, size=500)
+        source = parse_source_filter(request.args)
+        stream = is_streamed(request.args)
+        result = search.get_courses_by_datetime(datetime_str, size=500,
+                                                source=source,
+                                                stream=stream)
         filtered_fields = parse_url_array(request.args, 'filtered_fields')
         return format_response(result, filtered_fields)
 
@@ -200,30 +493,39 @@ class Datetime(Resource):
 class DatetimeSpan(Resource):
     @utils.word_limit
     def get(self, datetime_str, span_str):
-        result = search.get_courses_by_datetime(datetime_str, span_str, size=500)
+        source = parse_source_filter(request.args)
+        stream = is_streamed(request.args)
+        result = search.get_courses_by_datetime(datetime_str, span_str, size=500,
+                                                source=source,
+                                                stream=stream)
         filtered_fields = parse_url_array(request.args, 'filtered_fields')
         return format_response(result, filtered_fields)
 
 
 class Search(Resource):
-    def get(self):
+    @utils.paged
+    def get(self, page_size=None, search_after=None):
         args = request.args
-        result = search.get_courses_by_searching(args, size=500)
+        source = parse_source_filter(args)
+        stream = is_streamed(args) and page_size is None
+        result = search.get_courses_by_searching(args, size=500,
+                                                 source=source,
+                                                 stream=stream,
+                                                 page_size=page_size,
+                                                 search_after=search_after)
         filtered_fields = parse_url_array(args, 'filtered_fields')
         return format_response(result, filtered_fields)
 
 
 class ListAllCourses(Resource):
     def get(self):
-        courseid_list = search.list_all_courses(None)
-        return {
-            'courseids': courseid_list
-        }
+        result = search.list_all_courses(None,
+                                         stream=is_streamed(request.args))
+        return format_response(result)
 
 
 class ListAllCoursesByTerm(Resource):
     def get(self, term):
-        courseid_list = search.list_all_courses(term)
-        return {
-            'courseids': courseid_list
-        }
+        result = search.list_all_courses(term,
+                                         stream=is_streamed(request.args))
+        return format_response(result)
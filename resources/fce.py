@@ -1,7 +1,7 @@
 from flask import Flask, request
 from flask_restful import Resource, reqparse
 from flask_restful.utils import cors
-from common import Message, search, utils
+from common import Message, fce_rollup, search, utils
 
 
 ##
@@ -41,13 +41,47 @@ def format_response(search_result):
 
 
 class FCEByID(Resource):
-    def get(self, courseid):
-        result = search.get_fce_by_id(courseid, size=300)
+    @utils.paged
+    def get(self, courseid, page_size=None, search_after=None):
+        result = search.get_fce_by_id(courseid, size=300, page_size=page_size,
+                                      search_after=search_after)
         return format_response(result)
 
 
 class FCEByInstructor(Resource):
+    @utils.paged
     @utils.word_limit
-    def get(self, instructor):
-        result = search.get_fce_by_instructor(instructor, size=300)
+    def get(self, instructor, page_size=None, search_after=None):
+        result = search.get_fce_by_instructor(instructor, size=300,
+                                              page_size=page_size,
+                                              search_after=search_after)
         return format_response(result)
+
+
+# @brief  Serves a summary from the rollup of the FCEs if it can, and from
+#         the aggregations of ES otherwise
+def summary_response(group, text, get_summary):
+    summary = fce_rollup.summarize(group, text)
+    if summary is not None:
+        return {'summary': summary}, 200
+    return format_response(get_summary(text))
+
+
+class FCESummaryByID(Resource):
+    def get(self, courseid):
+        return summary_response('courseid', courseid,
+                                search.get_fce_summary_by_id)
+
+
+class FCESummaryByInstructor(Resource):
+    @utils.word_limit
+    def get(self, instructor):
+        return summary_response('instructor', instructor,
+                                search.get_fce_summary_by_instructor)
+
+
+class FCESummaryByDepartment(Resource):
+    @utils.word_limit
+    def get(self, department):
+        return summary_response('department', department,
+                                search.get_fce_summary_by_department)
@@ -0,0 +1,40 @@
+# @file conftest.py
+# @brief Fixtures of the tests, run from the root of the repository with
+#        python -m pytest tests. ES is replaced by the in-memory stand-in of
+#        the benchmarks.
+# @author Justin Chu (justinchuby@cmu.edu)
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import config.settings  # noqa: E402
+from elasticsearch_dsl.connections import connections  # noqa: E402
+
+from benchmarks.fake_es import FakeElasticsearch  # noqa: E402
+from common import cache, index_version, local_index,\
+    term_snapshot  # noqa: E402
+
+
+##
+## @brief      An empty in-memory ES as the default connection, with the
+##             caches, versions, local indexes and snapshots of the previous
+##             tests dropped.
+##
+@pytest.fixture
+def es():
+    es = FakeElasticsearch()
+    connections.add_connection('default', es)
+    cache.clear()
+    index_version.clear()
+    yield es
+    index_version.wait()
+    local_index.wait()
+    for index in local_index.indexes():
+        local_index.unload(index)
+    term_snapshot.clear()
+    cache.clear()
+    index_version.clear()
@@ -0,0 +1,61 @@
+import asyncio
+
+import elasticsearch
+import pytest
+
+from common import aio
+
+aiohttp = pytest.importorskip('aiohttp')
+web = pytest.importorskip('aiohttp.web')
+
+
+##
+## @brief      Runs the client against a local server answering with the
+##             given (status, body) pairs in turn, and returns the result of
+##             use(client) along with the paths requested.
+##
+async def serve(answers, use, **kwargs):
+    answers = list(answers)
+    paths = []
+
+    async def handle(request):
+        paths.append(request.path_qs)
+        status, body = answers.pop(0)
+        return web.json_response(body, status=status)
+
+    app = web.Application()
+    app.router.add_route('*', '/{tail:.*}', handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    client = elasticsearch.Elasticsearch(
+        ['http://127.0.0.1:{}'.format(port)],
+        transport_class=aio.AsyncTransport,
+        connection_class=aio.AIOHttpConnection, **kwargs)
+    try:
+        return await use(client), paths
+    finally:
+        await client.transport.close()
+        await runner.cleanup()
+
+
+def test_unavailable_node_is_retried():
+    hits = {'hits': {'total': 0, 'hits': []}}
+    result, paths = asyncio.run(serve(
+        [(503, {'error': 'unavailable'}), (200, hits)],
+        lambda es: es.search(index='course-f17', body={'size': 0}),
+        max_retries=3))
+    assert result == hits
+    assert paths == ['/course-f17/_search'] * 2
+
+
+def test_errors_are_raised_as_elasticsearch_exceptions():
+    error = {'error': {'type': 'index_not_found_exception'}, 'status': 404}
+    with pytest.raises(elasticsearch.exceptions.NotFoundError) as e:
+        asyncio.run(serve(
+            [(404, error)],
+            lambda es: es.get(index='course-f17', doc_type='course',
+                              id='15-112', realtime=True)))
+    assert e.value.info == error
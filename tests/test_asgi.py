@@ -0,0 +1,125 @@
+import asyncio
+import json
+import time
+
+import pytest
+from elasticsearch_dsl.connections import connections
+
+from benchmarks import corpus
+from benchmarks.fake_es import AsyncFakeElasticsearch
+from common import aio, search
+from config.es_config import ES_COURSE_INDEX_PREFIX
+
+INDEX = ES_COURSE_INDEX_PREFIX + 'f17'
+LATENCY = 0.2
+
+
+@pytest.fixture
+def asgi(es, monkeypatch):
+    asgi = pytest.importorskip('asgi')
+    api = pytest.importorskip('api')
+    monkeypatch.setattr(search, 'init_es_connection', lambda: None)
+    monkeypatch.setattr(api, '_warmup_started', True)
+    yield asgi
+    connections.remove_connection(aio.ALIAS)
+
+
+@pytest.fixture
+def async_es(es, asgi):
+    async_es = AsyncFakeElasticsearch(es, latency=LATENCY)
+    connections.add_connection(aio.ALIAS, async_es)
+    return async_es
+
+
+async def get(asgi, path, query='', headers=()):
+    scope = {'type': 'http', 'method': 'GET', 'path': path,
+             'query_string': query.encode('latin-1'),
+             'headers': [(name.encode('latin-1'), value.encode('latin-1'))
+                         for name, value in headers]}
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b''}
+
+    async def send(message):
+        messages.append(message)
+
+    await asgi.application(scope, receive, send)
+    body = b''.join(message.get('body', b'') for message in messages[1:])
+    return (messages[0]['status'],
+            {name.decode('latin-1'): value.decode('latin-1')
+             for name, value in messages[0]['headers']},
+            body)
+
+
+async def get_many(asgi, paths):
+    return await asyncio.gather(*(get(asgi, path) for path in paths))
+
+
+def test_concurrent_requests_share_the_loop(es, asgi, async_es):
+    courses = corpus.generate_courses(100, term='f17', seed=4)
+    es.index_many(INDEX, 'course', courses, id_field='id')
+    # More requests than handler threads
+    assert len(courses) > asgi.settings.ASGI_HANDLER_THREADS
+    paths = ['/course/v1/course/{}/term/f17/'.format(course['id'])
+             for course in courses]
+
+    start = time.perf_counter()
+    responses = asyncio.run(get_many(asgi, paths))
+    elapsed = time.perf_counter() - start
+    for course, (status, headers, body) in zip(courses, responses):
+        assert status == 200
+        assert json.loads(body)['course']['id'] == course['id']
+        assert 'etag' in headers
+    # Every ES request waited at once, on the event loop
+    assert async_es.max_in_flight == len(courses)
+    assert elapsed < 10 * LATENCY
+
+
+def test_instructor_is_served_on_the_loop(es, asgi, async_es):
+    courses = corpus.generate_courses(20, term='f17', seed=4)
+    es.index_many(INDEX, 'course', courses, id_field='id')
+    name = courses[0]['lectures'][0]['instructors'][0].split(',')[0]
+
+    status, _, body = asyncio.run(get(
+        asgi, '/course/v1/instructor/{}/term/f17/'.format(name),
+        'page_size=5'))
+    assert status == 200
+    assert json.loads(body)['courses']
+    assert async_es.max_in_flight == 1
+
+    status, _, body = asyncio.run(get(
+        asgi, '/course/v1/instructor/{}/'.format(name), 'page_size=x'))
+    assert status == 400
+
+
+def test_conditional_request_skips_es(es, asgi, async_es):
+    courses = corpus.generate_courses(3, term='f17', seed=4)
+    es.index_many(INDEX, 'course', courses, id_field='id')
+    path = '/course/v1/course/{}/term/f17/'.format(courses[0]['id'])
+    status, headers, _ = asyncio.run(get(asgi, path))
+    assert status == 200
+
+    async_es.max_in_flight = 0
+    status, _, body = asyncio.run(get(asgi, path,
+                                      headers=[('if-none-match',
+                                                headers['etag'])]))
+    assert status == 304
+    assert body == b''
+    assert async_es.max_in_flight == 0
+
+
+def test_other_endpoints_are_served_by_flask(es, asgi, async_es):
+    courses = corpus.generate_courses(3, term='f17', seed=4)
+    es.index_many(INDEX, 'course', courses, id_field='id')
+
+    status, _, body = asyncio.run(get(asgi, '/course/v1/'))
+    assert status == 200
+    status, _, body = asyncio.run(get(
+        asgi, '/course/v1/list-all-courses/term/f17/', 'stream'))
+    assert status == 200
+    assert sorted(json.loads(body)['courseids']) == \
+        sorted(course['id'] for course in courses)
+    status, _, _ = asyncio.run(get(asgi, '/course/v1/missing/'))
+    assert status == 404
+    assert async_es.max_in_flight == 0
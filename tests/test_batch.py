@@ -0,0 +1,55 @@
+import pytest
+
+from benchmarks import corpus
+from common import search
+from config.es_config import ES_COURSE_INDEX_PREFIX
+
+URL = '/course/v1/courses/'
+
+
+@pytest.fixture
+def client(es, monkeypatch):
+    api = pytest.importorskip('api')
+    monkeypatch.setattr(search, 'init_es_connection', lambda: None)
+    return api.app.test_client()
+
+
+@pytest.fixture
+def courses(es):
+    courses = corpus.generate_courses(3, term='f17', seed=12)
+    es.index_many(ES_COURSE_INDEX_PREFIX + 'f17', 'course', courses,
+                  id_field='id')
+    return courses
+
+
+def test_batch_answers_each_course(client, courses):
+    courseids = [course['id'] for course in courses]
+    response = client.post(URL, json={'courseids': courseids + ['99-999'],
+                                      'term': 'f17'})
+    assert response.status_code == 200
+    found = response.get_json()['courses']
+    assert sorted(found) == sorted(courseids + ['99-999'])
+    assert found['99-999']['status'] == 404
+
+
+def test_batch_answers_a_course_asked_twice_once(client, courses):
+    courseid = courses[0]['id']
+    response = client.post(URL, json={'courseids': [courseid, courseid],
+                                      'term': 'f17'})
+    assert response.status_code == 200
+    assert list(response.get_json()['courses']) == [courseid]
+
+
+def test_batch_answers_a_course_per_term(client, courses):
+    courseid = courses[0]['id']
+    response = client.post(URL, json={'courses': [
+        {'courseid': courseid, 'term': 'f17'},
+        {'courseid': courseid, 'term': 's17'},
+        {'courseid': courses[1]['id'], 'term': 'f17'},
+    ]})
+    assert response.status_code == 200
+    found = response.get_json()['courses']
+    assert sorted(found) == sorted([courseid + '/f17', courseid + '/s17',
+                                    courses[1]['id']])
+    assert found[courseid + '/f17']['id'] == courseid
+    assert found[courseid + '/s17']['status'] == 404
@@ -0,0 +1,36 @@
+import pytest
+
+import config.cache
+from common import cache
+
+
+@pytest.fixture
+def search(monkeypatch):
+    monkeypatch.setattr(config.cache, 'CACHE_ENABLED', True)
+    cache.clear()
+    calls = []
+
+    @cache.cached('course', index=lambda args: 'course-f17')
+    def search(name, stream=False):
+        calls.append((name, stream))
+        return {'response': {}, 'name': name}
+
+    search.calls = calls
+    yield search
+    cache.clear()
+
+
+def test_repeated_call_is_cached(search):
+    assert search('a') == search('a')
+    assert len(search.calls) == 1
+
+
+@pytest.mark.parametrize('call', [
+    lambda search: search('a', True),
+    lambda search: search('a', stream=True),
+    lambda search: search(name='a', stream=True),
+])
+def test_streamed_call_is_not_cached(search, call):
+    call(search)
+    call(search)
+    assert len(search.calls) == 2
@@ -0,0 +1,65 @@
+import pytest
+
+import config.settings
+from benchmarks import corpus
+from common import index_version, search
+from config.es_config import ES_COURSE_INDEX_PREFIX, ES_FCE_INDEX
+
+
+@pytest.fixture
+def client(es, monkeypatch):
+    api = pytest.importorskip('api')
+    monkeypatch.setattr(search, 'init_es_connection', lambda: None)
+    monkeypatch.setattr(config.settings, 'INDEX_VERSION_TTL', 0)
+    return api.app.test_client()
+
+
+def test_course_with_fces_follows_both_indexes(es, client):
+    courses = corpus.generate_courses(5, term='f17', seed=11)
+    es.index_many(ES_COURSE_INDEX_PREFIX + 'f17', 'course', courses,
+                  id_field='id')
+    fces = corpus.generate_fces(courses[:1])
+    es.index_many(ES_FCE_INDEX, 'fce', fces)
+    url = '/course/v1/course/{}/term/f17/fce/'.format(courses[0]['id'])
+
+    response = client.get(url)
+    assert response.status_code == 200
+    assert 'max-age' in response.headers['Cache-Control']
+    etag = response.headers['ETag']
+    assert client.get(url, headers={'If-None-Match': etag}).status_code == \
+        304
+
+    # New FCEs of the course, its term is unchanged
+    added = corpus.generate_fces(courses[:1], years=(2018,))
+    es.index_many(ES_FCE_INDEX, 'fce', added)
+    index_version.refresh()
+    response = client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert len(response.get_json()['fces']) == len(fces) + len(added)
+
+
+def test_only_data_endpoints_are_validated(es, client):
+    courses = corpus.generate_courses(5, term='f17', seed=11)
+    es.index_many(ES_COURSE_INDEX_PREFIX + 'f17', 'course', courses,
+                  id_field='id')
+    api = pytest.importorskip('api')
+    for rule in api.app.url_map.iter_rules():
+        if rule.endpoint in ('static', 'get_metrics', 'get_health'):
+            continue
+        assert rule.endpoint in (api.COURSE_ENDPOINTS |
+                                 api.FCE_JOIN_ENDPOINTS | api.FCE_ENDPOINTS |
+                                 {'homehome', 'courseapihome',
+                                  'coursebatch'}), rule.endpoint
+
+    assert 'ETag' in client.get('/course/v1/courseid/{}/'.format(
+        courses[0]['id'])).headers
+    for url in ('/', '/course/v1/'):
+        response = client.get(url)
+        assert response.status_code == 200
+        assert 'ETag' not in response.headers
+    response = client.post('/course/v1/courses/',
+                           json={'courseids': [courses[0]['id']],
+                                 'term': 'f17'})
+    assert response.status_code == 200
+    assert 'ETag' not in response.headers
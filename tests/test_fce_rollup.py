@@ -0,0 +1,88 @@
+import math
+
+import pytest
+
+import config.cache
+from benchmarks import corpus
+from common import fce_rollup, search
+from config.fce import ES_FCE_INDEX
+
+pytest.importorskip('numpy')
+
+
+def assert_close(expected, actual, path=''):
+    if isinstance(expected, dict):
+        assert isinstance(actual, dict) and set(expected) == set(actual), path
+        for key in expected:
+            assert_close(expected[key], actual[key], '{}/{}'.format(path, key))
+    elif isinstance(expected, list):
+        assert isinstance(actual, list) and len(expected) == len(actual), path
+        for i, (x, y) in enumerate(zip(expected, actual)):
+            assert_close(x, y, '{}/{}'.format(path, i))
+    elif isinstance(expected, float) or isinstance(actual, float):
+        assert expected is not None and actual is not None, path
+        assert math.isclose(expected, actual, rel_tol=1e-9), path
+    else:
+        assert expected == actual, path
+
+
+##
+## @brief      Checks that the rollup answers like the aggregations of ES,
+##             for the courses, instructors and departments of the FCEs.
+##
+def assert_same_summaries(fces):
+    rollup = fce_rollup.get()
+    queries = [('courseid', search.get_fce_summary_by_id, fce['courseid'])
+               for fce in fces[::7]]
+    queries += [('instructor', search.get_fce_summary_by_instructor, name)
+                for fce in fces[::11]
+                for name in (fce['instructor'],
+                             fce['instructor'].split()[-1])]
+    queries += [('department', search.get_fce_summary_by_department,
+                 fce['department']) for fce in fces[::13]]
+    queries += [('courseid', search.get_fce_summary_by_id, '00-000'),
+                ('instructor', search.get_fce_summary_by_instructor,
+                 'nobody')]
+    for group, get_summary, text in queries:
+        expected = get_summary(text)
+        assert expected['response'].get('status') is None
+        assert_close(expected['summary'], rollup.summarize(group, text),
+                     '{}:{}'.format(group, text))
+
+
+@pytest.fixture
+def fces(es, monkeypatch):
+    monkeypatch.setattr(config.cache, 'CACHE_ENABLED', False)
+    courses = corpus.generate_courses(40, term='f17', seed=9)
+    fces = corpus.generate_fces(courses, seed=9)
+    # Rows of an unknown year count in the totals only
+    fces += [dict(fce, year=None) for fce in fces[::17]]
+    es.index_many(ES_FCE_INDEX, 'fce', fces)
+    yield fces
+    fce_rollup.unload()
+
+
+def test_rollup_equals_aggregations(fces):
+    fce_rollup.refresh()
+    assert_same_summaries(fces)
+
+
+def test_rollup_equals_aggregations_after_update(es, fces, monkeypatch):
+    fce_rollup.refresh()
+    courses = corpus.generate_courses(10, term='f17', seed=9)
+    added = corpus.generate_fces(courses, years=(2017, 2018), seed=10)
+    es.index_many(ES_FCE_INDEX, 'fce', added)
+
+    fetched = []
+    fetch = fce_rollup._fetch
+
+    def recorded_fetch(from_year=None):
+        fetched.append(from_year)
+        return fetch(from_year)
+
+    monkeypatch.setattr(fce_rollup, '_fetch', recorded_fetch)
+    fce_rollup.refresh()
+    # Only the latest year held and the ones after it were read again
+    assert fetched == [2017]
+    assert len(fce_rollup.get()) == len(fces) + len(added)
+    assert_same_summaries(fces + added)
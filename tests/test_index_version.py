@@ -0,0 +1,104 @@
+import threading
+
+import elasticsearch
+
+import config.settings
+from benchmarks import corpus
+from common import index_version
+from config.es_config import ES_COURSE_INDEX_PREFIX, ES_FCE_INDEX
+
+INDEX = ES_COURSE_INDEX_PREFIX + 'f17'
+
+
+def test_failure_is_cached(es, monkeypatch):
+    calls = []
+
+    def fail(indexes):
+        calls.append(indexes)
+        raise elasticsearch.exceptions.ConnectionError('N/A', 'down', None)
+
+    monkeypatch.setattr(index_version, 'fetch_versions', fail)
+    assert index_version.get(INDEX) is None
+    assert index_version.get(INDEX) is None
+    assert calls == [[INDEX]]
+
+
+def test_one_fetch_at_a_time(es, monkeypatch):
+    es.index_many(INDEX, 'course', corpus.generate_courses(5, term='f17'),
+                  id_field='id')
+    version = index_version.fetch_version(INDEX)
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def slow_fetch(indexes):
+        calls.append(indexes)
+        started.set()
+        release.wait(5)
+        return {INDEX: version}
+
+    monkeypatch.setattr(index_version, 'fetch_versions', slow_fetch)
+    thread = threading.Thread(target=index_version.get, args=(INDEX,))
+    thread.start()
+    assert started.wait(5)
+    # Answered without waiting for the fetch in progress
+    assert index_version.get(INDEX) is None
+    release.set()
+    thread.join()
+    assert index_version.get(INDEX) == version
+    assert calls == [[INDEX]]
+
+
+def test_version_survives_restart(es, monkeypatch):
+    es.index_many(INDEX, 'course', corpus.generate_courses(5, term='f17'),
+                  id_field='id')
+    version = index_version.fetch_version(INDEX)
+    stats = es.indices.stats
+
+    def restarted(*args, **kwargs):
+        # The indexing counters start over and merges purge the deleted
+        # documents when the nodes restart
+        result = stats(*args, **kwargs)
+        result['_all']['primaries']['docs']['deleted'] = 7
+        result['_all']['primaries']['indexing'] = {'index_total': 0}
+        return result
+
+    monkeypatch.setattr(es.indices, 'stats', restarted)
+    assert index_version.fetch_version(INDEX) == version
+
+
+def test_versions_are_read_together(es, monkeypatch):
+    indexes = [INDEX, ES_COURSE_INDEX_PREFIX + 's17',
+               ES_COURSE_INDEX_PREFIX + '*', ES_FCE_INDEX]
+    for index, term in zip(indexes, ('f17', 's17')):
+        es.index_many(index, 'course', corpus.generate_courses(5, term=term),
+                      id_field='id')
+    es.index_many(ES_FCE_INDEX, 'fce', corpus.generate_fces(
+        corpus.generate_courses(2, term='f17')))
+    stats_calls = []
+    stats = es.indices.stats
+
+    def counted_stats(*args, **kwargs):
+        stats_calls.append(kwargs.get('index'))
+        return stats(*args, **kwargs)
+
+    monkeypatch.setattr(es.indices, 'stats', counted_stats)
+    versions = index_version.fetch_versions(indexes + ['missing'])
+    assert len(stats_calls) == 1
+    assert versions['missing'] is None
+    assert len({versions[index].etag for index in indexes}) == len(indexes)
+    assert versions[INDEX] == index_version.fetch_version(INDEX)
+
+
+def test_versions_are_refreshed_in_background(es, monkeypatch):
+    monkeypatch.setattr(config.settings, 'INDEX_VERSION_TTL', 0)
+    es.index_many(INDEX, 'course', corpus.generate_courses(5, term='f17'),
+                  id_field='id')
+    version = index_version.get(INDEX)
+    es.index_many(INDEX, 'course',
+                  corpus.generate_courses(8, term='f17', seed=3)[5:],
+                  id_field='id')
+
+    # The last known version, while the new one is read
+    assert index_version.get(INDEX) == version
+    index_version.wait()
+    assert index_version.get(INDEX) != version
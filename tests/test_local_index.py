@@ -0,0 +1,51 @@
+import config.settings
+from benchmarks import corpus
+from common import index_version, local_index, search
+from common.memory_es import DocumentList
+from config.es_config import ES_COURSE_INDEX_PREFIX
+
+INDEX = ES_COURSE_INDEX_PREFIX + 'f17'
+
+
+def find_course(courseid):
+    searcher = search.CourseSearcher({'courseid': [courseid]}, index='f17')
+    response = searcher.execute_local()
+    assert response is not None, "Not answered by the local index"
+    return [hit.to_dict() for hit in response]
+
+
+def test_reindexed_term_is_reloaded(es, monkeypatch):
+    monkeypatch.setattr(config.settings, 'INDEX_VERSION_TTL', 0)
+    courses = corpus.generate_courses(20, term='f17', seed=1)
+    es.index_many(INDEX, 'course', courses, id_field='id')
+    local_index.load_from_es(INDEX)
+    index_version.get(INDEX)
+
+    renamed = dict(courses[0], name='Renamed Course')
+    added = corpus.generate_courses(21, term='f17', seed=2)[-1]
+    assert added['id'] not in {course['id'] for course in courses}
+    # The term is scraped again into a new index
+    es.indexes[INDEX] = DocumentList(created=es.indexes[INDEX].created + 1)
+    es.index_many(INDEX, 'course', [renamed] + courses[1:] + [added],
+                  id_field='id')
+
+    index_version.refresh()
+    local_index.wait()
+    assert local_index.get(INDEX) is not None
+    requests = es.stats()['requests']
+    assert [course['name'] for course in find_course(renamed['id'])] == \
+        ['Renamed Course']
+    assert [course['id'] for course in find_course(added['id'])] == \
+        [added['id']]
+    assert es.stats()['requests'] == requests
+
+
+def test_unchanged_term_is_kept(es, monkeypatch):
+    monkeypatch.setattr(config.settings, 'INDEX_VERSION_TTL', 0)
+    es.index_many(INDEX, 'course', corpus.generate_courses(5, term='f17'),
+                  id_field='id')
+    loaded = local_index.load_from_es(INDEX)
+    index_version.get(INDEX)
+    index_version.refresh()
+    local_index.wait()
+    assert local_index.get(INDEX) is loaded
@@ -0,0 +1,56 @@
+import elasticsearch
+import pytest
+
+from benchmarks import corpus
+from common import memory_es
+from config.es_config import ES_COURSE_INDEX_PREFIX
+
+INDEX = ES_COURSE_INDEX_PREFIX + 'f17'
+BODY = {'size': 0, 'aggs': {'units': {'cardinality': {'field': 'units'}}}}
+
+
+@pytest.fixture
+def courses(es):
+    es.index_many(INDEX, 'course', corpus.generate_courses(5, term='f17'),
+                  id_field='id')
+
+
+def test_unsupported_aggregation_is_a_bad_request(es, courses):
+    with pytest.raises(elasticsearch.exceptions.RequestError) as error:
+        es.search(index=INDEX, body=BODY)
+    assert error.value.status_code == 400
+    assert error.value.info['error']['type'] == 'parsing_exception'
+
+
+def test_unsupported_aggregation_in_msearch(es, courses):
+    responses = es.msearch(body=[{'index': INDEX}, BODY,
+                                 {'index': INDEX}, {'size': 1}])['responses']
+    assert responses[0]['status'] == 400
+    assert len(responses[1]['hits']['hits']) == 1
+
+
+def test_unsupported_query_is_a_bad_request(es, courses):
+    with pytest.raises(elasticsearch.exceptions.RequestError) as error:
+        es.search(index=INDEX, body={'query': {'fuzzy': {'name': 'x'}}})
+    assert error.value.status_code == 400
+    assert error.value.info['error']['type'] == 'parsing_exception'
+
+
+def test_scrolls_are_bounded(es, courses, monkeypatch):
+    monkeypatch.setattr(memory_es, 'MAX_SCROLLS', 3)
+    scroll_ids = [es.search(index=INDEX, body={'size': 1},
+                            scroll='1m')['_scroll_id'] for _ in range(5)]
+    assert len(es._scrolls) == 3
+    with pytest.raises(elasticsearch.exceptions.NotFoundError):
+        es.scroll(scroll_id=scroll_ids[0], scroll='1m')
+    assert len(es.scroll(scroll_id=scroll_ids[-1],
+                         scroll='1m')['hits']['hits']) == 1
+
+
+def test_expired_scrolls_are_dropped(es, courses):
+    scroll_id = es.search(index=INDEX, body={'size': 1},
+                          scroll='0s')['_scroll_id']
+    with pytest.raises(elasticsearch.exceptions.NotFoundError):
+        es.scroll(scroll_id=scroll_id, scroll='1m')
+    es.search(index=INDEX, body={'size': 1}, scroll='1m')
+    assert scroll_id not in es._scrolls
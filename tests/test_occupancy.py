@@ -0,0 +1,135 @@
+import threading
+
+import pytest
+
+import config.course
+import config.settings
+from benchmarks import corpus
+from common import index_version, search, term_snapshot
+from common.cmu_course import Course
+from common.memory_es import DocumentList
+from config.es_config import ES_COURSE_INDEX_PREFIX
+
+np = pytest.importorskip('numpy')
+
+INDEX = ES_COURSE_INDEX_PREFIX + 'f17'
+
+
+##
+## @brief      The minutes per week each room of a building is in use, with
+##             loops over the courses.
+##
+def room_minutes(courses, building):
+    minutes = {}
+    for scotty_dict in courses:
+        course = Course(scotty_dict)
+        for meeting in course.lectures + course.sections:
+            for time_obj in meeting.times:
+                if ((time_obj.building or '').upper() != building or
+                        time_obj.begin_minutes is None or
+                        time_obj.room is None):
+                    continue
+                days = bin(time_obj.day_mask).count('1')
+                length = time_obj.end_minutes - time_obj.begin_minutes
+                room = time_obj.room.upper()
+                minutes[room] = minutes.get(room, 0) + days * length
+    return {room: total for room, total in minutes.items() if total}
+
+
+def index_courses(es, courses):
+    es.index_many(INDEX, 'course', courses, id_field='id')
+
+
+def test_occupancy_of_building(es):
+    courses = corpus.generate_courses(200, term='f17', seed=5)
+    index_courses(es, courses)
+
+    output = search.get_building_occupancy('dh', 'f17', '30')
+    occupancy = output['occupancy']
+    assert output['response'] == {}
+    assert occupancy['building'] == 'DH'
+    assert len(occupancy['meetings']) == 7
+    assert all(len(day) == 48 for day in occupancy['meetings'])
+    assert occupancy['room_minutes'] == room_minutes(courses, 'DH')
+    assert occupancy['room_minutes']
+
+
+def test_occupancy_follows_the_index(es, monkeypatch):
+    monkeypatch.setattr(config.settings, 'INDEX_VERSION_TTL', 0)
+    courses = corpus.generate_courses(100, term='f17', seed=6)
+    index_courses(es, courses)
+    search.get_building_occupancy('DH', 'f17')
+
+    # The term is scraped again
+    rescraped = corpus.generate_courses(150, term='f17', seed=7)
+    es.indexes[INDEX] = DocumentList(created=es.indexes[INDEX].created + 1)
+    index_courses(es, rescraped)
+    index_version.refresh()
+    occupancy = search.get_building_occupancy('DH', 'f17')['occupancy']
+    assert occupancy['room_minutes'] == room_minutes(rescraped, 'DH')
+
+
+def test_build_does_not_block_other_terms(es, monkeypatch):
+    other = ES_COURSE_INDEX_PREFIX + 's17'
+    index_courses(es, corpus.generate_courses(20, term='f17', seed=13))
+    es.index_many(other, 'course',
+                  corpus.generate_courses(20, term='s17', seed=14),
+                  id_field='id')
+    term_snapshot.get(other)
+
+    started, release = threading.Event(), threading.Event()
+    from_es = term_snapshot.TermSnapshot.from_es
+
+    def slow_from_es(index, etag=None):
+        started.set()
+        release.wait(5)
+        return from_es(index, etag)
+
+    monkeypatch.setattr(term_snapshot.TermSnapshot, 'from_es', slow_from_es)
+    thread = threading.Thread(target=term_snapshot.get, args=(INDEX,))
+    thread.start()
+    assert started.wait(5)
+    try:
+        assert term_snapshot.get(other).index == other
+    finally:
+        release.set()
+        thread.join()
+    assert term_snapshot.get(INDEX).index == INDEX
+
+
+def test_snapshot_file_is_mapped(es, monkeypatch, tmp_path):
+    monkeypatch.setattr(config.course, 'TERM_SNAPSHOT_DIR', str(tmp_path))
+    index_courses(es, corpus.generate_courses(30, term='f17', seed=15))
+    built = term_snapshot.get(INDEX)
+    term_snapshot.clear()
+
+    def fail(index, etag=None):
+        raise AssertionError("built again")
+
+    monkeypatch.setattr(term_snapshot.TermSnapshot, 'from_es', fail)
+    loaded = term_snapshot.get(INDEX)
+    assert loaded is not built
+    assert isinstance(loaded.rows, np.memmap)
+    assert loaded.etag == built.etag
+    assert loaded.courseids == built.courseids
+    assert (loaded.rows == built.rows).all()
+
+
+@pytest.mark.parametrize('bin_str', ['7', '0', '2000', 'hour'])
+def test_invalid_bin(es, bin_str):
+    output = search.get_building_occupancy('DH', 'f17', bin_str)
+    assert output['response']['status'] == 400
+
+
+def test_occupancy_endpoint(es, monkeypatch):
+    api = pytest.importorskip('api')
+    monkeypatch.setattr(search, 'init_es_connection', lambda: None)
+    index_courses(es, corpus.generate_courses(50, term='f17', seed=8))
+    client = api.app.test_client()
+
+    response = client.get('/course/v1/building/DH/occupancy/term/f17/')
+    assert response.status_code == 200
+    assert len(response.get_json()['occupancy']['meetings'][0]) == 24
+    response = client.get('/course/v1/building/DH/occupancy/term/f17/'
+                          '?bin=7')
+    assert response.status_code == 400
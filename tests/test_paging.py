@@ -0,0 +1,31 @@
+from benchmarks import corpus
+from common import search, utils
+from config.es_config import ES_COURSE_INDEX_PREFIX
+
+
+def pages(get, page_size, **kwargs):
+    courses, search_after = [], None
+    while True:
+        output = get(page_size=page_size, search_after=search_after, **kwargs)
+        courses.extend(output['courses'])
+        if output['next_cursor'] is None:
+            return courses
+        search_after = utils.decode_cursor(output['next_cursor'])
+
+
+def test_pages_across_terms(es):
+    # The same courses, with the same _uid, in two terms
+    courses = corpus.generate_courses(30, seed=3)
+    for term in ('f17', 's18'):
+        es.index_many(ES_COURSE_INDEX_PREFIX + term, 'course',
+                      [dict(course, semester=term) for course in courses],
+                      id_field='id')
+    name = courses[0]['lectures'][0]['instructors'][0].split(',')[0]
+
+    unpaged = search.get_courses_by_instructor(name)['courses']
+    assert len(unpaged) >= 2
+    for page_size in (1, 2, 3):
+        paged = pages(search.get_courses_by_instructor, page_size, name=name)
+        assert sorted((course['semester'], course['id'])
+                      for course in paged) == \
+            sorted((course['semester'], course['id']) for course in unpaged)
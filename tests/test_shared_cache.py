@@ -0,0 +1,79 @@
+import json
+import time
+
+import pytest
+
+import config.cache
+from benchmarks import corpus
+from common import cache, search, shared_cache
+from config.es_config import ES_COURSE_INDEX_PREFIX
+
+fakeredis = pytest.importorskip('fakeredis')
+# fakeredis runs the Lua scripts with lupa
+pytest.importorskip('lupa')
+
+
+@pytest.fixture
+def shared(es, monkeypatch):
+    monkeypatch.setattr(config.cache, 'CACHE_ENABLED', True)
+    monkeypatch.setitem(config.cache.CACHE_TTL, 'course', 60)
+    shared = shared_cache.set_client(fakeredis.FakeStrictRedis())
+    yield shared
+    shared_cache.set_client(None)
+
+
+@pytest.fixture
+def courses(es):
+    courses = corpus.generate_courses(3, term='f17')
+    es.index_many(ES_COURSE_INDEX_PREFIX + 'f17', 'course', courses,
+                  id_field='id')
+    return [(course['id'], 'f17') for course in courses]
+
+
+def entry_keys(shared):
+    return shared.client.keys('{}:entry:*'.format(shared.prefix))
+
+
+def test_expired_lock_is_kept_for_its_new_owner(shared):
+    other_worker = shared_cache.SharedCache(shared.client)
+    assert shared.get('key', wait=False)[0] is False
+    lock_key = shared._lock_key('key')
+    # The lock expires and the other worker takes it
+    shared.client.delete(lock_key)
+    assert other_worker.get('key', wait=False)[0] is False
+    owner = shared.client.get(lock_key)
+
+    shared.set('key', 'value', 60)
+    assert shared.client.get(lock_key) == owner
+    other_worker.set('key', 'value', 60)
+    assert shared.client.get(lock_key) is None
+
+
+def test_stale_hit_is_not_kept_locally(shared, courses):
+    courseid, term = courses[0]
+    output = search.get_course_by_id(courseid, term)
+    key, = entry_keys(shared)
+    entry = json.loads(shared.client.get(key).decode('utf-8'))
+    entry['soft_expiry'] = time.time() - 1
+    shared.client.set(key, json.dumps(entry))
+    # Being refreshed by another worker
+    shared.client.set(key + b':lock', 'other')
+    cache._cache.invalidate()
+
+    assert search.get_course_by_id.get_cached(courseid, term) == \
+        (True, output)
+    assert len(cache._cache) == 0
+
+
+def test_batch_does_not_wait_for_locks(shared, courses):
+    shared.lock_wait = 5
+    outputs = search.get_course_by_id_batch(courses)
+    # Every course is being computed again by another worker
+    for key in entry_keys(shared):
+        shared.client.delete(key)
+        shared.client.set(key + b':lock', 'other')
+    cache._cache.invalidate()
+
+    start = time.monotonic()
+    assert search.get_course_by_id_batch(courses) == outputs
+    assert time.monotonic() - start < 1
@@ -0,0 +1,101 @@
+import threading
+import time
+
+import pytest
+
+import config.settings
+from benchmarks import corpus
+from common import search, singleflight
+from config.es_config import ES_COURSE_INDEX_PREFIX
+
+CALLERS = 8
+
+
+@pytest.fixture
+def instructor(es, monkeypatch):
+    monkeypatch.setattr(config.settings, 'SINGLE_FLIGHT', True)
+    courses = corpus.generate_courses(20, term='f17', seed=4)
+    es.index_many(ES_COURSE_INDEX_PREFIX + 'f17', 'course', courses,
+                  id_field='id')
+    return courses[0]['lectures'][0]['instructors'][0].split(',')[0]
+
+
+##
+## @brief      Makes the searches of ES block until released, once every
+##             caller is either in flight or waiting for the one in flight.
+##
+def block_searches(es, monkeypatch, error=None):
+    release = threading.Event()
+    calls = []
+    search_es = es.search
+
+    def blocked(*args, **kwargs):
+        calls.append(args)
+        release.wait(5)
+        if error is not None:
+            raise error
+        return search_es(*args, **kwargs)
+
+    monkeypatch.setattr(es, 'search', blocked)
+    return release, calls
+
+
+def wait_for_waiters(count):
+    deadline = time.monotonic() + 5
+    while singleflight.stats()['waiting'] < count:
+        assert time.monotonic() < deadline, "The callers were not coalesced"
+        time.sleep(0.01)
+
+
+def run_concurrently(f):
+    results = [None] * CALLERS
+    threads = []
+
+    def run(i):
+        try:
+            results[i] = f()
+        except Exception as e:
+            results[i] = e
+
+    for i in range(CALLERS):
+        threads.append(threading.Thread(target=run, args=(i,)))
+        threads[-1].start()
+    return threads, results
+
+
+def search_instructor(name):
+    return search.CourseSearcher({'instructor': [name]}, index='f17',
+                                 size=100).execute()
+
+
+def test_identical_searches_reach_es_once(es, monkeypatch, instructor):
+    expected = [hit.to_dict() for hit in search_instructor(instructor)]
+    assert expected
+    release, calls = block_searches(es, monkeypatch)
+
+    threads, results = run_concurrently(lambda: search_instructor(instructor))
+    wait_for_waiters(CALLERS - 1)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    for response in results:
+        assert [hit.to_dict() for hit in response] == expected
+    # Every caller got its own copy
+    assert len({id(response) for response in results}) == CALLERS
+
+
+def test_error_reaches_every_waiter(es, monkeypatch, instructor):
+    error = ValueError("Malformed response")
+    release, calls = block_searches(es, monkeypatch, error)
+
+    threads, results = run_concurrently(lambda: search_instructor(instructor))
+    wait_for_waiters(CALLERS - 1)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert all(result is error for result in results)
+    assert singleflight.stats()['in_flight'] == 0
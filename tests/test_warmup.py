@@ -0,0 +1,84 @@
+import threading
+
+import elasticsearch
+import pytest
+
+from benchmarks import corpus
+from common import search, utils, warmup
+from config.es_config import ES_COURSE_INDEX_PREFIX
+
+
+@pytest.fixture
+def client(es, monkeypatch):
+    api = pytest.importorskip('api')
+    monkeypatch.setattr(search, 'init_es_connection', lambda: None)
+    monkeypatch.setattr(warmup, '_ready', threading.Event())
+    monkeypatch.setattr(warmup, '_error', None)
+    monkeypatch.setattr(warmup, '_thread', None)
+    monkeypatch.setattr(api, '_warmup_started', False)
+    return api.app.test_client()
+
+
+def test_failed_warmup_does_not_block_requests(es, client, monkeypatch):
+    courses = corpus.generate_courses(3, term='f17', seed=16)
+    es.index_many(ES_COURSE_INDEX_PREFIX + 'f17', 'course', courses,
+                  id_field='id')
+    tries = []
+
+    def fail(terms=None):
+        tries.append(terms)
+        raise elasticsearch.exceptions.NotFoundError(404, 'missing')
+
+    def run_once():
+        try:
+            warmup.run()
+        except Exception:
+            pass
+
+    monkeypatch.setattr(search, 'init_local_indexes', fail)
+    # Tried once instead of until it succeeds
+    monkeypatch.setattr(warmup, '_run_until_ready', run_once)
+
+    url = '/course/v1/course/{}/term/f17/'.format(courses[0]['id'])
+    assert client.get(url).status_code == 200
+    warmup._thread.join()
+    assert tries
+    response = client.get('/health')
+    assert response.status_code == 503
+    assert response.get_json()['status'] == 'failed'
+    assert client.get(url).status_code == 200
+
+
+def test_ready_once_the_current_term_is_warm(es, client):
+    courses = corpus.generate_courses(3, term='f17', seed=16)
+    es.index_many(utils.get_current_course_index(), 'course', courses,
+                  id_field='id')
+    assert not warmup.is_ready()
+    warmup.run()
+
+    assert client.get('/health').status_code == 200
+    assert 'current term' in warmup.status()['seconds']
+    found, output = search.list_all_courses.get_cached('current')
+    assert found
+    assert sorted(output['courseids']) == sorted(c['id'] for c in courses)
+
+
+def test_current_term_not_scraped_yet(es, client):
+    warmup.run()
+    assert client.get('/health').status_code == 200
+
+
+def test_failed_current_term_is_not_ready(es, client, monkeypatch):
+    monkeypatch.setattr(search, 'scan_course_ids', lambda index: iter(
+        [{'status': 500, 'error': 'all shards failed'}]))
+    with pytest.raises(RuntimeError):
+        warmup.run()
+    assert client.get('/health').status_code == 503
+
+
+def test_warmup_is_started_once(es, client, monkeypatch):
+    starts = []
+    monkeypatch.setattr(warmup, 'start', lambda: starts.append(1))
+    for _ in range(3):
+        client.get('/health')
+    assert starts == [1]